@@ -0,0 +1,293 @@
+import argparse
+import json
+import math
+import platform
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import numpy as np
+from boid import Boid
+from boid_helper import generate_boids, serialize_boids, deserialize_boids
+from flock import Flock, deserialize_boids_array
+from network import Network, Package, PackageKind, ProtocolStatusCodes
+from server_simulation import ServerSimulation, WORLD_BOUNDS
+from spatial_grid import SpatialGrid
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+SCHEMA_VERSION = 1  # bumped when the layout of the results file changes
+
+DEFAULT_SIZES = (100, 1000, 10000, 100000)
+DEFAULT_SEED = 0
+DEFAULT_REPEATS = 10  # timed runs of every case
+DEFAULT_TIME_BUDGET = 5.0  # seconds, a case stops repeating once its timed runs took this long (at least one run is done)
+DEFAULT_THRESHOLD = 0.2  # a median this much slower than the baseline's is a regression
+STEP_DT = 1 / 60  # the simulation step of the step benchmarks, the server's default tick
+
+REFERENCE_DENSITY = 100 / ((WORLD_BOUNDS[2] - WORLD_BOUNDS[0]) * (WORLD_BOUNDS[3] - WORLD_BOUNDS[1]))  # 100 boids in the default world
+
+# step engines: name -> ServerSimulation arguments
+ENGINES = {
+    'boids': dict(engine='boids', step_mode='double_buffered'),
+    'boids-in-place': dict(engine='boids', step_mode='in_place'),
+    'boids-reference': dict(engine='boids', step_mode='in_place', use_spatial_grid=False),
+    'flock': dict(engine='flock'),
+    'parallel': dict(engine='parallel'),
+}
+
+# the largest flock the Boid object engines are benchmarked with, one step of a bigger one takes minutes
+ENGINE_MAX_BOIDS = {'boids': 10000, 'boids-in-place': 10000, 'boids-reference': 1000}
+
+RULES = ('neighbors', 'alignment', 'cohesion', 'separation', 'edge_avoidance')
+
+
+def world_bounds(num_boids: int) -> tuple[float, float, float, float]:
+    """The world of a benchmark flock, scaled with the number of boids so every size has the default world's density."""
+    scale = math.sqrt(num_boids / (REFERENCE_DENSITY * WORLD_BOUNDS[2] * WORLD_BOUNDS[3]))
+    return 0, 0, WORLD_BOUNDS[2] * scale, WORLD_BOUNDS[3] * scale
+
+
+def seeded_boids(num_boids: int, seed: int) -> list[Boid]:
+    """The same flock for the same size and seed, on every machine and every run."""
+    random.seed(seed * 1_000_003 + num_boids)
+    return generate_boids(num_boids, world_bounds(num_boids))
+
+
+def time_runs(run, repeats: int, time_budget: float, setup=None) -> list[float]:
+    """Time run() up to repeats times (after one untimed warmup run), stops early once time_budget is spent."""
+    if setup is not None:
+        setup()
+    run()
+
+    times = []
+    while len(times) < repeats and sum(times) < time_budget:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def make_result(benchmark: str, case: str, num_boids: int, times: list[float], payload_bytes: int | None = None) -> dict:
+    """One row of the results, the times are seconds per run."""
+    median = statistics.median(times)
+    result = {
+        'benchmark': benchmark,
+        'case': case,
+        'boids': num_boids,
+        'runs': len(times),
+        'median_s': median,
+        'mean_s': statistics.fmean(times),
+        'min_s': min(times),
+        'stdev_s': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'boids_per_s': num_boids / median if median > 0 else None,
+    }
+    if payload_bytes is not None:
+        result['payload_bytes'] = payload_bytes
+        result['mb_per_s'] = payload_bytes / median / 1e6 if median > 0 else None
+    return result
+
+
+def skipped_result(benchmark: str, case: str, num_boids: int, reason: str) -> dict:
+    return {'benchmark': benchmark, 'case': case, 'boids': num_boids, 'skipped': reason}
+
+
+def bench_step(engine: str, num_boids: int, seed: int, repeats: int, time_budget: float) -> dict:
+    """The time of one ServerSimulation.step, Boid.update for every boid in the Boid object engines."""
+    if num_boids > ENGINE_MAX_BOIDS.get(engine, num_boids):
+        return skipped_result('step', engine, num_boids, f"more than {ENGINE_MAX_BOIDS[engine]} boids")
+
+    simulation = ServerSimulation(seeded_boids(num_boids, seed), max_boids=num_boids, bounds=world_bounds(num_boids), **ENGINES[engine])
+    try:
+        times = time_runs(lambda: simulation.step(STEP_DT), repeats, time_budget)
+    finally:
+        simulation.close()
+    return make_result('step', engine, num_boids, times)
+
+
+def bench_rules(num_boids: int, seed: int, repeats: int, time_budget: float) -> list[dict]:
+    """The cost of every rule of Boid.update summed over the flock, with the neighbors found through the spatial grid."""
+    if num_boids > ENGINE_MAX_BOIDS['boids']:
+        return [skipped_result('rules', rule, num_boids, f"more than {ENGINE_MAX_BOIDS['boids']} boids") for rule in RULES]
+
+    boids = seeded_boids(num_boids, seed)
+    min_x, min_y, max_x, max_y = world_bounds(num_boids)
+    grid = SpatialGrid(Boid.PERCEPTION_RADIUS)
+    grid.rebuild(boids)
+
+    perception_squared = Boid.PERCEPTION_RADIUS * Boid.PERCEPTION_RADIUS
+    avoid_squared = Boid.AVOID_RADIUS * Boid.AVOID_RADIUS
+
+    def find_neighbors() -> list[tuple[list[Boid], list[Boid]]]:
+        neighbors = []
+        for boid in boids:
+            in_perception = [other for other in grid.query(boid.x, boid.y) if other is not boid and boid.get_distance_squared(other) < perception_squared]
+            in_avoidance = [other for other in in_perception if boid.get_distance_squared(other) < avoid_squared]
+            neighbors.append((in_perception, in_avoidance))
+        return neighbors
+
+    neighbors = find_neighbors()
+    runs = {
+        'neighbors': find_neighbors,
+        'alignment': lambda: [boid.alignment(in_perception) for boid, (in_perception, _) in zip(boids, neighbors)],
+        'cohesion': lambda: [boid.cohesion(in_perception) for boid, (in_perception, _) in zip(boids, neighbors)],
+        'separation': lambda: [boid.separation(in_avoidance) for boid, (_, in_avoidance) in zip(boids, neighbors)],
+        'edge_avoidance': lambda: [boid.edge_avoidance(min_x, min_y, max_x, max_y) for boid in boids],
+    }
+    return [make_result('rules', rule, num_boids, time_runs(runs[rule], repeats, time_budget)) for rule in RULES]
+
+
+def bench_serialization(num_boids: int, seed: int, repeats: int, time_budget: float) -> list[dict]:
+    """serialize_boids / deserialize_boids of Boid lists and their numpy counterparts, Flock.serialize and the array view."""
+    boids = seeded_boids(num_boids, seed)
+    flock = Flock.from_boids(boids)
+    payload = serialize_boids(boids)
+
+    runs = {
+        'serialize_boids': lambda: serialize_boids(boids),
+        'deserialize_boids': lambda: deserialize_boids(payload),
+        'flock_serialize': lambda: flock.serialize(),
+        'deserialize_boids_array': lambda: deserialize_boids_array(payload).copy(),  # copied, the view alone costs nothing
+    }
+    return [make_result('serialization', case, num_boids, time_runs(run, repeats, time_budget), len(payload)) for case, run in runs.items()]
+
+
+def echo_loop(sock: socket.socket):
+    """Send back every package until the connection is closed."""
+    while True:
+        result = Network.receive_data(sock, log=False)
+        if result is None:
+            continue
+        status, package = result
+        if status != ProtocolStatusCodes.ALL_GOOD or package.kind == PackageKind.EXIT:
+            break
+        Network.send_data(sock, package, log=False)
+
+
+def bench_network(num_boids: int, seed: int, repeats: int, time_budget: float) -> dict:
+    """The round trip of a BOIDS_STATE package through Network.send_data / receive_data over a loopback TCP connection."""
+    package = Package(PackageKind.BOIDS_STATE, serialize_boids(seeded_boids(num_boids, seed)))
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    for sock in (client, server):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    echo = threading.Thread(target=echo_loop, args=(server,), name="benchmark-echo")
+    echo.start()
+
+    def round_trip():
+        Network.send_data(client, package, log=False)
+        status, echoed = Network.receive_data(client, log=False)
+        if status != ProtocolStatusCodes.ALL_GOOD or len(echoed.payload) != len(package.payload):
+            raise ConnectionError(f"Loopback round trip failed: {status.name}")
+
+    try:
+        times = time_runs(round_trip, repeats, time_budget)
+    finally:
+        Network.send_data(client, Package(PackageKind.EXIT, b""), log=False)
+        echo.join()
+        client.close()
+        server.close()
+
+    # a round trip carries the payload both ways
+    return make_result('network', 'loopback_round_trip', num_boids, times, 2 * len(package.payload))
+
+
+def run_benchmarks(benchmarks: list[str], engines: list[str], sizes: list[int], seed: int, repeats: int, time_budget: float) -> list[dict]:
+    results = []
+    for num_boids in sizes:
+        if 'step' in benchmarks:
+            for engine in engines:
+                logger.info(f"step: {engine}, {num_boids} boids")
+                results.append(bench_step(engine, num_boids, seed, repeats, time_budget))
+        if 'rules' in benchmarks:
+            logger.info(f"rules: {num_boids} boids")
+            results += bench_rules(num_boids, seed, repeats, time_budget)
+        if 'serialization' in benchmarks:
+            logger.info(f"serialization: {num_boids} boids")
+            results += bench_serialization(num_boids, seed, repeats, time_budget)
+        if 'network' in benchmarks:
+            logger.info(f"network: {num_boids} boids")
+            results.append(bench_network(num_boids, seed, repeats, time_budget))
+    return results
+
+
+def environment() -> dict:
+    """What the numbers depend on, stored with them."""
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """The cases whose median is more than threshold slower than in the baseline, as readable lines."""
+    baseline_medians = {(row['benchmark'], row['case'], row['boids']): row['median_s'] for row in baseline if 'median_s' in row}
+
+    regressions = []
+    for row in results:
+        old = baseline_medians.get((row['benchmark'], row['case'], row['boids']))
+        if old is None or 'median_s' not in row or old <= 0:
+            continue
+        ratio = row['median_s'] / old
+        if ratio > 1 + threshold:
+            regressions.append(f"{row['benchmark']} {row['case']} {row['boids']} boids: {old * 1e3:.3f} ms -> {row['median_s'] * 1e3:.3f} ms (x{ratio:.2f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmarks of the simulation engines, the serialization and the network layer.")
+    parser.add_argument('--benchmarks', nargs='+', choices=('step', 'rules', 'serialization', 'network'),
+                        default=['step', 'rules', 'serialization', 'network'])
+    parser.add_argument('--engines', nargs='+', choices=tuple(ENGINES), default=list(ENGINES), help="the engines of the step benchmark")
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES), help="the flock sizes")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="the seed of the generated flocks")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help="the maximum number of timed runs of every case")
+    parser.add_argument('--time-budget', type=float, default=DEFAULT_TIME_BUDGET, help="seconds of timed runs per case")
+    parser.add_argument('--output', help="write the results (JSON) to this file instead of stdout")
+    parser.add_argument('--baseline', help="a previous results file, exit with status 1 if a case got slower than --threshold")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="the allowed slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, args.engines, args.sizes, args.seed, args.repeats, args.time_budget)
+    report = {
+        'schema': SCHEMA_VERSION,
+        'environment': environment(),
+        'settings': {'seed': args.seed, 'repeats': args.repeats, 'time_budget': args.time_budget, 'step_dt': STEP_DT},
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        logger.info(f"Results written to {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.threshold)
+        for line in regressions:
+            logger.error(f"Regression: {line}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        logger.info("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
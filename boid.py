@@ -1,6 +1,7 @@
 import struct
 import random
 import math
+from spatial_grid import SpatialGrid
 
 
 def to_polar(x: float, y: float) -> tuple[float, float]:
@@ -43,6 +44,7 @@ class Boid:
     ALIGNMENT = 1 / 8
     COHESION = 1 / 100
     EDGE_AVOIDANCE = 1 / 2
+    OBSTACLE_AVOIDANCE = 150  # the push per pixel a boid is inside the AVOID_RADIUS of an obstacle (see obstacles.py)
 
     MOVE_TOWARDS_WEIGHT = 100
 
@@ -200,8 +202,12 @@ class Boid:
         # Scale the direction vector by the MOVE_TOWARDS_WEIGHT
         return direction_x * Boid.MOVE_TOWARDS_WEIGHT, direction_y * Boid.MOVE_TOWARDS_WEIGHT
 
-    def update(self, dt: float, boids: list['Boid'], min_x: float, min_y: float, max_x: float, max_y: float, target_to: tuple[float, float] | None, target_away: tuple[float, float] | None):
-        boids_in_perception_range = [boid for boid in boids if boid is not self and self.get_distance_squared(boid) < Boid.PERCEPTION_RADIUS * Boid.PERCEPTION_RADIUS]
+    def update(self, dt: float, boids: list['Boid'], min_x: float, min_y: float, max_x: float, max_y: float, target_to: tuple[float, float] | None, target_away: tuple[float, float] | None,
+               grid: SpatialGrid | None = None, out: 'Boid | None' = None, obstacles: 'Obstacles | None' = None):
+        # with a grid only the nearby cells are scanned, without one every boid is (the reference mode)
+        candidates = boids if grid is None else grid.query(self.x, self.y)
+
+        boids_in_perception_range = [boid for boid in candidates if boid is not self and self.get_distance_squared(boid) < Boid.PERCEPTION_RADIUS * Boid.PERCEPTION_RADIUS]
         boids_in_avoidance_range = [boid for boid in boids_in_perception_range if boid is not self and self.get_distance_squared(boid) < Boid.AVOID_RADIUS * Boid.AVOID_RADIUS]
 
         # calculate edge avoidance
@@ -221,6 +227,12 @@ class Boid:
         fx = edge_avoidance_x + mtfx + mafx + afx + cfx + sfx
         fy = edge_avoidance_y + mtfy + mafy + afy + cfy + sfy
 
+        # calculate obstacle avoidance, only the obstacles of the boid's broadphase cell are tested
+        if obstacles is not None:
+            ofx, ofy = obstacles.avoidance(self.x, self.y)
+            fx += ofx
+            fy += ofy
+
         # enforce turn limit
         _, old_heading = to_polar(self.vx, self.vy)
         new_velocity_x = self.vx + fx * dt
@@ -235,19 +247,27 @@ class Boid:
             else:
                 new_heading = old_heading - Boid.MAX_TURN
 
-        self.vx, self.vy = from_polar(speed, new_heading)
+        # the new state is written to out when given (double buffered step), otherwise in place
+        target = self if out is None else out
+
+        target.vx, target.vy = from_polar(speed, new_heading)
 
         # enforce speed limit
-        speed, _ = to_polar(self.vx, self.vy)
+        speed, _ = to_polar(target.vx, target.vy)
         if speed > Boid.MAX_SPEED:
             scale = Boid.MAX_SPEED / speed
-            self.vx *= scale
-            self.vy *= scale
+            target.vx *= scale
+            target.vy *= scale
         elif speed < Boid.MIN_SPEED:
             scale = Boid.MIN_SPEED / speed
-            self.vx *= scale
-            self.vy *= scale
+            target.vx *= scale
+            target.vy *= scale
 
         # update position
-        self.x += self.vx * dt
-        self.y += self.vy * dt
+        old_x, old_y = self.x, self.y
+        target.x = self.x + target.vx * dt
+        target.y = self.y + target.vy * dt
+
+        # keep the grid in sync, later boids in this tick read the new position
+        if grid is not None and out is None:
+            grid.move(self, old_x, old_y)
@@ -2,6 +2,13 @@ from boid import Boid
 import random
 import math
 import boid
+import struct
+import numpy as np
+
+
+BOIDS_COUNT_FIELD_SIZE = 4  # the size of the number of boids field of a serialized boids list (32 bit)
+
+STATE_TICK_FIELD_SIZE = 4  # every state package (BOIDS_STATE, BOIDS_DELTA, BOIDS_STATE_COMPACT) starts with the server tick (32 bit)
 
 
 def generate_random_velocity_boid(start_x: float, start_y: float) -> Boid:
@@ -11,17 +18,60 @@ def generate_random_velocity_boid(start_x: float, start_y: float) -> Boid:
     return Boid(start_x, start_y, vx, vy)
 
 
-def generate_boids(num_boids: int) -> list[Boid]:
+def generate_boids(num_boids: int, bounds: tuple[float, float, float, float] = (0, 0, 800, 450)) -> list[Boid]:
+    """Generate boids at random positions inside bounds (min_x, min_y, max_x, max_y)."""
+    min_x, min_y, max_x, max_y = bounds
     boids = []
     for _ in range(num_boids):
-        x = random.uniform(0, 800)
-        y = random.uniform(0, 450)
+        x = random.uniform(min_x, max_x)
+        y = random.uniform(min_y, max_y)
         vx = -Boid.MAX_SPEED if random.random() < 0.5 else Boid.MAX_SPEED
         vy = -Boid.MAX_SPEED if random.random() < 0.5 else Boid.MAX_SPEED
         boids.append(Boid(x, y, vx, vy))
     return boids
 
 
+class DoubleBufferedBoids:
+    """
+    Steps a list of boids without changing them in place: every boid reads the snapshot of frame N (front)
+    and writes frame N+1 into a separate list (back), then the two are swapped.
+    The result does not depend on the order of the list.
+    """
+
+    def __init__(self, boids: list[Boid]):
+        self.front: list[Boid] = boids  # the current frame, boids are added to and removed from this list
+        self.back: list[Boid] = []  # the next frame, rewritten completely on every step
+
+    def sync_back(self):
+        """Make the back buffer match the front one (same length and ids)."""
+        if len(self.back) != len(self.front):
+            self.back = [Boid(0.0, 0.0, 0.0, 0.0, boid.id) for boid in self.front]
+        else:
+            for src, dst in zip(self.front, self.back):
+                dst.id = src.id
+
+    def step(self, dt: float, min_x: float, min_y: float, max_x: float, max_y: float,
+             target_to: tuple[float, float] | None, target_away: tuple[float, float] | None, grid=None, obstacles=None) -> list[Boid]:
+        """Step all the boids, returns the new front list."""
+        if grid is not None:
+            grid.rebuild(self.front)
+
+        self.sync_back()
+
+        for src, dst in zip(self.front, self.back):
+            src.update(dt, self.front, min_x, min_y, max_x, max_y, target_to, target_away, grid, out=dst, obstacles=obstacles)
+
+        self.front, self.back = self.back, self.front
+        return self.front
+
+
+def get_boids_arrays(boids: list[boid.Boid]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """The (ids, x, y, vx, vy) arrays of a list of boids."""
+    ids = np.fromiter((b.id for b in boids), dtype=np.uint32, count=len(boids))
+    values = np.array([(b.x, b.y, b.vx, b.vy) for b in boids], dtype=np.float64).reshape(len(boids), 4)
+    return ids, values[:, 0], values[:, 1], values[:, 2], values[:, 3]
+
+
 def get_triangle_points(x, y, vx, vy, size=1.0):
     """
     Given an origin (x, y) and a direction vector (vx, vy),
@@ -58,26 +108,144 @@ def get_triangle_points(x, y, vx, vy, size=1.0):
     return [(tip[0]+offset[0], tip[1]+offset[1]), (left[0]+offset[0], left[1]+offset[1]), (right[0]+offset[0], right[1]+offset[1])]
 
 
-def serialize_boids(boids: list[boid.Boid]) -> bytes:
-    """Serialize the list of boids for network transmission."""
-    serialized_data = b''
+def get_triangles_points(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray, size: float = 1.0) -> np.ndarray:
+    """
+    get_triangle_points for a whole flock in one vectorized pass.
+    Returns: (boids, 3, 2) float32 array, the tip, left and right points of every boid (a boid that does not move
+    points along x, the per boid version raises for it)
+    """
+    mag = np.hypot(vx, vy)
+    moving = mag > 0
+    dx = np.divide(vx, mag, out=np.ones_like(mag, dtype=np.float64), where=moving)
+    dy = np.divide(vy, mag, out=np.zeros_like(mag, dtype=np.float64), where=moving)
+
+    # the triangle is centered on its centroid, a third of the way from the base to the tip
+    forward_x, forward_y = dx * size, dy * size
+    side_x, side_y = -dy * (size / 2), dx * (size / 2)
+    base_x, base_y = x - forward_x / 3, y - forward_y / 3
+
+    points = np.empty((len(mag), 3, 2), dtype=np.float32)
+    points[:, 0, 0] = x + forward_x * (2 / 3)
+    points[:, 0, 1] = y + forward_y * (2 / 3)
+    points[:, 1, 0] = base_x + side_x
+    points[:, 1, 1] = base_y + side_y
+    points[:, 2, 0] = base_x - side_x
+    points[:, 2, 1] = base_y - side_y
+    return points
+
+
+def serialize_boids(boids: list[boid.Boid], tick: int | None = None) -> bytes:
+    """
+    Serialize the list of boids for network transmission, packed into one preallocated buffer.
+    With a tick, the buffer starts with the tick field (a BOIDS_STATE payload, see pack_state_tick).
+    """
+    boid_size = boid.Boid.get_bytes_size()
+    start = 0 if tick is None else STATE_TICK_FIELD_SIZE
+    serialized_data = bytearray(start + BOIDS_COUNT_FIELD_SIZE + len(boids) * boid_size)
 
-    serialized_data += len(boids).to_bytes(2, 'big')  # Number of boids
-    for boid in boids:
-        serialized_data += boid.serialize()
+    if tick is not None:
+        serialized_data[:start] = pack_state_tick(tick)
+    struct.pack_into('!I', serialized_data, start, len(boids))  # Number of boids
+    offset = start + BOIDS_COUNT_FIELD_SIZE
+    for b in boids:
+        struct.pack_into('!ffffI', serialized_data, offset, b.x, b.y, b.vx, b.vy, b.id)
+        offset += boid_size
 
-    return serialized_data
+    return bytes(serialized_data)
 
 
 def deserialize_boids(data: bytes) -> list[boid.Boid]:
-    """Deserialize the list of boids from network transmission."""
-    num_boids = int.from_bytes(data[:2], 'big')
-    boids = []
+    """Deserialize the list of boids from network transmission, unpacked in one pass over a memoryview (no slicing)."""
+    if len(data) < BOIDS_COUNT_FIELD_SIZE:
+        return []
 
-    for i in range(num_boids):
-        start_index = 2 + i * boid.Boid.get_bytes_size()
-        end_index = start_index + boid.Boid.get_bytes_size()
-        boid_data = data[start_index:end_index]
-        boids.append(boid.Boid.deserialize(boid_data))
+    num_boids = int.from_bytes(data[:BOIDS_COUNT_FIELD_SIZE], 'big')
+    records = memoryview(data)[BOIDS_COUNT_FIELD_SIZE:BOIDS_COUNT_FIELD_SIZE + num_boids * boid.Boid.get_bytes_size()]
 
-    return boids
+    return [boid.Boid(x, y, vx, vy, id) for x, y, vx, vy, id in struct.iter_unpack('!ffffI', records)]
+
+
+def pack_state_tick(tick: int) -> bytes:
+    """The tick field a state payload starts with, the encoders write it in the buffer they build the payload in."""
+    return (tick & 0xFFFFFFFF).to_bytes(STATE_TICK_FIELD_SIZE, 'big')
+
+
+def add_state_tick(tick: int, payload: bytes) -> bytes:
+    """Put the server tick in front of a payload that was built without it (this copies the payload)."""
+    return pack_state_tick(tick) + payload
+
+
+def split_state_tick(payload: bytes) -> tuple[int, memoryview]:
+    """Split a state package payload into the server tick and the state payload (a view, not a copy)."""
+    return int.from_bytes(payload[:STATE_TICK_FIELD_SIZE], 'big'), memoryview(payload)[STATE_TICK_FIELD_SIZE:]
+
+
+COMMANDS_HEADER_FORMAT = '!II'  # the number of added boids, the number of removed ids
+COMMANDS_HEADER_SIZE = struct.calcsize(COMMANDS_HEADER_FORMAT)
+
+
+def serialize_commands(added_boids: list[boid.Boid], removed_ids: list[int]) -> bytes:
+    """Serialize a batch of commands (the BOIDS_COMMANDS payload): the added boids ('!ffffI'), then the removed ids (u32)."""
+    boid_size = boid.Boid.get_bytes_size()
+    serialized_data = bytearray(COMMANDS_HEADER_SIZE + len(added_boids) * boid_size + len(removed_ids) * 4)
+
+    struct.pack_into(COMMANDS_HEADER_FORMAT, serialized_data, 0, len(added_boids), len(removed_ids))
+    offset = COMMANDS_HEADER_SIZE
+    for b in added_boids:
+        struct.pack_into('!ffffI', serialized_data, offset, b.x, b.y, b.vx, b.vy, b.id)
+        offset += boid_size
+
+    struct.pack_into(f'!{len(removed_ids)}I', serialized_data, offset, *removed_ids)
+
+    return bytes(serialized_data)
+
+
+def deserialize_commands(data: bytes) -> tuple[list[boid.Boid], list[int]]:
+    """Deserialize a batch of commands, returns (added boids, removed ids)."""
+    num_added, num_removed = struct.unpack_from(COMMANDS_HEADER_FORMAT, data)
+    records_size = num_added * boid.Boid.get_bytes_size()
+
+    records = memoryview(data)[COMMANDS_HEADER_SIZE:COMMANDS_HEADER_SIZE + records_size]
+    added_boids = [boid.Boid(x, y, vx, vy, id) for x, y, vx, vy, id in struct.iter_unpack('!ffffI', records)]
+    removed_ids = list(struct.unpack_from(f'!{num_removed}I', data, COMMANDS_HEADER_SIZE + records_size))
+
+    return added_boids, removed_ids
+
+
+TARGET_NONE = 0
+TARGET_TO = 1
+TARGET_AWAY = 2
+
+
+def serialize_targets(target_to: tuple[float, float] | None, target_away: tuple[float, float] | None) -> bytes:
+    """Serialize the flock targets (the SET_TARGET payload), target_to wins if both are given."""
+    if target_to is not None:
+        return struct.pack('!Bff', TARGET_TO, target_to[0], target_to[1])
+    if target_away is not None:
+        return struct.pack('!Bff', TARGET_AWAY, target_away[0], target_away[1])
+    return struct.pack('!Bff', TARGET_NONE, 0.0, 0.0)
+
+
+def deserialize_targets(data: bytes) -> tuple[tuple[float, float] | None, tuple[float, float] | None]:
+    """Deserialize the flock targets, returns (target_to, target_away)."""
+    mode, x, y = struct.unpack('!Bff', data)
+    if mode == TARGET_TO:
+        return (x, y), None
+    if mode == TARGET_AWAY:
+        return None, (x, y)
+    return None, None
+
+
+def serialize_viewport(viewport: tuple[float, float, float, float] | None) -> bytes:
+    """Serialize a client's viewport (the SET_VIEWPORT payload), (min_x, min_y, max_x, max_y) or None for the whole world."""
+    if viewport is None:
+        return struct.pack('!ffff', 0.0, 0.0, 0.0, 0.0)
+    return struct.pack('!ffff', *viewport)
+
+
+def deserialize_viewport(data: bytes) -> tuple[float, float, float, float] | None:
+    """Deserialize a client's viewport, an empty rectangle means the whole world (None)."""
+    min_x, min_y, max_x, max_y = struct.unpack('!ffff', data)
+    if max_x <= min_x or max_y <= min_y:
+        return None
+    return min_x, min_y, max_x, max_y
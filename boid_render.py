@@ -0,0 +1,80 @@
+import numpy as np
+from raylibpy import *
+from boid import Boid
+from boid_helper import get_triangle_points, get_triangles_points, get_boids_arrays
+from obstacles import Obstacles
+
+BOID_SIZE = 10  # the size of a drawn boid, in pixels
+OBSTACLE_LINE_WIDTH = 2  # the width of a drawn wall, in pixels
+OBSTACLE_CIRCLE_SIDES = 32  # the sides of the polygon a circle obstacle is drawn as
+OBSTACLE_COLOR = DARKGRAY
+
+# the boids drawn by one draw_triangle_strip call: raylib draws a strip of n points as n - 2 separate triangles (3
+# vertices each), so the 6 STRIP_BLOCK points of a boid cost 6 triangles (1 real, 5 degenerate), 18 vertices, 6 times
+# the vertices of the boid's own triangle; a call is 1024 * 18 = 18432 vertices, below raylib's default render batch
+# (8192 quads, 32768 vertices) so it never overflows it, STRIP_BOIDS must stay at or below 32768 // 18 = 1820
+STRIP_BOIDS = 1024
+
+# the strip points of one boid from its (tip, left, right) points: every boid is a real triangle joined to the next one
+# by degenerate (zero area) triangles, the block is 6 points so the real triangles all have the same strip parity and
+# are emitted as (right, left, tip), the counter-clockwise order raylib draws (the order draw_boid uses)
+STRIP_BLOCK = (0, 0, 1, 2, 2, 2)
+
+
+def draw_boid(boid: Boid, color: Color):
+    points = get_triangle_points(boid.x, boid.y, boid.vx, boid.vy, BOID_SIZE)
+    point1 = Vector2(points[0][0], points[0][1])
+    point2 = Vector2(points[1][0], points[1][1])
+    point3 = Vector2(points[2][0], points[2][1])
+
+    draw_triangle(point1, point3, point2, color)
+
+
+def draw_triangles(points: np.ndarray, color: Color):
+    """Draw (count, 3, 2) triangle points (get_triangles_points) in one color, a draw call per STRIP_BOIDS triangles."""
+    for start in range(0, len(points), STRIP_BOIDS):
+        strip = np.ascontiguousarray(points[start:start + STRIP_BOIDS][:, STRIP_BLOCK], dtype=np.float32)
+        count = strip.shape[0] * len(STRIP_BLOCK)
+        # Vector2 is a pair of c_float, the array is handed to raylib without a copy
+        draw_triangle_strip((Vector2 * count).from_buffer(strip), count, color)
+
+
+def draw_boids_arrays(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray, color: Color = BLUE):
+    """Draw a flock from its state arrays, all the triangles are computed in one pass and drawn in bulk."""
+    draw_triangles(get_triangles_points(x, y, vx, vy, BOID_SIZE), color)
+
+
+def draw_boids(boids: list[Boid], color: Color = BLUE):
+    _, x, y, vx, vy = get_boids_arrays(boids)
+    draw_boids_arrays(x, y, vx, vy, color)
+
+
+def get_obstacles_triangles(obstacles: Obstacles) -> np.ndarray:
+    """
+    The triangles of the obstacles for draw_triangles: a quad (2 triangles) per wall and a fan per circle.
+    Obstacles never move, so this is computed once and the triangles are drawn in bulk every frame.
+    """
+    walls = obstacles.radius == 0
+    ax, ay, bx, by = obstacles.ax[walls], obstacles.ay[walls], obstacles.bx[walls], obstacles.by[walls]
+    length = np.hypot(bx - ax, by - ay)
+    safe_length = np.where(length > 0, length, 1.0)
+    nx = -(by - ay) / safe_length * (OBSTACLE_LINE_WIDTH / 2)
+    ny = (bx - ax) / safe_length * (OBSTACLE_LINE_WIDTH / 2)
+    corners = np.stack([np.stack([ax + nx, ay + ny], -1), np.stack([bx + nx, by + ny], -1),
+                        np.stack([bx - nx, by - ny], -1), np.stack([ax - nx, ay - ny], -1)], 1)
+    quads = corners[:, [[0, 1, 2], [0, 2, 3]]].reshape(-1, 3, 2)
+
+    circles = ~walls
+    angles = np.linspace(0, 2 * np.pi, OBSTACLE_CIRCLE_SIDES + 1)
+    cx, cy, radius = obstacles.ax[circles, None], obstacles.ay[circles, None], obstacles.radius[circles, None]
+    rim = np.stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)], -1)
+    center = np.broadcast_to(np.stack([cx, cy], -1), (len(cx), OBSTACLE_CIRCLE_SIDES, 2))
+    fans = np.stack([center, rim[:, :-1], rim[:, 1:]], 2).reshape(-1, 3, 2)
+
+    triangles = np.concatenate([quads, fans]).astype(np.float32)
+
+    # draw_triangles takes the points in the order of get_triangles_points, flip the triangles wound the other way
+    p0, p1, p2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    flipped = (p1[:, 0] - p0[:, 0]) * (p2[:, 1] - p0[:, 1]) - (p1[:, 1] - p0[:, 1]) * (p2[:, 0] - p0[:, 0]) < 0
+    triangles[flipped] = triangles[flipped][:, [0, 2, 1]]
+    return triangles
@@ -0,0 +1,185 @@
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+from boid import Boid
+from boid_helper import serialize_targets, deserialize_targets
+from server_simulation import ServerSimulation
+from obstacles import Obstacles
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+# A checkpoint file, all the fields are big endian:
+#   header: magic (8 bytes), version (u16), tick (u64), world bounds (4 x f64), targets (the SET_TARGET payload)
+#   rng: the random module's state, version (u8), 625 words (u32), has gauss_next (u8), gauss_next (f64)
+#   boids: count (u32), then CHECKPOINT_BOID_DTYPE records, full precision so the restored world steps the same
+#   crc32 (u32) of everything before it
+CHECKPOINT_MAGIC = b'BOIDCKPT'
+CHECKPOINT_VERSION = 1
+
+CHECKPOINT_HEADER_FORMAT = '!8sHQdddd9s'
+CHECKPOINT_HEADER_SIZE = struct.calcsize(CHECKPOINT_HEADER_FORMAT)
+RNG_STATE_WORDS = 625  # the Mersenne Twister state and its position
+RNG_STATE_FORMAT = f'!B{RNG_STATE_WORDS}IBd'
+RNG_STATE_SIZE = struct.calcsize(RNG_STATE_FORMAT)
+CHECKPOINT_BOID_DTYPE = np.dtype([('id', '>u4'), ('x', '>f8'), ('y', '>f8'), ('vx', '>f8'), ('vy', '>f8')])
+
+DEFAULT_CHECKPOINT_INTERVAL = 5.0  # seconds between two checkpoints
+
+
+class Checkpoint:
+    """The whole state of the server's world at one tick: the boids (and so the id set), the targets, the tick and the RNG."""
+
+    def __init__(self, tick: int, bounds: tuple[float, float, float, float], boids: np.ndarray,
+                 target_to: tuple[float, float] | None, target_away: tuple[float, float] | None, rng_state: tuple):
+        self.tick = tick
+        self.bounds = bounds
+        self.boids = boids  # CHECKPOINT_BOID_DTYPE records
+        self.target_to = target_to
+        self.target_away = target_away
+        self.rng_state = rng_state  # random.getstate()
+
+    @classmethod
+    def capture(cls, simulation: ServerSimulation) -> 'Checkpoint':
+        """Copy the state of the simulation, O(boids) on the caller's thread, the encoding is left to the writer."""
+        ids, x, y, vx, vy = simulation.get_state_arrays()
+        boids = np.empty(len(ids), dtype=CHECKPOINT_BOID_DTYPE)
+        boids['id'] = ids
+        boids['x'] = x
+        boids['y'] = y
+        boids['vx'] = vx
+        boids['vy'] = vy
+        return cls(simulation.tick, simulation.bounds, boids, simulation.target_to, simulation.target_away, random.getstate())
+
+    def to_bytes(self) -> bytes:
+        rng_version, words, gauss_next = self.rng_state
+        data = (struct.pack(CHECKPOINT_HEADER_FORMAT, CHECKPOINT_MAGIC, CHECKPOINT_VERSION, self.tick, *self.bounds,
+                            serialize_targets(self.target_to, self.target_away)) +
+                struct.pack(RNG_STATE_FORMAT, rng_version, *words, gauss_next is not None, gauss_next or 0.0) +
+                len(self.boids).to_bytes(4, 'big') + self.boids.tobytes())
+        return data + zlib.crc32(data).to_bytes(4, 'big')
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Checkpoint':
+        """Decode a checkpoint, raises ValueError if it is not one or it is damaged."""
+        if len(data) < CHECKPOINT_HEADER_SIZE + RNG_STATE_SIZE + 8 or zlib.crc32(data[:-4]) != int.from_bytes(data[-4:], 'big'):
+            raise ValueError("The checkpoint is damaged (bad checksum)")
+
+        magic, version, tick, *rest = struct.unpack_from(CHECKPOINT_HEADER_FORMAT, data)
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError(f"Not a version {CHECKPOINT_VERSION} checkpoint")
+        bounds, targets = tuple(rest[:4]), rest[4]
+
+        rng_values = struct.unpack_from(RNG_STATE_FORMAT, data, CHECKPOINT_HEADER_SIZE)
+        rng_version, words, has_gauss_next, gauss_next = rng_values[0], rng_values[1:-2], rng_values[-2], rng_values[-1]
+        rng_state = (rng_version, tuple(words), gauss_next if has_gauss_next else None)
+
+        offset = CHECKPOINT_HEADER_SIZE + RNG_STATE_SIZE
+        count = int.from_bytes(data[offset:offset + 4], 'big')
+        boids = np.frombuffer(data, dtype=CHECKPOINT_BOID_DTYPE, count=count, offset=offset + 4)
+
+        return cls(tick, bounds, boids, *deserialize_targets(targets), rng_state)
+
+    def to_boids(self) -> list[Boid]:
+        return [Boid(x, y, vx, vy, id) for id, x, y, vx, vy in self.boids.tolist()]
+
+
+def write_checkpoint(path: str, checkpoint: Checkpoint):
+    """Write a checkpoint atomically: a crash while writing leaves the previous checkpoint in place."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(checkpoint.to_bytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path: str) -> Checkpoint | None:
+    """Read a checkpoint, None if there is none (a damaged one is logged and ignored too)."""
+    try:
+        with open(path, 'rb') as file:
+            return Checkpoint.from_bytes(file.read())
+    except FileNotFoundError:
+        return None
+    except ValueError as err:
+        logger.error(f"Ignoring the checkpoint {path}: {err}")
+        return None
+
+
+def restore_simulation(checkpoint: Checkpoint, engine: str = 'boids', step_mode: str = 'double_buffered',
+                       use_spatial_grid: bool = True, max_boids: int = 0, obstacles: Obstacles | None = None) -> ServerSimulation:
+    """
+    Build the simulation of a checkpoint in O(boids), it continues from the checkpoint's tick with the same RNG.
+    The obstacles are static, they come from the world's map and are not part of the checkpoint.
+    """
+    simulation = ServerSimulation(checkpoint.to_boids(), engine, step_mode, use_spatial_grid, max(max_boids, len(checkpoint.boids)), checkpoint.bounds,
+                                  obstacles)
+    simulation.tick = checkpoint.tick
+    simulation.set_targets(checkpoint.target_to, checkpoint.target_away)
+    random.setstate(checkpoint.rng_state)
+    return simulation
+
+
+class Checkpointer:
+    """
+    Checkpoints a simulation every interval seconds without stalling its loop: the state is copied on the loop's
+    thread and encoded and written on a background thread. When a write is still running the next checkpoint waits,
+    a newer one replaces it (only the newest checkpoint is worth writing).
+    """
+
+    def __init__(self, path: str, interval: float = DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.next_checkpoint = time.perf_counter() + interval
+
+        self.condition = threading.Condition()
+        self.pending: Checkpoint | None = None
+        self.closed = False
+        self.written = 0  # the number of checkpoints written
+
+        self.thread = threading.Thread(target=self.write_loop, name="checkpoint-writer")
+        self.thread.start()
+
+    def update(self, simulation: ServerSimulation):
+        """Call once per tick, takes a checkpoint when the interval passed."""
+        now = time.perf_counter()
+        if now >= self.next_checkpoint:
+            self.next_checkpoint = now + self.interval
+            self.submit(Checkpoint.capture(simulation))
+
+    def submit(self, checkpoint: Checkpoint):
+        with self.condition:
+            self.pending = checkpoint
+            self.condition.notify()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.closed)
+                checkpoint, self.pending = self.pending, None
+                if checkpoint is None:
+                    break
+
+            start = time.perf_counter()
+            try:
+                write_checkpoint(self.path, checkpoint)
+            except OSError as err:
+                logger.error(f"Failed writing the checkpoint {self.path}: {err}")
+                continue
+
+            self.written += 1
+            logger.debug(f"Checkpoint of tick {checkpoint.tick} ({len(checkpoint.boids)} boids) written in {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    def close(self, simulation: ServerSimulation | None = None):
+        """Stop the writer, after writing a last checkpoint of simulation (when given) so a restart loses nothing."""
+        if simulation is not None:
+            self.submit(Checkpoint.capture(simulation))
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
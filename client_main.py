@@ -1,12 +1,21 @@
 import threading
 import logging
 import queue
+import socket
 import time
 
+import numpy as np
 from raylibpy import *
-from boid_helper import get_triangle_points, deserialize_boids, generate_random_velocity_boid
+from boid_helper import get_triangles_points, deserialize_boids, generate_random_velocity_boid, serialize_commands, serialize_viewport, split_state_tick
 from network import Package, PackageKind
 from boid import Boid
+from delta_codec import DeltaDecoder, DeltaStatus
+from compact_codec import CompactStateDecoder
+from interpolation import SnapshotInterpolator
+from boid_render import BOID_SIZE, OBSTACLE_COLOR, draw_triangles, get_obstacles_triangles
+from obstacles import deserialize_obstacles
+from flock_index import FlockIndex
+from network_vars import SessionFlags
 from client_network import communicating_setup, setup_client_variables, get_shutdown, set_shutdown, setup_incoming_packets_thread, setup_outgoing_packets_thread
 from logger_utils import create_formatted_logger
 
@@ -17,13 +26,33 @@ logger = create_formatted_logger()
 
 shutdown = False  # a flag to indicate if the client should shut down
 
+obstacles_triangles: np.ndarray | None = None  # the world's obstacles, drawn as triangles, None until the server sends them
+
 PICK_BOID_SQUARED_RADIUS = 400  # squared radius to pick a boid, in pixels
 
+REQUEST_COMPACT_STATE = True  # ask the server for the compact state encoding (see compact_codec.py)
+
+REQUEST_SINGLE_CONNECTION = True  # run both directions over one connection, False opens the two extra connections
+
+INTERPOLATE_STATE = True  # render the flock interpolated between the received snapshots, False draws the newest one
+
+SEND_VIEWPORT = True  # ask the server for only the boids around the window, False gets the whole world
+
+EXIT_WAIT = 2.0  # how long the server gets to close the connection after the exit package, in seconds
+
 
 def setup_network():
     logger.debug("Setting up client-server communication...")
-    incoming_socket, outgoing_socket = communicating_setup()
-    incoming_socket.settimeout(2.0)
+    session_flags = SessionFlags.NONE
+    if REQUEST_COMPACT_STATE:
+        session_flags |= SessionFlags.COMPACT_STATE
+    if REQUEST_SINGLE_CONNECTION:
+        session_flags |= SessionFlags.SINGLE_CONNECTION
+    incoming_socket, outgoing_socket, granted_flags = communicating_setup(session_flags)
+    logger.debug(f"Session flags granted: {granted_flags!r}")
+    if incoming_socket is not outgoing_socket:
+        # a single connection stays blocking, a timeout would also apply to the sends (shutdown_network wakes it)
+        incoming_socket.settimeout(2.0)
 
     logger.debug("Setting up client network variables")
     set_shutdown(False)
@@ -36,116 +65,191 @@ def setup_network():
     incoming_thread.start()
     outgoing_thread.start()
 
-    return incoming_thread, outgoing_thread
+    return incoming_thread, outgoing_thread, incoming_socket
 
 
-def shutdown_network(incoming_thread, outgoing_thread):
+def shutdown_network(incoming_thread, outgoing_thread, incoming_socket):
     logger.debug("Shutting down client network...")
     outgoing_packets.put(Package(PackageKind.EXIT, b""))
 
-    time.sleep(1)  # Give some time for the exit package to be sent
+    # the outgoing thread ends right after the exit package is sent
+    outgoing_thread.join()
 
     set_shutdown(True)  # Set the shutdown flag to True
 
-    # Wait for the threads to finish
-    incoming_thread.join()
-    outgoing_thread.join()
+    # the server closes the connection once it gets the exit package, which ends the incoming thread
+    incoming_thread.join(EXIT_WAIT)
+    if incoming_thread.is_alive():
+        incoming_socket.shutdown(socket.SHUT_RDWR)  # wakes the incoming thread, it blocks in recv on a single connection
+        incoming_thread.join()
 
     logger.debug("Client network shut down successfully.")
 
 
-def get_closest_boid_to_point(boids: list[Boid], point: tuple[float, float]) -> tuple[Boid | None, float]:
-    """Get the closest boid to a given point."""
-    closest_boid = None
-    min_distance = float('inf')
+def receive_state(delta_decoder: DeltaDecoder, compact_decoder: CompactStateDecoder) -> tuple[int | None, list[Boid] | None]:
+    """
+    Handle all the waiting incoming packets, returns the server tick and the boids of the newest state received,
+    (None, None) when no state arrived. The replay player (replay_main.py) feeds its packets through here too.
+    """
+    global obstacles_triangles
+    new_state_pylod: memoryview | None = None
+    new_state_tick: int | None = None  # the server tick of the newest state received in this frame
+    new_boids: list[Boid] | None = None
+    while not incoming_packets.empty():
+        packet = incoming_packets.get()
+
+        # Process the packet
+        match packet.kind:
+            case PackageKind.BOIDS_STATE:
+                # Update boids state, only the newest one is decoded
+                new_state_tick, new_state_pylod = split_state_tick(packet.payload)
+            case PackageKind.BOIDS_DELTA:
+                tick, payload = split_state_tick(packet.payload)
+                match delta_decoder.apply(payload):
+                    case DeltaStatus.APPLIED:
+                        new_state_tick, new_state_pylod, new_boids = tick, None, delta_decoder.get_boids()
+                    case DeltaStatus.GAP:
+                        logger.warning("Gap in the boids delta stream, requesting a resync")
+                        outgoing_packets.put(Package(PackageKind.RESYNC_REQUEST, b""))
+                    case DeltaStatus.IGNORED:
+                        pass  # the state stays at the last applied frame until the keyframe
+            case PackageKind.BOIDS_STATE_COMPACT:
+                tick, payload = split_state_tick(packet.payload)
+                compact_boids = compact_decoder.decode(payload)
+                if compact_boids is not None:
+                    new_state_tick, new_state_pylod, new_boids = tick, None, compact_boids
+                else:
+                    logger.warning("Missing the boids index table, requesting a resync")
+                    outgoing_packets.put(Package(PackageKind.RESYNC_REQUEST, b""))
+            case PackageKind.OBSTACLES:
+                obstacles = deserialize_obstacles(packet.payload)
+                obstacles_triangles = get_obstacles_triangles(obstacles)
+                logger.info(f"Received {len(obstacles)} obstacles")
+            case PackageKind.ERROR:
+                logger.error(f"Error packet received: {packet.payload.decode('utf-8')}")
+            case _:
+                logger.warning(f"Unknown packet kind received: {packet.kind.name}")
+
+        incoming_packets.task_done()
+
+    # decode only when a new snapshot arrived, the decoded boids are kept between frames
+    if new_state_pylod is not None:
+        new_boids = deserialize_boids(new_state_pylod)
+
+    return new_state_tick, new_boids
+
+
+def pick_boid(flock_index: FlockIndex, flock: tuple[np.ndarray, ...], point: tuple[float, float], max_displacement: float = 0.0) -> int | None:
+    """
+    The id of the drawn boid closest to a point, None when no boid is within the pick radius. Both the newest state
+    and an interpolated flock (its boids at most max_displacement from the newest state) are picked through the index.
+    """
+    ids, x, y, _, _ = flock
+    if ids is flock_index.ids:
+        closest_boid, squared_distance = flock_index.get_closest_boid(point)
+        closest_id = closest_boid.id if closest_boid is not None else None
+    else:
+        closest_id, squared_distance = flock_index.get_closest_moved(point, ids, x, y, max_displacement)
 
-    for boid in boids:
-        distance = (boid.x - point[0]) ** 2 + (boid.y - point[1]) ** 2
-        if distance < min_distance:
-            min_distance = distance
-            closest_boid = boid
+    return closest_id if squared_distance < PICK_BOID_SQUARED_RADIUS else None
 
-    return closest_boid, min_distance
+
+def draw_flock(flock: tuple[np.ndarray, ...], picked_id: int | None, boids_id_i_added: list[int]):
+    """Draw the (ids, x, y, vx, vy) flock: the picked boid red, the ones this client added green, the rest blue."""
+    ids, x, y, vx, vy = flock
+    points = get_triangles_points(x, y, vx, vy, BOID_SIZE)
+
+    picked = ids == picked_id if picked_id is not None else np.zeros(len(ids), dtype=bool)
+    added = np.isin(ids, np.fromiter(boids_id_i_added, dtype=np.uint32, count=len(boids_id_i_added))) & ~picked
+
+    # a bulk draw per color
+    draw_triangles(points[~(picked | added)], BLUE)
+    draw_triangles(points[added], GREEN)
+    draw_triangles(points[picked], RED)
 
 
 if __name__ == '__main__':
-    incoming_thread, outgoing_thread = setup_network()
+    incoming_thread, outgoing_thread, incoming_socket = setup_network()
 
     init_window(800, 450, "Client view")
 
     set_target_fps(60)
 
-    boids: list[Boid] = []
+    if SEND_VIEWPORT:
+        viewport = (0.0, 0.0, float(get_screen_width()), float(get_screen_height()))
+        outgoing_packets.put(Package(PackageKind.SET_VIEWPORT, serialize_viewport(viewport)))
+
+    flock_index = FlockIndex([], PICK_BOID_SQUARED_RADIUS)  # the newest state, built once per received state
 
-    last_state_pylod: bytes = b""
+    flock = flock_index.arrays  # the (ids, x, y, vx, vy) drawn, the newest state or the interpolated one
+
+    max_displacement = 0.0  # how far a drawn boid can be from its position in the newest state, in pixels
 
     peaked_boid: int | None = None
 
     boids_id_i_added = []
 
+    delta_decoder = DeltaDecoder()  # the local state of the BOIDS_DELTA stream
+
+    compact_decoder = CompactStateDecoder()  # the index table of the BOIDS_STATE_COMPACT stream
+
+    interpolator = SnapshotInterpolator()  # the last snapshots, by server tick
+
     while not window_should_close() and get_shutdown() is False:
         # Update
         mouse_position = get_mouse_position()
-        closes_boid, squared_distance = get_closest_boid_to_point(boids, (mouse_position.x, mouse_position.y))
+        picked_id = pick_boid(flock_index, flock, (mouse_position.x, mouse_position.y), max_displacement)
+
+        # the commands of this frame, sent together in one BOIDS_COMMANDS package
+        added_boids: list[Boid] = []
+        removed_ids: list[int] = []
 
         if is_mouse_button_pressed(MOUSE_BUTTON_LEFT):
             # Generate a new boid at the mouse position
             new_boid = generate_random_velocity_boid(mouse_position.x, mouse_position.y)
             boids_id_i_added.append(new_boid.id)
-            outgoing_packets.put(Package(PackageKind.ADD_BOID, new_boid.serialize()))
+            added_boids.append(new_boid)
             logger.info(f"Added new boid at position: ({new_boid.x}, {new_boid.y}, {new_boid.id})")
 
         if is_mouse_button_pressed(MOUSE_BUTTON_RIGHT):
             # Remove the closest boid to the mouse position
-            if closes_boid is not None and squared_distance < PICK_BOID_SQUARED_RADIUS:
-                peaked_boid = closes_boid.id
-                outgoing_packets.put(Package(PackageKind.REMOVE_BOID, peaked_boid.to_bytes(4, 'big')))
+            if picked_id is not None:
+                peaked_boid = picked_id
+                removed_ids.append(peaked_boid)
                 logger.info(f"Removed boid with ID: {peaked_boid}")
 
+        if len(added_boids) > 0 or len(removed_ids) > 0:
+            outgoing_packets.put(Package(PackageKind.BOIDS_COMMANDS, serialize_commands(added_boids, removed_ids)))
+
         # remove all boids in boids_i_added that are no longer present
-        new_boids_i_added = []
-        for boid_id in boids_id_i_added:
-            if boid_id in [b.id for b in boids]:
-                new_boids_i_added.append(boid_id)
+        new_boids_i_added = [boid_id for boid_id in boids_id_i_added if boid_id in flock_index]
 
         # check if there is any incoming packet
-        while not incoming_packets.empty():
-            packet = incoming_packets.get()
+        new_state_tick, new_boids = receive_state(delta_decoder, compact_decoder)
 
-            # Process the packet
-            match packet.kind:
-                case PackageKind.BOIDS_STATE:
-                    # Update boids state
-                    last_state_pylod = packet.payload
-                case PackageKind.ERROR:
-                    logger.error(f"Error packet received: {packet.payload.decode('utf-8')}")
-                case _:
-                    logger.warning(f"Unknown packet kind received: {packet.kind.name}")
+        if new_boids is not None:
+            flock_index = FlockIndex(new_boids, PICK_BOID_SQUARED_RADIUS)
 
-            incoming_packets.task_done()
-
-        boids = deserialize_boids(last_state_pylod)
+        if INTERPOLATE_STATE:
+            now = time.perf_counter()
+            if new_boids is not None:
+                interpolator.push(new_state_tick, new_boids, now)
+            flock = interpolator.sample_arrays(now)
+            max_displacement = Boid.MAX_SPEED * interpolator.lag
+        else:
+            flock = flock_index.arrays
 
         mouse_position = get_mouse_position()
-        closes_boid, squared_distance = get_closest_boid_to_point(boids, (mouse_position.x, mouse_position.y))
+        picked_id = pick_boid(flock_index, flock, (mouse_position.x, mouse_position.y), max_displacement)
 
         # Draw
         begin_drawing()
         clear_background(RAYWHITE)
 
-        for boid in boids:
-            points = get_triangle_points(boid.x, boid.y, boid.vx, boid.vy, 10)
-            point1 = Vector2(points[0][0], points[0][1])
-            point2 = Vector2(points[1][0], points[1][1])
-            point3 = Vector2(points[2][0], points[2][1])
-
-            if closes_boid is not None and squared_distance < PICK_BOID_SQUARED_RADIUS and closes_boid.id == boid.id:
-                draw_triangle(point1, point3, point2, RED)
-            else:
-                if boid.id in new_boids_i_added:
-                    draw_triangle(point1, point3, point2, GREEN)
-                else:
-                    draw_triangle(point1, point3, point2, BLUE)
+        if obstacles_triangles is not None:
+            draw_triangles(obstacles_triangles, OBSTACLE_COLOR)
+
+        draw_flock(flock, picked_id, new_boids_i_added)
 
         draw_fps(10, 10)
 
@@ -155,4 +259,4 @@ if __name__ == '__main__':
 
     close_window()
 
-    shutdown_network(incoming_thread, outgoing_thread)
+    shutdown_network(incoming_thread, outgoing_thread, incoming_socket)
@@ -1,5 +1,5 @@
+import queue
 import socket
-import time
 import threading
 from network_vars import *
 from network import Network, ProtocolStatusCodes, Package, PackageKind
@@ -10,6 +10,8 @@ __outgoing_packets = None  # a queue for all outgoing packets
 
 __shutdown = False  # a flag to indicate if the client should shut down
 
+STOP_SENDING = None  # put in the outgoing queue to end the outgoing thread without sending anything more
+
 logger = create_formatted_logger()
 
 
@@ -51,6 +53,8 @@ def setup_incoming_packets_thread(incoming_socket):
                     __shutdown = True
                     break
 
+    __outgoing_packets.put(STOP_SENDING)  # wake the outgoing thread so it can end too
+
     logger.debug("Incoming packets thread shutting down...")
 
 
@@ -59,27 +63,53 @@ def setup_outgoing_packets_thread(outgoing_socket):
     logger.debug("Starting outgoing packets thread...")
 
     while not __shutdown:
-        if not __outgoing_packets.empty():
-            package = __outgoing_packets.get()
+        packages = [__outgoing_packets.get()]  # blocks until there is something to send
 
-            Network.send_data(outgoing_socket, package, log=False)
+        # send everything that is waiting in one go
+        while True:
+            try:
+                packages.append(__outgoing_packets.get_nowait())
+            except queue.Empty:
+                break
 
+        for _ in packages:
             __outgoing_packets.task_done()
 
-            if package.kind == PackageKind.EXIT:
-                logger.debug("Received exit package, shutting down...")
-                __shutdown = True
-                break
+        stop = STOP_SENDING in packages
+        if stop:
+            packages = packages[:packages.index(STOP_SENDING)]
+
+        status, message = Network.send_batch(outgoing_socket, packages, log=False)
+
+        if status != ProtocolStatusCodes.ALL_GOOD:
+            logger.fatal(f"Failed sending to the server: {status.name} {message}")
+            __shutdown = True
+            break
 
-        time.sleep(1 / 10)
+        if any(package.kind == PackageKind.EXIT for package in packages):
+            logger.debug("Sent exit package, shutting down...")
+            __shutdown = True
+            break
+
+        if stop:
+            break
 
     logger.debug("Outgoing packets thread shutting down...")
 
 
-def communicating_setup():
+def communicating_setup(session_flags: SessionFlags = SessionFlags.NONE, host: str = SERVER_IP, port: int = SERVER_SETUP_PORT):
+    """
+    Connect to the server (its setup port) and open the incoming and outgoing sockets.
+    session_flags are the options asked for in the handshake, the server may grant only some of them.
+    Returns: (incoming socket, outgoing socket, granted session flags)
+    """
     # Connect to server setup server
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((SERVER_IP, SERVER_SETUP_PORT))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # send the small input packages right away
+    client_socket.connect((host, port))
+
+    # Ask for the session options
+    Network.send_data(client_socket, Package(PackageKind.ESTABLISH_CONNECTION, session_flags.to_bytes(1, 'big')))
 
     # Receive the ports for incoming and outgoing communication
     status, package = Network.receive_data(client_socket)
@@ -87,21 +117,28 @@ def communicating_setup():
     if status != ProtocolStatusCodes.ALL_GOOD:
         raise Exception("Failed to establish connection with server setup server")
 
-    # Unpack the ports [servers' outgoing port, servers' incoming port]
+    # Unpack the ports [servers' outgoing port, servers' incoming port] and the granted session flags
     incoming_port, outgoing_port = package.payload[0:2], package.payload[2:4]
+    granted_flags = SessionFlags(package.payload[4]) if len(package.payload) > 4 else SessionFlags.NONE
 
     incoming_port = int.from_bytes(incoming_port, byteorder='big')
     outgoing_port = int.from_bytes(outgoing_port, byteorder='big')
 
-    print(f"Incoming port: {incoming_port}, Outgoing port: {outgoing_port}")
+    print(f"Incoming port: {incoming_port}, Outgoing port: {outgoing_port}, Session flags: {granted_flags!r}")
+
+    if granted_flags & SessionFlags.SINGLE_CONNECTION:
+        # both directions run over the setup connection
+        return client_socket, client_socket, granted_flags
+
     # create the incoming and outgoing sockets
     incoming_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    incoming_socket.connect((SERVER_IP, incoming_port))
+    incoming_socket.connect((host, incoming_port))
 
     outgoing_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    outgoing_socket.connect((SERVER_IP, outgoing_port))
+    outgoing_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    outgoing_socket.connect((host, outgoing_port))
 
-    return incoming_socket, outgoing_socket
+    return incoming_socket, outgoing_socket, granted_flags
 
 
 def setup_client_variables(incoming_queue, outgoing_queue):
@@ -0,0 +1,165 @@
+import enum
+import struct
+import numpy as np
+from boid import Boid
+from flock import BOID_WIRE_DTYPE
+from boid_helper import pack_state_tick
+
+# BOIDS_DELTA payload:
+#   header: seq (u32), base_seq (u32), flags (u8), added count (u32), changed count (u32), removed count (u32)
+#   added boids, then changed boids, in the Boid.serialize format ('!ffffI')
+#   removed boid ids (u32)
+# a keyframe (flags & DELTA_KEYFRAME) holds every boid as added, base_seq is ignored.
+# a delta applies only to the state of frame base_seq, a client that has another frame must request a resync.
+DELTA_HEADER_FORMAT = '!IIBIII'
+DELTA_HEADER_SIZE = struct.calcsize(DELTA_HEADER_FORMAT)
+DELTA_FLAGS_OFFSET = struct.calcsize('!II')  # where the flags are in the header
+
+DELTA_KEYFRAME = 0x01
+
+KEYFRAME_INTERVAL = 60  # a keyframe is sent to every client once every this many frames
+QUANTIZE_SCALE = 16  # boids are sent only when their state changed by at least 1 / QUANTIZE_SCALE (pixels, pixels per second)
+
+
+def _quantize(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray) -> np.ndarray:
+    return np.round(np.stack((x, y, vx, vy), axis=1) * QUANTIZE_SCALE).astype(np.int64)
+
+
+def _pack_records(ids: np.ndarray, x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray) -> bytes:
+    records = np.empty(len(ids), dtype=BOID_WIRE_DTYPE)
+    records['x'] = x
+    records['y'] = y
+    records['vx'] = vx
+    records['vy'] = vy
+    records['id'] = ids
+    return records.tobytes()
+
+
+class DeltaEncoder:
+    """
+    Builds the BOIDS_DELTA stream of the server, once per broadcast for all the clients.
+    The encoder keeps the state the clients hold (the baseline): a boid is sent only when its quantized state differs
+    from the baseline, so every client that applied all the deltas holds exactly the baseline.
+    """
+
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0  # the number of the last encoded frame
+
+        # the baseline, sorted by id
+        self.ids = np.empty(0, dtype=np.uint32)
+        self.x = np.empty(0, dtype=np.float32)
+        self.y = np.empty(0, dtype=np.float32)
+        self.vx = np.empty(0, dtype=np.float32)
+        self.vy = np.empty(0, dtype=np.float32)
+        self.quantized = np.empty((0, 4), dtype=np.int64)
+
+        self._tick_field = b""  # the payloads start with it, empty when encoding without a tick
+        self._delta_payload = b""
+        self._keyframe_payload: bytes | None = None
+
+    def update(self, ids: np.ndarray, x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray, tick: int | None = None):
+        """
+        Encode the next frame from the current state of the world.
+        With a tick, the payloads of the frame start with the tick field, ready to be sent as they are.
+        """
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order].astype(np.uint32)
+        x = x[order].astype(np.float32)
+        y = y[order].astype(np.float32)
+        vx = vx[order].astype(np.float32)
+        vy = vy[order].astype(np.float32)
+        quantized = _quantize(x, y, vx, vy)
+
+        # match the current boids with the baseline
+        positions = np.searchsorted(self.ids, ids)
+        safe_positions = np.minimum(positions, max(len(self.ids) - 1, 0))
+        matched = (positions < len(self.ids)) & (self.ids[safe_positions] == ids) if len(self.ids) > 0 else np.zeros(len(ids), dtype=bool)
+
+        changed = matched.copy()
+        changed[matched] = np.any(self.quantized[positions[matched]] != quantized[matched], axis=1)
+        added = ~matched
+        removed_ids = self.ids[~np.isin(self.ids, ids, assume_unique=True)]
+
+        # unchanged boids keep their baseline values, this is what the clients have
+        unchanged = matched & ~changed
+        x[unchanged] = self.x[positions[unchanged]]
+        y[unchanged] = self.y[positions[unchanged]]
+        vx[unchanged] = self.vx[positions[unchanged]]
+        vy[unchanged] = self.vy[positions[unchanged]]
+        quantized[unchanged] = self.quantized[positions[unchanged]]
+
+        self.ids, self.x, self.y, self.vx, self.vy, self.quantized = ids, x, y, vx, vy, quantized
+        self.seq += 1
+
+        self._tick_field = b"" if tick is None else pack_state_tick(tick)
+        self._delta_payload = b"".join((self._tick_field,
+                                        struct.pack(DELTA_HEADER_FORMAT, self.seq, self.seq - 1, 0, int(added.sum()), int(changed.sum()), len(removed_ids)),
+                                        _pack_records(ids[added], x[added], y[added], vx[added], vy[added]),
+                                        _pack_records(ids[changed], x[changed], y[changed], vx[changed], vy[changed]),
+                                        removed_ids.astype('>u4').tobytes()))
+        self._keyframe_payload = None
+
+    def is_keyframe_due(self) -> bool:
+        """True when every client should get a keyframe in this frame."""
+        return self.seq % self.keyframe_interval == 1 or self.keyframe_interval == 1
+
+    def delta_payload(self) -> bytes:
+        """The delta from the previous frame to the current one."""
+        return self._delta_payload
+
+    def keyframe_payload(self) -> bytes:
+        """The whole baseline of the current frame, built at most once per frame."""
+        if self._keyframe_payload is None:
+            self._keyframe_payload = b"".join((self._tick_field,
+                                               struct.pack(DELTA_HEADER_FORMAT, self.seq, self.seq, DELTA_KEYFRAME, len(self.ids), 0, 0),
+                                               _pack_records(self.ids, self.x, self.y, self.vx, self.vy)))
+        return self._keyframe_payload
+
+
+class DeltaStatus(enum.Enum):
+    """What DeltaDecoder.apply did with a payload."""
+    APPLIED = enum.auto()  # the state is now at the payload's frame
+    GAP = enum.auto()  # the payload does not follow the current frame, a resync should be requested
+    IGNORED = enum.auto()  # a resync is already pending, the deltas are ignored until the keyframe
+
+
+class DeltaDecoder:
+    """Applies the BOIDS_DELTA stream on the client, keeps the boids by id."""
+
+    def __init__(self):
+        self.boids: dict[int, Boid] = {}
+        self.seq: int | None = None  # the frame the state is at, None until the first keyframe
+        self.waiting_for_keyframe = True  # a resync was requested (or we just connected)
+
+    def get_boids(self) -> list[Boid]:
+        return list(self.boids.values())
+
+    def apply(self, payload: bytes) -> DeltaStatus:
+        """
+        Apply a BOIDS_DELTA payload.
+        Returns GAP when a resync should be requested: the payload does not follow the current frame.
+        The deltas are then IGNORED until the next keyframe, without asking for another resync.
+        """
+        seq, base_seq, flags, num_added, num_changed, num_removed = struct.unpack_from(DELTA_HEADER_FORMAT, payload)
+
+        if flags & DELTA_KEYFRAME:
+            self.boids.clear()
+        elif self.seq is None or base_seq != self.seq:
+            if self.waiting_for_keyframe:
+                return DeltaStatus.IGNORED  # the gap was reported already, until the keyframe arrives
+            self.waiting_for_keyframe = True
+            return DeltaStatus.GAP
+
+        records_size = (num_added + num_changed) * Boid.get_bytes_size()
+        records = memoryview(payload)[DELTA_HEADER_SIZE:DELTA_HEADER_SIZE + records_size]
+        for x, y, vx, vy, id in struct.iter_unpack('!ffffI', records):
+            self.boids[id] = Boid(x, y, vx, vy, id)
+
+        removed = memoryview(payload)[DELTA_HEADER_SIZE + records_size:DELTA_HEADER_SIZE + records_size + num_removed * 4]
+        for (id,) in struct.iter_unpack('!I', removed):
+            self.boids.pop(id, None)
+
+        self.seq = seq
+        self.waiting_for_keyframe = False
+        return DeltaStatus.APPLIED
@@ -0,0 +1,319 @@
+import numpy as np
+from boid import Boid
+from boid_helper import BOIDS_COUNT_FIELD_SIZE, STATE_TICK_FIELD_SIZE, pack_state_tick
+from obstacles import Obstacles
+from metrics import server_metrics
+
+# the network layout of a boid, the same as Boid.serialize ('!ffffI')
+BOID_WIRE_DTYPE = np.dtype([('x', '>f4'), ('y', '>f4'), ('vx', '>f4'), ('vy', '>f4'), ('id', '>u4')])
+
+
+def deserialize_boids_array(data: bytes) -> np.ndarray:
+    """
+    View a serialize_boids payload as a structured array (fields x, y, vx, vy, id), without copying it.
+    The view keeps the payload alive and is read only.
+    """
+    if len(data) < BOIDS_COUNT_FIELD_SIZE:
+        return np.empty(0, dtype=BOID_WIRE_DTYPE)
+
+    num_boids = int.from_bytes(data[:BOIDS_COUNT_FIELD_SIZE], 'big')
+    return np.frombuffer(data, dtype=BOID_WIRE_DTYPE, count=num_boids, offset=BOIDS_COUNT_FIELD_SIZE)
+
+
+NEIGHBOR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def neighbor_pairs(x: np.ndarray, y: np.ndarray, radius: float, count: int | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find all the pairs (i, j), i != j, of points closer than radius to each other, using a sorted cell list.
+    Only the first count points are used as i (all of them by default), every point can be a j.
+    Returns: (i, j, squared distance) arrays
+    """
+    count = len(x) if count is None else count
+    if count == 0 or len(x) < 2:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty, np.empty(0, dtype=np.float64)
+
+    cx = np.floor(x / radius).astype(np.int64)
+    cy = np.floor(y / radius).astype(np.int64)
+    cx -= cx.min() - 1  # leave an empty border so the neighbor cells never wrap around
+    cy -= cy.min() - 1
+    width = int(cy.max()) + 2
+    keys = cx * width + cy
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    all_i = []
+    all_j = []
+    rows = np.arange(count)
+    for dx, dy in NEIGHBOR_OFFSETS:
+        neighbor_keys = keys[:count] + dx * width + dy
+        start = np.searchsorted(sorted_keys, neighbor_keys, 'left')
+        end = np.searchsorted(sorted_keys, neighbor_keys, 'right')
+        lengths = end - start
+
+        total = int(lengths.sum())
+        if total == 0:
+            continue
+
+        # expand every [start, end) range into the positions it covers
+        offsets = np.repeat(start - (np.cumsum(lengths) - lengths), lengths)
+        all_i.append(np.repeat(rows, lengths))
+        all_j.append(order[np.arange(total) + offsets])
+
+    if len(all_i) == 0:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty, np.empty(0, dtype=np.float64)
+
+    i = np.concatenate(all_i)
+    j = np.concatenate(all_j)
+    distance_squared = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2
+
+    mask = (i != j) & (distance_squared < radius * radius)
+    return i[mask], j[mask], distance_squared[mask]
+
+
+def _move_to_target(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray, direction_x: np.ndarray, direction_y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The vectorized body of Boid.move_towards / Boid.move_away_from, given the direction vectors."""
+    distance = np.sqrt(direction_x ** 2 + direction_y ** 2)
+    at_target = distance == 0
+    safe_distance = np.where(at_target, 1.0, distance)
+
+    fx = np.where(at_target, vx, direction_x / safe_distance * Boid.MOVE_TOWARDS_WEIGHT)
+    fy = np.where(at_target, vy, direction_y / safe_distance * Boid.MOVE_TOWARDS_WEIGHT)
+    return fx, fy
+
+
+def compute_step(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray, count: int, dt: float,
+                 min_x: float, min_y: float, max_x: float, max_y: float,
+                 target_to: tuple[float, float] | None, target_away: tuple[float, float] | None,
+                 obstacles: Obstacles | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the next state of the first count boids, the same rules and parameters as Boid.update.
+    Every boid in the arrays is used as a neighbor, so the ones after count act as read only ghosts.
+    All the forces are computed from the given state (a snapshot), the arrays are not modified.
+    Returns: the new (x, y, vx, vy) arrays of the first count boids
+    """
+    with server_metrics.phase('neighbors'):
+        i, j, distance_squared = neighbor_pairs(x, y, Boid.PERCEPTION_RADIUS, count)
+
+    with server_metrics.phase('forces'):
+        return _compute_forces(x, y, vx, vy, count, dt, min_x, min_y, max_x, max_y, target_to, target_away, obstacles, i, j, distance_squared)
+
+
+def _compute_forces(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray, count: int, dt: float,
+                    min_x: float, min_y: float, max_x: float, max_y: float,
+                    target_to: tuple[float, float] | None, target_away: tuple[float, float] | None, obstacles: Obstacles | None,
+                    i: np.ndarray, j: np.ndarray, distance_squared: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """The rules of compute_step applied over the neighbor pairs (i, j)."""
+    px, py, pvx, pvy = x[:count], y[:count], vx[:count], vy[:count]
+
+    # alignment and cohesion, over the boids inside the perception radius
+    neighbors = np.bincount(i, minlength=count)
+    has_neighbors = neighbors > 0
+    safe_neighbors = np.where(has_neighbors, neighbors, 1)
+
+    afx = np.where(has_neighbors, (np.bincount(i, vx[j], count) / safe_neighbors - pvx) * Boid.ALIGNMENT, 0.0)
+    afy = np.where(has_neighbors, (np.bincount(i, vy[j], count) / safe_neighbors - pvy) * Boid.ALIGNMENT, 0.0)
+    cfx = np.where(has_neighbors, (np.bincount(i, x[j], count) / safe_neighbors - px) * Boid.COHESION, 0.0)
+    cfy = np.where(has_neighbors, (np.bincount(i, y[j], count) / safe_neighbors - py) * Boid.COHESION, 0.0)
+
+    # separation, over the boids inside the avoid radius
+    avoid = distance_squared < Boid.AVOID_RADIUS * Boid.AVOID_RADIUS
+    ai, aj = i[avoid], j[avoid]
+    sfx = -np.bincount(ai, x[aj] - x[ai], count) * Boid.SEPARATION
+    sfy = -np.bincount(ai, y[aj] - y[ai], count) * Boid.SEPARATION
+
+    # edge avoidance
+    scale = np.minimum(np.minimum(px - min_x, py - min_y), np.minimum(max_x - px, max_y - py))
+    outside = scale < 0.0
+    efx = np.where(outside, (max_x - min_x) / 2 - px, 0.0) * Boid.EDGE_AVOIDANCE
+    efy = np.where(outside, (max_y - min_y) / 2 - py, 0.0) * Boid.EDGE_AVOIDANCE
+
+    fx = efx + afx + cfx + sfx
+    fy = efy + afy + cfy + sfy
+
+    if target_to is not None:
+        mtfx, mtfy = _move_to_target(px, py, pvx, pvy, target_to[0] - px, target_to[1] - py)
+        fx = fx + mtfx
+        fy = fy + mtfy
+
+    if target_away is not None:
+        mafx, mafy = _move_to_target(px, py, pvx, pvy, px - target_away[0], py - target_away[1])
+        fx = fx + mafx
+        fy = fy + mafy
+
+    if obstacles is not None:
+        ofx, ofy = obstacles.avoidance_arrays(px, py)
+        fx = fx + ofx
+        fy = fy + ofy
+
+    # enforce turn limit
+    old_heading = np.arctan2(pvy, pvx)
+    new_vx = pvx + fx * dt
+    new_vy = pvy + fy * dt
+    speed = np.hypot(new_vx, new_vy)
+    new_heading = np.arctan2(new_vy, new_vx)
+
+    heading_diff = 180 - np.mod(180 - new_heading + old_heading, 360)
+    new_heading = np.where(heading_diff > Boid.MAX_TURN, old_heading + Boid.MAX_TURN, new_heading)
+
+    new_vx = speed * np.cos(new_heading)
+    new_vy = speed * np.sin(new_heading)
+
+    # enforce speed limit
+    speed = np.hypot(new_vx, new_vy)
+    with np.errstate(divide='ignore'):
+        speed_scale = np.where(speed > Boid.MAX_SPEED, Boid.MAX_SPEED / speed,
+                               np.where(speed < Boid.MIN_SPEED, Boid.MIN_SPEED / speed, 1.0))
+    new_vx *= speed_scale
+    new_vy *= speed_scale
+
+    # update position
+    return px + new_vx * dt, py + new_vy * dt, new_vx, new_vy
+
+
+class Flock:
+    """
+    A structure of arrays flock, x, y, vx, vy and id are kept in contiguous numpy arrays and the whole flock is
+    stepped in vectorized batches. Boid objects are only built on demand (see get_boid / to_boids).
+    """
+
+    def __init__(self, capacity: int = 64):
+        capacity = max(capacity, 1)
+        self._x = np.zeros(capacity, dtype=np.float64)
+        self._y = np.zeros(capacity, dtype=np.float64)
+        self._vx = np.zeros(capacity, dtype=np.float64)
+        self._vy = np.zeros(capacity, dtype=np.float64)
+        self._ids = np.zeros(capacity, dtype=np.uint32)
+        self.count = 0
+        self.id_to_index: dict[int, int] = {}  # boid id -> index in the arrays
+
+    @classmethod
+    def from_boids(cls, boids: list[Boid]) -> 'Flock':
+        flock = cls(len(boids))
+        flock.add_boids(boids)
+        return flock
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def x(self) -> np.ndarray:
+        return self._x[:self.count]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._y[:self.count]
+
+    @property
+    def vx(self) -> np.ndarray:
+        return self._vx[:self.count]
+
+    @property
+    def vy(self) -> np.ndarray:
+        return self._vy[:self.count]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self.count]
+
+    def _reserve(self, capacity: int):
+        if capacity <= len(self._x):
+            return
+
+        new_capacity = max(capacity, len(self._x) * 2)
+        for name in ('_x', '_y', '_vx', '_vy', '_ids'):
+            old = getattr(self, name)
+            new = np.zeros(new_capacity, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def index_of(self, boid_id: int) -> int | None:
+        return self.id_to_index.get(boid_id)
+
+    def add_boid(self, boid: Boid) -> bool:
+        """Add a boid to the flock, returns False if a boid with the same id is already in the flock."""
+        if boid.id in self.id_to_index:
+            return False
+
+        self._reserve(self.count + 1)
+        index = self.count
+        self._x[index] = boid.x
+        self._y[index] = boid.y
+        self._vx[index] = boid.vx
+        self._vy[index] = boid.vy
+        self._ids[index] = boid.id
+        self.id_to_index[boid.id] = index
+        self.count += 1
+        return True
+
+    def add_boids(self, boids: list[Boid]):
+        self._reserve(self.count + len(boids))
+        for boid in boids:
+            self.add_boid(boid)
+
+    def remove_boid(self, boid_id: int) -> bool:
+        """Remove a boid by id by moving the last boid into its slot, returns False if the id is not in the flock."""
+        index = self.id_to_index.pop(boid_id, None)
+        if index is None:
+            return False
+
+        last = self.count - 1
+        if index != last:
+            for array in (self._x, self._y, self._vx, self._vy, self._ids):
+                array[index] = array[last]
+            self.id_to_index[int(self._ids[index])] = index
+
+        self.count -= 1
+        return True
+
+    def get_boid(self, index: int) -> Boid:
+        return Boid(float(self._x[index]), float(self._y[index]), float(self._vx[index]), float(self._vy[index]), int(self._ids[index]))
+
+    def to_boids(self) -> list[Boid]:
+        return [Boid(x, y, vx, vy, id) for x, y, vx, vy, id in
+                zip(self.x.tolist(), self.y.tolist(), self.vx.tolist(), self.vy.tolist(), self.ids.tolist())]
+
+    def serialize(self, indices: np.ndarray | None = None, tick: int | None = None) -> bytes:
+        """
+        Serialize the flock in the serialize_boids format, packed in one pass without building Boid objects.
+        indices selects the boids to serialize, all of them by default. With a tick, the buffer starts with the tick field.
+        """
+        count = self.count if indices is None else len(indices)
+        start = 0 if tick is None else STATE_TICK_FIELD_SIZE
+        serialized_data = bytearray(start + BOIDS_COUNT_FIELD_SIZE + count * BOID_WIRE_DTYPE.itemsize)
+        if tick is not None:
+            serialized_data[:start] = pack_state_tick(tick)
+        serialized_data[start:start + BOIDS_COUNT_FIELD_SIZE] = count.to_bytes(BOIDS_COUNT_FIELD_SIZE, 'big')  # Number of boids
+
+        records = np.frombuffer(serialized_data, dtype=BOID_WIRE_DTYPE, offset=start + BOIDS_COUNT_FIELD_SIZE)
+        selection = slice(None) if indices is None else indices
+        records['x'] = self.x[selection]
+        records['y'] = self.y[selection]
+        records['vx'] = self.vx[selection]
+        records['vy'] = self.vy[selection]
+        records['id'] = self.ids[selection]
+
+        return bytes(serialized_data)
+
+    def step(self, dt: float, min_x: float, min_y: float, max_x: float, max_y: float,
+             target_to: tuple[float, float] | None, target_away: tuple[float, float] | None, ghosts: np.ndarray | None = None,
+             obstacles: Obstacles | None = None):
+        """
+        Step the whole flock, every boid reads the state of the flock at the start of the step.
+        ghosts are read only neighbors that are not stepped (BOID_WIRE_DTYPE records, e.g. the boids of another shard).
+        obstacles are the static obstacles the boids steer away from.
+        """
+        if ghosts is None or len(ghosts) == 0:
+            x, y, vx, vy = compute_step(self.x, self.y, self.vx, self.vy, self.count, dt, min_x, min_y, max_x, max_y, target_to, target_away, obstacles)
+        else:
+            x, y, vx, vy = compute_step(np.concatenate((self.x, ghosts['x'])), np.concatenate((self.y, ghosts['y'])),
+                                        np.concatenate((self.vx, ghosts['vx'])), np.concatenate((self.vy, ghosts['vy'])),
+                                        self.count, dt, min_x, min_y, max_x, max_y, target_to, target_away, obstacles)
+
+        self.x[:] = x
+        self.y[:] = y
+        self.vx[:] = vx
+        self.vy[:] = vy
@@ -0,0 +1,77 @@
+import math
+import numpy as np
+from boid import Boid
+from boid_helper import get_boids_arrays
+from spatial_grid import CellIndex
+
+
+class FlockIndex:
+    """
+    The client's index over the flock it receives, built once per state: the state arrays (shared with the renderer),
+    a cell index to pick the boid closest to a point within a radius, and the ids for ownership checks.
+    A pick only looks at the boids around the point, it does not depend on the size of the flock.
+    """
+
+    def __init__(self, boids: list[Boid], pick_squared_radius: float):
+        self.boids = boids
+        self.pick_squared_radius = pick_squared_radius
+        self.ids, self.x, self.y, self.vx, self.vy = get_boids_arrays(boids)
+        self.id_set = set(self.ids.tolist())
+
+        # a cell is the pick radius, a pick looks at the cells its radius square overlaps (at most 3 x 3)
+        self.pick_radius = math.sqrt(pick_squared_radius)
+        self.cells = CellIndex(self.x, self.y, max(self.pick_radius, 1.0))
+
+    @property
+    def arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """The (ids, x, y, vx, vy) arrays of the indexed boids."""
+        return self.ids, self.x, self.y, self.vx, self.vy
+
+    def __len__(self):
+        return len(self.boids)
+
+    def __contains__(self, boid_id: int) -> bool:
+        return boid_id in self.id_set
+
+    def get_closest_boid(self, point: tuple[float, float]) -> tuple[Boid | None, float]:
+        """The closest boid to a point and its squared distance, (None, inf) when no boid is within the pick radius."""
+        px, py = point
+        candidates = self.cells.query_rect(px - self.pick_radius, py - self.pick_radius, px + self.pick_radius, py + self.pick_radius)
+        if len(candidates) == 0:
+            return None, float('inf')
+
+        squared_distances = (self.x[candidates] - px) ** 2 + (self.y[candidates] - py) ** 2
+        closest = int(np.argmin(squared_distances))
+        squared_distance = float(squared_distances[closest])
+        if squared_distance > self.pick_squared_radius:
+            return None, float('inf')
+
+        return self.boids[int(candidates[closest])], squared_distance
+
+    def get_closest_moved(self, point: tuple[float, float], ids: np.ndarray, x: np.ndarray, y: np.ndarray,
+                          max_displacement: float) -> tuple[int | None, float]:
+        """
+        get_closest_boid for the indexed boids moved to (x, y), the id of the closest one and its squared distance.
+        ids are sorted (an interpolated flock) and no boid is further than max_displacement from its indexed
+        position, so the cells are queried with the pick radius widened by it and only those candidates are tested.
+        """
+        px, py = point
+        reach = self.pick_radius + max_displacement
+        candidates = self.cells.query_rect(px - reach, py - reach, px + reach, py + reach)
+        if len(candidates) == 0 or len(ids) == 0:
+            return None, float('inf')
+
+        # the candidates' moved positions, a boid not drawn (removed since) cannot be picked
+        positions = np.minimum(np.searchsorted(ids, self.ids[candidates]), len(ids) - 1)
+        positions = positions[ids[positions] == self.ids[candidates]]
+        if len(positions) == 0:
+            return None, float('inf')
+
+        squared_distances = (x[positions] - px) ** 2 + (y[positions] - py) ** 2
+        closest = int(np.argmin(squared_distances))
+        squared_distance = float(squared_distances[closest])
+        if squared_distance > self.pick_squared_radius:
+            return None, float('inf')
+
+        return int(ids[positions[closest]]), squared_distance
+
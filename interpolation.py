@@ -0,0 +1,148 @@
+import collections
+import numpy as np
+from boid import Boid
+
+INTERPOLATION_DELAY = 0.1  # seconds the client renders behind the newest snapshot, about two snapshots at 20 Hz
+MAX_EXTRAPOLATION = 0.25  # seconds a boid is moved along its velocity past the newest snapshot, then it waits
+SNAPSHOT_BUFFER_SIZE = 8  # the number of snapshots kept
+ARRIVAL_HISTORY_SIZE = 64  # the number of arrival times the clock estimate is fitted on
+MIN_CLOCK_SPAN = 0.25  # seconds of arrivals needed before the snapshots are interpolated, the newest is drawn until then
+CLOCK_SMOOTHING = 0.05  # how much of its error the render clock corrects every frame (0 - 1)
+CLOCK_SNAP = 1.0  # seconds, a render clock further than this from the estimate jumps to it
+
+
+class Snapshot:
+    """The boids of one server tick, as arrays sorted by id."""
+
+    def __init__(self, tick: int, boids: list[Boid]):
+        self.tick = tick
+        ids = np.fromiter((boid.id for boid in boids), dtype=np.uint32, count=len(boids))
+        values = np.array([(boid.x, boid.y, boid.vx, boid.vy) for boid in boids], dtype=np.float64).reshape(len(boids), 4)
+
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.values = values[order]  # x, y, vx, vy
+
+    def to_arrays(self, values: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """The (ids, x, y, vx, vy) arrays, like get_boids_arrays."""
+        values = self.values if values is None else values
+        return self.ids, values[:, 0], values[:, 1], values[:, 2], values[:, 3]
+
+
+class SnapshotInterpolator:
+    """
+    Keeps the last snapshots of the server's state and renders the flock at a point in server time slightly behind
+    the newest one, interpolating every boid (matched by id) between the two snapshots around it.
+    When the next snapshot is late the boids are extrapolated along their velocity for up to MAX_EXTRAPOLATION seconds.
+
+    The server tick of every snapshot is mapped to the client's clock: the tick rate and the offset between the two
+    clocks are estimated from the arrival times of the buffered snapshots and smoothed, so uneven arrivals do not make
+    the flock jump.
+    """
+
+    def __init__(self, delay: float = INTERPOLATION_DELAY, max_extrapolation: float = MAX_EXTRAPOLATION):
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        self.snapshots: collections.deque[Snapshot] = collections.deque(maxlen=SNAPSHOT_BUFFER_SIZE)
+        self.arrivals: collections.deque[tuple[int, float]] = collections.deque(maxlen=ARRIVAL_HISTORY_SIZE)  # (tick, time)
+
+        self.tick_rate: float | None = None  # server ticks per second
+        self.tick_offset: float | None = None  # server tick = time * tick_rate + tick_offset
+        self.render_tick: float | None = None  # the last rendered point in server time
+        self.render_time: float | None = None  # the time it was rendered at
+        self.lag = 0.0  # seconds between the last sample and the newest snapshot, in either direction
+
+    def push(self, tick: int, boids: list[Boid], arrival_time: float):
+        """Add the snapshot of a server tick, received at arrival_time (seconds, the clock used in sample)."""
+        if len(self.snapshots) > 0 and tick <= self.snapshots[-1].tick:
+            if tick < self.snapshots[0].tick:
+                self.reset()  # the server restarted
+            else:
+                return  # an old or repeated snapshot
+
+        self.snapshots.append(Snapshot(tick, boids))
+        self.arrivals.append((tick, arrival_time))
+
+        first_tick, first_time = self.arrivals[0]
+        if arrival_time - first_time < MIN_CLOCK_SPAN or tick == first_tick:
+            return
+
+        ticks = np.array([arrival_tick for arrival_tick, _ in self.arrivals], dtype=np.float64)
+        times = np.array([arrival for _, arrival in self.arrivals], dtype=np.float64) - first_time
+        self.tick_rate = float(np.polyfit(times, ticks, 1)[0])
+        if self.tick_rate <= 0:
+            self.tick_rate = None
+            return
+
+        # the snapshot that arrived the earliest for its tick had the least delay, it gives the best clock offset
+        self.tick_offset = float(np.max(ticks - times * self.tick_rate)) - first_time * self.tick_rate
+
+    def reset(self):
+        self.snapshots.clear()
+        self.arrivals.clear()
+        self.tick_rate = None
+        self.tick_offset = None
+        self.render_tick = None
+        self.render_time = None
+        self.lag = 0.0
+
+    def sample(self, now: float) -> list[Boid]:
+        """The boids at the render time of now."""
+        ids, x, y, vx, vy = self.sample_arrays(now)
+        return [Boid(x, y, vx, vy, id) for id, x, y, vx, vy in zip(ids.tolist(), x.tolist(), y.tolist(), vx.tolist(), vy.tolist())]
+
+    def sample_arrays(self, now: float) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The (ids, x, y, vx, vy) arrays of the boids at the render time of now, sorted by id, no Boid is built.
+        Sets lag: a boid is drawn at most its speed times lag away from where the newest snapshot has it.
+        """
+        self.lag = 0.0
+        if len(self.snapshots) == 0:
+            return Snapshot(0, []).to_arrays()
+
+        newest = self.snapshots[-1]
+        if self.tick_rate is None or len(self.snapshots) == 1:
+            return newest.to_arrays()
+
+        # the render clock runs at the tick rate and corrects a part of its error every frame, it does not jump
+        target_tick = (now - self.delay) * self.tick_rate + self.tick_offset
+        if self.render_tick is None or abs(target_tick - self.render_tick) > CLOCK_SNAP * self.tick_rate:
+            render_tick = target_tick
+        else:
+            predicted_tick = self.render_tick + (now - self.render_time) * self.tick_rate
+            render_tick = max(predicted_tick + (target_tick - predicted_tick) * CLOCK_SMOOTHING, self.render_tick)
+        self.render_tick = render_tick
+        self.render_time = now
+
+        render_tick = max(render_tick, self.snapshots[0].tick)
+
+        if render_tick >= newest.tick:
+            seconds = min(render_tick - newest.tick, self.max_extrapolation * self.tick_rate) / self.tick_rate
+            self.lag = seconds
+            values = newest.values.copy()
+            values[:, 0] += values[:, 2] * seconds
+            values[:, 1] += values[:, 3] * seconds
+            return newest.to_arrays(values)
+
+        # the two snapshots around the render time
+        older = self.snapshots[0]
+        newer = newest
+        for snapshot in self.snapshots:
+            if snapshot.tick <= render_tick:
+                older = snapshot
+            else:
+                newer = snapshot
+                break
+
+        t = (render_tick - older.tick) / (newer.tick - older.tick)
+        self.lag = (newest.tick - render_tick) / self.tick_rate
+
+        # boids in both snapshots are interpolated, boids only in the newer one (just added) are shown as they are,
+        # boids only in the older one were removed
+        positions = np.searchsorted(older.ids, newer.ids)
+        safe_positions = np.minimum(positions, max(len(older.ids) - 1, 0))
+        matched = (older.ids[safe_positions] == newer.ids) if len(older.ids) > 0 else np.zeros(len(newer.ids), dtype=bool)
+
+        values = newer.values.copy()
+        values[matched] = older.values[safe_positions[matched]] * (1 - t) + newer.values[matched] * t
+        return newer.to_arrays(values)
@@ -0,0 +1,200 @@
+import bisect
+import contextlib
+import http.server
+import threading
+import time
+from network_vars import PackageKind
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+METRICS_HOST = "127.0.0.1"  # the metrics are served locally only
+DEFAULT_METRICS_PORT = 9100
+
+# the upper bounds (seconds) of the duration histograms, a 60 Hz tick is 0.0167
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.0167, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+PACKAGE_HEADER_SIZE = 5  # the length and kind fields in front of every package, counted in the package bytes
+
+_NOT_SAMPLING = contextlib.nullcontext()  # what phase() returns while sampling is off, shared so it costs no allocation
+
+
+class Histogram:
+    """A cumulative histogram in the Prometheus layout: the count of observations at or below every bucket bound."""
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_text(self, name: str, labels: str = "") -> list[str]:
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum!r}' if labels else f'{name}_sum {self.sum!r}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}' if labels else f'{name}_count {self.count}')
+        return lines
+
+
+class _PhaseTimer:
+    def __init__(self, metrics: 'Metrics', phase: str):
+        self.metrics = metrics
+        self.phase = phase
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe_phase(self.phase, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """
+    The server's hot path instrumentation: a duration histogram per phase of the loop and of the tick,
+    and the packages sent and received by kind. Per client numbers are read from the clients when scraped.
+    Nothing is recorded while sampling is off (the default), phase() then returns a shared no-op context manager.
+    """
+
+    def __init__(self):
+        self.sampling = False
+        self.lock = threading.Lock()
+
+        self.tick_durations = Histogram()
+        self.phase_durations: dict[str, Histogram] = {}
+        self.packages: dict[tuple[str, PackageKind], list[int]] = {}  # (direction, kind) -> [packages, bytes]
+
+        # the package counts of the previous scrape, the packages per second are measured between two scrapes
+        self.last_scrape_time = time.perf_counter()
+        self.last_scrape_packages: dict[tuple[str, PackageKind], int] = {}
+
+    def phase(self, name: str):
+        """Time a block: with server_metrics.phase('step'): ..."""
+        return _PhaseTimer(self, name) if self.sampling else _NOT_SAMPLING
+
+    def observe_phase(self, name: str, seconds: float):
+        with self.lock:
+            histogram = self.phase_durations.get(name)
+            if histogram is None:
+                histogram = self.phase_durations[name] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_tick(self, seconds: float):
+        """Record the duration of one whole frame of the server loop."""
+        if self.sampling:
+            with self.lock:
+                self.tick_durations.observe(seconds)
+
+    def count_package(self, direction: str, kind: PackageKind, payload_size: int):
+        """Count a package sent ('out') or received ('in') by the server."""
+        if self.sampling:
+            with self.lock:
+                counts = self.packages.setdefault((direction, kind), [0, 0])
+                counts[0] += 1
+                counts[1] += payload_size + PACKAGE_HEADER_SIZE
+
+    def to_text(self, all_client_infos: list) -> str:
+        """All the metrics in the Prometheus text exposition format."""
+        now = time.perf_counter()
+        with self.lock:
+            lines = ["# HELP boids_tick_seconds The duration of a frame of the server loop.",
+                     "# TYPE boids_tick_seconds histogram"]
+            lines += self.tick_durations.to_text('boids_tick_seconds')
+
+            lines += ["# HELP boids_phase_seconds The duration of a phase of the server loop, phases can nest.",
+                      "# TYPE boids_phase_seconds histogram"]
+            for name, histogram in sorted(self.phase_durations.items()):
+                lines += histogram.to_text('boids_phase_seconds', f'phase="{name}"')
+
+            packages = sorted(self.packages.items(), key=lambda item: (item[0][0], item[0][1].name))
+            lines += ["# HELP boids_packages_total The packages sent (out) and received (in) by the server.",
+                      "# TYPE boids_packages_total counter"]
+            lines += [f'boids_packages_total{{direction="{direction}",kind="{kind.name}"}} {count}'
+                      for (direction, kind), (count, _) in packages]
+
+            lines += ["# HELP boids_package_bytes_total The bytes of the packages sent and received by the server, headers included.",
+                      "# TYPE boids_package_bytes_total counter"]
+            lines += [f'boids_package_bytes_total{{direction="{direction}",kind="{kind.name}"}} {size}'
+                      for (direction, kind), (_, size) in packages]
+
+            elapsed = now - self.last_scrape_time
+            lines += ["# HELP boids_packages_per_second The packages per second since the previous scrape.",
+                      "# TYPE boids_packages_per_second gauge"]
+            lines += [f'boids_packages_per_second{{direction="{direction}",kind="{kind.name}"}} '
+                      f'{(count - self.last_scrape_packages.get((direction, kind), 0)) / elapsed if elapsed > 0 else 0.0!r}'
+                      for (direction, kind), (count, _) in packages]
+
+            self.last_scrape_time = now
+            self.last_scrape_packages = {key: count for key, (count, _) in packages}
+
+        clients = [client_info for client_info in list(all_client_infos) if not client_info.should_terminate]
+        lines += ["# HELP boids_clients The connected clients.",
+                  "# TYPE boids_clients gauge",
+                  f"boids_clients {len(clients)}"]
+
+        lines += ["# HELP boids_client_queue_depth The packages waiting in a client's outgoing channel.",
+                  "# TYPE boids_client_queue_depth gauge"]
+        lines += [f'boids_client_queue_depth{{client="{client_info.client_id}"}} {client_info.outgoing_queue.qsize()}' for client_info in clients]
+
+        lines += ["# HELP boids_client_sent_bytes_total The bytes sent to a client, headers included.",
+                  "# TYPE boids_client_sent_bytes_total counter"]
+        lines += [f'boids_client_sent_bytes_total{{client="{client_info.client_id}"}} {client_info.bytes_sent}' for client_info in clients]
+
+        lines += ["# HELP boids_client_coalesced_states_total The states replaced by a newer one before they were sent to a client.",
+                  "# TYPE boids_client_coalesced_states_total counter"]
+        lines += [f'boids_client_coalesced_states_total{{client="{client_info.client_id}"}} {client_info.outgoing_queue.coalesced}'
+                  for client_info in clients]
+
+        return "\n".join(lines) + "\n"
+
+
+server_metrics = Metrics()  # the metrics of this process, sampled once the metrics server is started
+
+
+def start_metrics_server(all_client_infos: list, port: int = DEFAULT_METRICS_PORT, metrics: Metrics = server_metrics):
+    """
+    Serve the metrics on http://METRICS_HOST:port/metrics (the Prometheus text format) and turn sampling on.
+    Returns a function that stops it.
+    """
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            body = metrics.to_text(all_client_infos).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # a scrape every few seconds would flood the log
+
+    server = http.server.ThreadingHTTPServer((METRICS_HOST, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    metrics.sampling = True
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+
+    def stop():
+        metrics.sampling = False
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    return stop
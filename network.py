@@ -1,4 +1,6 @@
+import asyncio
 import enum
+import select
 import socket
 import traceback
 from logger_utils import create_formatted_logger  # Make sure this is the correct import path
@@ -10,6 +12,9 @@ logger = create_formatted_logger()
 NETWORK_PACKAGE_LENGTH_FIELD_SIZE = 32 // 8  # 32 bit / 8 bit per char
 NETWORK_PACKAGE_KIND_FIELD_SIZE = 1  # 1 byte == 0xFF
 
+# payloads larger than this are streamed to the socket in chunks of this size, instead of being copied behind the header
+NETWORK_SEND_CHUNK_SIZE = 64 * 1024
+
 
 class Package:
     def __init__(self, kind: PackageKind, payload: bytes | str):
@@ -30,7 +35,8 @@ class ProtocolStatusCodes(enum.IntEnum):
 
 
 def get_max_package_length():
-    return 10 ** NETWORK_PACKAGE_LENGTH_FIELD_SIZE - 1
+    # the largest value of the length field (which counts the header too)
+    return 2 ** (8 * NETWORK_PACKAGE_LENGTH_FIELD_SIZE) - 1
 
 
 class Network:
@@ -41,19 +47,42 @@ class Network:
         logger.info(f'{prefix}S LOG:{direction_str} {byte_data}')
 
     @staticmethod
-    def send_data(sock: socket.socket, package: Package, tid: int = -1, log: bool = True) -> tuple[ProtocolStatusCodes, str]:
+    def check_package(package: Package) -> tuple[ProtocolStatusCodes, str]:
+        """Check that a package fits the framing."""
         if len(package.payload) + NETWORK_PACKAGE_LENGTH_FIELD_SIZE + NETWORK_PACKAGE_KIND_FIELD_SIZE > get_max_package_length():
             return ProtocolStatusCodes.MESSAGE_TOO_LARGE, f"The message is too large, len={len(package.payload)}"
 
         if package.kind // 0xFF > NETWORK_PACKAGE_KIND_FIELD_SIZE:
             return ProtocolStatusCodes.MESSAGE_TOO_LARGE, f"The kind field is too large, len={package.kind // 0xFF}, value={package.kind}"
 
-        header = (len(package.payload) + NETWORK_PACKAGE_LENGTH_FIELD_SIZE + NETWORK_PACKAGE_KIND_FIELD_SIZE).to_bytes(NETWORK_PACKAGE_LENGTH_FIELD_SIZE)
+        return ProtocolStatusCodes.ALL_GOOD, ""
+
+    @staticmethod
+    def build_header(package: Package) -> bytes:
+        """Build the length and kind fields of a package."""
+        header = (len(package.payload) + NETWORK_PACKAGE_LENGTH_FIELD_SIZE + NETWORK_PACKAGE_KIND_FIELD_SIZE).to_bytes(NETWORK_PACKAGE_LENGTH_FIELD_SIZE, byteorder='big')
         header += package.kind.to_bytes(NETWORK_PACKAGE_KIND_FIELD_SIZE, byteorder='big')
-        bytearray_data = header + package.payload
+        return header
+
+    @staticmethod
+    def send_data(sock: socket.socket, package: Package, tid: int = -1, log: bool = True) -> tuple[ProtocolStatusCodes, str]:
+        status, message = Network.check_package(package)
+        if status != ProtocolStatusCodes.ALL_GOOD:
+            return status, message
+
+        header = Network.build_header(package)
 
         try:
-            sock.send(bytearray_data)
+            if len(package.payload) <= NETWORK_SEND_CHUNK_SIZE:
+                bytearray_data = header + package.payload
+                sock.sendall(bytearray_data)
+            else:
+                # stream a large payload without copying it
+                bytearray_data = header
+                sock.sendall(header)
+                payload_view = memoryview(package.payload)
+                for offset in range(0, len(payload_view), NETWORK_SEND_CHUNK_SIZE):
+                    sock.sendall(payload_view[offset:offset + NETWORK_SEND_CHUNK_SIZE])
         except socket.error as err:
             logger.error(f'Socket Error send_data: {err}')
             return ProtocolStatusCodes.SOCKET_CONNECTION_ERROR, str(err)
@@ -66,12 +95,75 @@ class Network:
 
         return ProtocolStatusCodes.ALL_GOOD, ""
 
+    @staticmethod
+    def send_batch(sock: socket.socket, packages: list[Package], tid: int = -1, log: bool = True) -> tuple[ProtocolStatusCodes, str]:
+        """
+        Send several packages with as few sendall calls as possible, small packages are joined into one buffer.
+        Packages that do not fit the framing are logged and skipped.
+        """
+        pending = []
+
+        try:
+            for package in packages:
+                status, message = Network.check_package(package)
+                if status != ProtocolStatusCodes.ALL_GOOD:
+                    logger.error(f"{tid} Dropped a {package.kind.name} package: {message}")
+                    continue
+
+                header = Network.build_header(package)
+                pending.append(header)
+
+                if len(package.payload) <= NETWORK_SEND_CHUNK_SIZE:
+                    pending.append(package.payload)
+                else:
+                    # stream a large payload without copying it
+                    sock.sendall(b"".join(pending))
+                    pending.clear()
+                    payload_view = memoryview(package.payload)
+                    for offset in range(0, len(payload_view), NETWORK_SEND_CHUNK_SIZE):
+                        sock.sendall(payload_view[offset:offset + NETWORK_SEND_CHUNK_SIZE])
+
+                if log:
+                    Network.log_transmission('sent', header + package.payload, tid)
+
+            if len(pending) > 0:
+                sock.sendall(b"".join(pending))
+        except socket.error as err:
+            logger.error(f'Socket Error send_batch: {err}')
+            return ProtocolStatusCodes.SOCKET_CONNECTION_ERROR, str(err)
+        except Exception as err:
+            logger.error(f'General Error send_batch: {err}\n{traceback.format_exc()}')
+            return ProtocolStatusCodes.GENERAL_ERROR, str(err)
+
+        return ProtocolStatusCodes.ALL_GOOD, ""
+
+    @staticmethod
+    def receive_header_field(sock: socket.socket, size: int) -> bytes:
+        """Receive a whole header field, recv may return only a part of it when large packages stream in."""
+        field = sock.recv(size)
+        while 0 < len(field) < size:
+            part = sock.recv(size - len(field))
+            if part == b"":
+                break
+            field += part
+        return field
+
+    @staticmethod
+    def wait_for_data(sock: socket.socket, timeout: float | None) -> bool:
+        """
+        Wait until a socket has data to read (or is closed), False when timeout seconds pass first.
+        A deadline is kept by waiting here and then reading the whole package with a blocking receive_data: a socket
+        timeout in the middle of a package would drop the bytes already read and desync the stream.
+        """
+        readable, _, _ = select.select([sock], [], [], timeout)
+        return len(readable) > 0
+
     @staticmethod
     def receive_data(sock: socket.socket, tid: int = -1, log: bool = True) -> tuple[ProtocolStatusCodes, Package] | None:
         def receive_data_main() -> tuple[ProtocolStatusCodes, Package, bytes] | None:
             try:
                 all_bytes = b""
-                length_field = sock.recv(NETWORK_PACKAGE_LENGTH_FIELD_SIZE)
+                length_field = Network.receive_header_field(sock, NETWORK_PACKAGE_LENGTH_FIELD_SIZE)
                 all_bytes += length_field
 
                 if length_field == b"":
@@ -85,7 +177,7 @@ class Network:
                 if length_field < 0:
                     return ProtocolStatusCodes.NONE_INTEGER_LENGTH_FIELD, Package(PackageKind(0), f"length_field={length_field}".encode()), all_bytes
 
-                kind_field = sock.recv(NETWORK_PACKAGE_KIND_FIELD_SIZE)
+                kind_field = Network.receive_header_field(sock, NETWORK_PACKAGE_KIND_FIELD_SIZE)
                 all_bytes += kind_field
                 try:
                     kind_field = int.from_bytes(kind_field, byteorder='big')
@@ -93,23 +185,24 @@ class Network:
                     return ProtocolStatusCodes.NONE_INTEGER_KIND_FIELD, Package(PackageKind(0), str(err).encode()), all_bytes
 
                 payload_length = length_field - NETWORK_PACKAGE_LENGTH_FIELD_SIZE - NETWORK_PACKAGE_KIND_FIELD_SIZE
-                received_data = b""
 
-                if payload_length > 0:
-                    received_data = sock.recv(payload_length)
-                    all_bytes += received_data
+                # receive straight into one preallocated buffer, large payloads arrive in many recv calls
+                received_data = bytearray(max(payload_length, 0))
+                received_view = memoryview(received_data)
+                received_length = 0
 
-                    if received_data == b"":
-                        return ProtocolStatusCodes.SOCKET_DISCONNECTED, Package(PackageKind(kind_field), b""), all_bytes
+                while received_length < payload_length:
+                    new_length = sock.recv_into(received_view[received_length:], payload_length - received_length)
 
-                while len(received_data) != payload_length:
-                    new_data = sock.recv(payload_length - len(received_data))
-                    all_bytes += new_data
+                    if new_length == 0:
+                        return ProtocolStatusCodes.SOCKET_DISCONNECTED, Package(PackageKind(kind_field), bytes(received_view[:received_length])), all_bytes
 
-                    if new_data == b"":
-                        return ProtocolStatusCodes.SOCKET_DISCONNECTED, Package(PackageKind(kind_field), received_data), all_bytes
+                    received_length += new_length
 
-                    received_data += new_data
+                received_view.release()
+                received_data = bytes(received_data)
+                if log:
+                    all_bytes += received_data
 
                 return ProtocolStatusCodes.ALL_GOOD, Package(PackageKind(kind_field), received_data), all_bytes
 
@@ -130,3 +223,31 @@ class Network:
                 Network.log_transmission("recv", raw_bytes, tid)
 
         return result[:-1] if result is not None else None
+
+    @staticmethod
+    async def receive_data_async(reader: asyncio.StreamReader, tid: int = -1, log: bool = True) -> tuple[ProtocolStatusCodes, Package]:
+        """The asyncio version of receive_data, reads one package from a stream."""
+        try:
+            length_field = await reader.readexactly(NETWORK_PACKAGE_LENGTH_FIELD_SIZE)
+            length_field = int.from_bytes(length_field, byteorder='big')
+
+            if length_field < NETWORK_PACKAGE_LENGTH_FIELD_SIZE + NETWORK_PACKAGE_KIND_FIELD_SIZE:
+                return ProtocolStatusCodes.INCOMPATIBLE_LENGTH_FIELD, Package(PackageKind(0), f"length_field={length_field}".encode())
+
+            kind_field = int.from_bytes(await reader.readexactly(NETWORK_PACKAGE_KIND_FIELD_SIZE), byteorder='big')
+            payload = await reader.readexactly(length_field - NETWORK_PACKAGE_LENGTH_FIELD_SIZE - NETWORK_PACKAGE_KIND_FIELD_SIZE)
+        except asyncio.IncompleteReadError:
+            return ProtocolStatusCodes.SOCKET_DISCONNECTED, Package(PackageKind(0), b"")
+        except ConnectionError as err:
+            logger.error(f'Socket Error receive_data_async: {err}')
+            return ProtocolStatusCodes.SOCKET_CONNECTION_ERROR, Package(PackageKind(0), str(err).encode())
+
+        try:
+            package = Package(PackageKind(kind_field), payload)
+        except ValueError as err:
+            return ProtocolStatusCodes.NONE_INTEGER_KIND_FIELD, Package(PackageKind(0), str(err).encode())
+
+        if payload != b"" and log:
+            Network.log_transmission("recv", payload, tid)
+
+        return ProtocolStatusCodes.ALL_GOOD, package
@@ -3,11 +3,13 @@ import enum
 SERVER_IP = "127.0.0.1"
 SERVER_SETUP_PORT = 5000
 
-MAX_PACKET_SIZE = 0xFFFF  # max packet size in bytes (the maximum size of allowed transferable data, AKA ALL DATA)
+MAX_PACKET_SIZE = 0xFFFFFFFF  # max packet size in bytes (the maximum size of allowed transferable data, AKA ALL DATA)
 # the size field the responsible for representing the amount of application data and packet type data in the packet
-PACKET_SIZE_FIELD_LENGTH = 2  # the length of the field size in bytes, 2 bytes <= 0xFFFF
+PACKET_SIZE_FIELD_LENGTH = 4  # the length of the field size in bytes, 4 bytes <= 0xFFFFFFFF
 PACKET_TYPE_FIELD_LENGTH = 1  # the length of the field type in bytes, 1 byte == 0xFF
 
+HANDSHAKE_TIMEOUT = 2.0  # seconds the server waits for the client's ESTABLISH_CONNECTION request
+
 
 class PackageKind(enum.IntEnum):
     ERROR = 0x00
@@ -17,3 +19,21 @@ class PackageKind(enum.IntEnum):
     BOIDS_STATE = 0x02
     ADD_BOID = 0x03
     REMOVE_BOID = 0x04
+    SET_TARGET = 0x05
+    BOIDS_DELTA = 0x06
+    RESYNC_REQUEST = 0x07
+    BOIDS_STATE_COMPACT = 0x08
+    BOIDS_COMMANDS = 0x09  # many ADD_BOID / REMOVE_BOID commands in one package (see boid_helper.serialize_commands)
+    SET_VIEWPORT = 0x0A  # the area of the world a client shows, it gets only the boids around it (see boid_helper.serialize_viewport)
+    SHARD_EXCHANGE = 0x0B  # the boids handed off to and the border ghosts of a neighbor shard, once per tick (see shard.py)
+    OBSTACLES = 0x0C  # the static obstacles of the world, sent once to every client (see obstacles.serialize_obstacles)
+
+
+class SessionFlags(enum.IntFlag):
+    """
+    Options negotiated in the ESTABLISH_CONNECTION handshake: the client sends the flags it asks for (1 byte),
+    the server answers with the ports followed by the flags it granted (1 byte).
+    """
+    NONE = 0x00
+    COMPACT_STATE = 0x01  # the state is sent as BOIDS_STATE_COMPACT (see compact_codec.py)
+    SINGLE_CONNECTION = 0x02  # both directions run over the setup connection, no ports are opened (they are sent as 0)
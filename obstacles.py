@@ -0,0 +1,180 @@
+import json
+import math
+import numpy as np
+from boid import Boid
+
+# every obstacle is a capsule: the points within radius of the segment a-b, a wall is a capsule of radius 0 and a
+# circle is a capsule whose two ends are its center
+OBSTACLE_DTYPE = np.dtype([('ax', '>f4'), ('ay', '>f4'), ('bx', '>f4'), ('by', '>f4'), ('radius', '>f4')])
+OBSTACLES_COUNT_FIELD_SIZE = 4  # the number of obstacles in front of an OBSTACLES payload (32 bit)
+
+OBSTACLE_CELL_SIZE = 2 * Boid.AVOID_RADIUS  # the cell size of the broadphase grid
+
+
+class Obstacles:
+    """
+    The static obstacles of a world (line segments and circles) in a broadphase grid.
+    Every cell lists the obstacles a boid inside it can be within Boid.AVOID_RADIUS of, so a boid tests only the
+    obstacles of its own cell, however many there are in the world. The grid is built once, obstacles never move.
+    """
+
+    def __init__(self, segments: list[tuple[float, float, float, float]] = (), circles: list[tuple[float, float, float]] = (),
+                 cell_size: float = OBSTACLE_CELL_SIZE):
+        self.segments = [tuple(map(float, segment)) for segment in segments]  # (x1, y1, x2, y2)
+        self.circles = [tuple(map(float, circle)) for circle in circles]  # (x, y, radius)
+        self.cell_size = cell_size
+
+        capsules = [(x1, y1, x2, y2, 0.0) for x1, y1, x2, y2 in self.segments] + [(x, y, x, y, radius) for x, y, radius in self.circles]
+        self.capsules = capsules  # (ax, ay, bx, by, radius), the boids engine reads them as floats
+        values = np.array(capsules, dtype=np.float64).reshape(len(capsules), 5)
+        self.ax, self.ay, self.bx, self.by, self.radius = (values[:, column].copy() for column in range(5))
+
+        self.cells: dict[tuple[int, int], list[int]] = {}  # (cell x, cell y) -> the obstacles near the cell
+        for index in range(len(capsules)):
+            for cell in self._cells_near(index):
+                self.cells.setdefault(cell, []).append(index)
+
+        # the same cells as sorted keys over the cells' bounding box, with their obstacles back to back (for arrays of points)
+        if len(self.cells) > 0:
+            self.min_cx = min(cx for cx, _ in self.cells)
+            self.min_cy = min(cy for _, cy in self.cells)
+            self.max_cx = max(cx for cx, _ in self.cells)
+            self.max_cy = max(cy for _, cy in self.cells)
+        else:
+            self.min_cx = self.min_cy = 0
+            self.max_cx = self.max_cy = -1
+        self.height = self.max_cy - self.min_cy + 1
+
+        cells = sorted(self.cells.items(), key=lambda item: self._key(*item[0]))
+        self.cell_keys = np.array([self._key(*cell) for cell, _ in cells], dtype=np.int64)
+        self.cell_starts = np.cumsum([0] + [len(indices) for _, indices in cells]).astype(np.int64)
+        self.cell_obstacles = np.array([index for _, indices in cells for index in indices], dtype=np.intp)
+
+    def __len__(self):
+        return len(self.ax)
+
+    def _key(self, cx: int, cy: int) -> int:
+        return (cx - self.min_cx) * self.height + (cy - self.min_cy)
+
+    def _cells_near(self, index: int) -> list[tuple[int, int]]:
+        """The cells that have a point within AVOID_RADIUS of an obstacle (a few extra near the corners)."""
+        reach = self.radius[index] + Boid.AVOID_RADIUS
+        ax, ay, bx, by = self.ax[index], self.ay[index], self.bx[index], self.by[index]
+
+        cx = np.arange(math.floor((min(ax, bx) - reach) / self.cell_size), math.floor((max(ax, bx) + reach) / self.cell_size) + 1)
+        cy = np.arange(math.floor((min(ay, by) - reach) / self.cell_size), math.floor((max(ay, by) + reach) / self.cell_size) + 1)
+        cx, cy = (grid.ravel() for grid in np.meshgrid(cx, cy, indexing='ij'))
+
+        # a cell is near when its center is within reach plus half its diagonal
+        center_x = (cx + 0.5) * self.cell_size
+        center_y = (cy + 0.5) * self.cell_size
+        _, _, distance = closest_points(center_x, center_y, ax, ay, bx, by)
+        near = distance <= reach + self.cell_size * math.sqrt(0.5)
+        return list(zip(cx[near].tolist(), cy[near].tolist()))
+
+    def query(self, x: float, y: float) -> list[int]:
+        """The obstacles a point can be within AVOID_RADIUS of (a superset), from its cell only."""
+        return self.cells.get((math.floor(x / self.cell_size), math.floor(y / self.cell_size)), [])
+
+    def query_pairs(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """query for arrays of points, returns the (point, obstacle) pairs as two index arrays."""
+        if len(self.cell_keys) == 0 or len(x) == 0:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty
+
+        cx = np.floor(x / self.cell_size).astype(np.int64)
+        cy = np.floor(y / self.cell_size).astype(np.int64)
+        inside = (cx >= self.min_cx) & (cx <= self.max_cx) & (cy >= self.min_cy) & (cy <= self.max_cy)
+        keys = np.where(inside, (cx - self.min_cx) * self.height + (cy - self.min_cy), -1)
+
+        positions = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        found = self.cell_keys[positions] == keys
+        start = self.cell_starts[positions]
+        lengths = np.where(found, self.cell_starts[positions + 1] - start, 0)
+
+        # expand every [start, end) range into the obstacles it covers
+        total = int(lengths.sum())
+        offsets = np.repeat(start - (np.cumsum(lengths) - lengths), lengths)
+        return np.repeat(np.arange(len(x)), lengths), self.cell_obstacles[np.arange(total) + offsets]
+
+    def avoidance(self, x: float, y: float) -> tuple[float, float]:
+        """The force that steers a boid at (x, y) away from the obstacles within AVOID_RADIUS of it."""
+        steering_x = 0.0
+        steering_y = 0.0
+
+        for index in self.query(x, y):
+            ax, ay, bx, by, radius = self.capsules[index]
+            abx, aby = bx - ax, by - ay
+            length_squared = abx * abx + aby * aby
+            t = 0.0 if length_squared == 0 else min(max(((x - ax) * abx + (y - ay) * aby) / length_squared, 0.0), 1.0)
+            away_x = x - (ax + abx * t)
+            away_y = y - (ay + aby * t)
+            distance = math.hypot(away_x, away_y)
+
+            gap = distance - radius  # negative inside a circle
+            if gap < Boid.AVOID_RADIUS and distance > 0:
+                strength = (Boid.AVOID_RADIUS - gap) / distance
+                steering_x += away_x * strength
+                steering_y += away_y * strength
+
+        return steering_x * Boid.OBSTACLE_AVOIDANCE, steering_y * Boid.OBSTACLE_AVOIDANCE
+
+    def avoidance_arrays(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """avoidance for arrays of boids, in one vectorized pass over the (boid, nearby obstacle) pairs."""
+        i, o = self.query_pairs(x, y)
+        if len(i) == 0:
+            return np.zeros(len(x)), np.zeros(len(x))
+
+        px, py = x[i], y[i]
+        closest_x, closest_y, distance = closest_points(px, py, self.ax[o], self.ay[o], self.bx[o], self.by[o])
+
+        gap = distance - self.radius[o]
+        near = (gap < Boid.AVOID_RADIUS) & (distance > 0)
+        strength = np.where(near, (Boid.AVOID_RADIUS - gap) / np.where(near, distance, 1.0), 0.0)
+
+        fx = np.bincount(i, (px - closest_x) * strength, len(x)) * Boid.OBSTACLE_AVOIDANCE
+        fy = np.bincount(i, (py - closest_y) * strength, len(x)) * Boid.OBSTACLE_AVOIDANCE
+        return fx, fy
+
+
+def closest_points(x, y, ax, ay, bx, by) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The closest points of the segments a-b to the points (x, y), and their distances (all arguments broadcast)."""
+    abx, aby = bx - ax, by - ay
+    length_squared = abx * abx + aby * aby
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length_squared > 0, ((x - ax) * abx + (y - ay) * aby) / length_squared, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    closest_x = ax + abx * t
+    closest_y = ay + aby * t
+    return closest_x, closest_y, np.hypot(x - closest_x, y - closest_y)
+
+
+def load_obstacles(path: str) -> Obstacles:
+    """
+    Load a map of obstacles, a JSON object:
+    {"segments": [[x1, y1, x2, y2], ...], "circles": [[x, y, radius], ...]}
+    """
+    with open(path) as file:
+        data = json.load(file)
+    return Obstacles(data.get('segments', []), data.get('circles', []))
+
+
+def serialize_obstacles(obstacles: Obstacles) -> bytes:
+    """The OBSTACLES payload: the number of obstacles, then an OBSTACLE_DTYPE record per obstacle."""
+    records = np.empty(len(obstacles), dtype=OBSTACLE_DTYPE)
+    records['ax'] = obstacles.ax
+    records['ay'] = obstacles.ay
+    records['bx'] = obstacles.bx
+    records['by'] = obstacles.by
+    records['radius'] = obstacles.radius
+    return len(obstacles).to_bytes(OBSTACLES_COUNT_FIELD_SIZE, 'big') + records.tobytes()
+
+
+def deserialize_obstacles(data: bytes) -> Obstacles:
+    count = int.from_bytes(data[:OBSTACLES_COUNT_FIELD_SIZE], 'big')
+    records = np.frombuffer(data, dtype=OBSTACLE_DTYPE, count=count, offset=OBSTACLES_COUNT_FIELD_SIZE)
+
+    circle = (records['ax'] == records['bx']) & (records['ay'] == records['by']) & (records['radius'] > 0)
+    segments = [(ax, ay, bx, by) for ax, ay, bx, by, _ in records[~circle].tolist()]
+    circles = [(ax, ay, radius) for ax, ay, _, _, radius in records[circle].tolist()]
+    return Obstacles(segments, circles)
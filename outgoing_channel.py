@@ -0,0 +1,111 @@
+import collections
+import threading
+from typing import Callable
+from network import Package, PackageKind
+
+# the packages that carry the world state, a newer one makes an older one worthless
+STATE_PACKAGE_KINDS = (PackageKind.BOIDS_STATE, PackageKind.BOIDS_STATE_COMPACT, PackageKind.BOIDS_DELTA)
+
+
+class OutgoingChannel:
+    """
+    The outgoing packages of one client.
+    Control packages are queued and all delivered in order, but only the newest state package is kept: a state that
+    was not sent yet is replaced (coalesced) by the next one. A slow client costs O(1) memory and always gets the
+    freshest frame.
+    It has the queue.Queue methods the send loops use (put, get, empty, qsize, task_done), close() wakes a blocked get
+    for good.
+    """
+
+    def __init__(self, on_coalesce: Callable[[Package, Package], Package | None] | None = None, on_put: Callable[[], None] | None = None):
+        self.control: collections.deque[Package] = collections.deque()
+        self.state: Package | None = None
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # called with the package that is replaced and the new one, returns the state to keep (None to keep none), it is
+        # called under the channel's lock, so the sender never takes a state the callback decides against
+        self.on_coalesce = on_coalesce
+        self.on_put = on_put  # called after every put, used to wake an event loop
+
+        self.coalesced = 0  # the number of state packages replaced before they were sent
+        self.dropped = 0  # the number of packages put after the channel was closed
+        self.sent_states = 0  # the number of state packages taken out of the channel
+        self.sent_controls = 0  # the number of control packages taken out of the channel
+
+    def put(self, package: Package):
+        with self.condition:
+            if self.closed:
+                self.dropped += 1
+                return
+
+            if package.kind in STATE_PACKAGE_KINDS:
+                replaced = self.state
+                if replaced is not None:
+                    self.coalesced += 1
+                    if self.on_coalesce is not None:
+                        package = self.on_coalesce(replaced, package)
+                        if package is None:
+                            self.coalesced += 1  # the new state is worthless without the replaced one
+                self.state = package
+            else:
+                self.control.append(package)
+            self.condition.notify()
+
+        if self.on_put is not None:
+            self.on_put()
+
+    def _take(self) -> Package:
+        # control packages first, they are small and may change how the state is read
+        if len(self.control) > 0:
+            self.sent_controls += 1
+            return self.control.popleft()
+
+        package = self.state
+        self.state = None
+        self.sent_states += 1
+        return package
+
+    def get(self, block: bool = True, timeout: float | None = None) -> Package | None:
+        """
+        Take the next package, blocks until there is one or the channel is closed.
+        Returns None if there is none after the timeout (or right away when not blocking), or when the channel is closed
+        and empty.
+        """
+        with self.condition:
+            if block:
+                self.condition.wait_for(lambda: not self._empty() or self.closed, timeout)
+            if self._empty():
+                return None
+            return self._take()
+
+    def take_all(self) -> list[Package]:
+        """Take every waiting package, in sending order."""
+        with self.condition:
+            packages = []
+            while not self._empty():
+                packages.append(self._take())
+            return packages
+
+    def close(self):
+        """Stop accepting packages and wake the sender, the packages already waiting can still be taken."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        if self.on_put is not None:
+            self.on_put()
+
+    def _empty(self) -> bool:
+        return len(self.control) == 0 and self.state is None
+
+    def empty(self) -> bool:
+        with self.condition:
+            return self._empty()
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.control) + (self.state is not None)
+
+    def task_done(self):
+        pass
@@ -0,0 +1,147 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from boid import Boid
+from flock import Flock, compute_step
+from obstacles import Obstacles
+from metrics import server_metrics
+
+# the shared state is float64[2][4][capacity], [front, back] x [x, y, vx, vy]
+FRONT = 0
+BACK = 1
+
+__worker_memory: shared_memory.SharedMemory | None = None  # the shared memory block, attached once per worker
+__worker_state: np.ndarray | None = None  # a view of the shared state inside the worker
+__worker_obstacles: Obstacles | None = None  # the static obstacles, sent once per worker
+
+
+def _state_view(memory: shared_memory.SharedMemory, capacity: int) -> np.ndarray:
+    return np.ndarray((2, 4, capacity), dtype=np.float64, buffer=memory.buf)
+
+
+def _worker_init(memory_name: str, capacity: int, obstacles: Obstacles | None):
+    global __worker_memory, __worker_state, __worker_obstacles
+    __worker_memory = shared_memory.SharedMemory(name=memory_name)
+    __worker_state = _state_view(__worker_memory, capacity)
+    __worker_obstacles = obstacles
+
+    # a forked worker inherits the parent's sampling, but nobody scrapes its metrics: the parent times the tiles
+    server_metrics.sampling = False
+
+
+def _step_tile(args) -> int:
+    """
+    Step the boids owned by one tile (a vertical strip of the world).
+    The boids of the neighbor tiles that are inside the perception radius of the strip are read as ghosts (the halo),
+    the results are written only for the owned boids, into the back buffer.
+    """
+    tile_min_x, tile_max_x, last_tile, count, dt, min_x, min_y, max_x, max_y, target_to, target_away = args
+
+    front = __worker_state[FRONT, :, :count]
+    back = __worker_state[BACK]
+    x = front[0]
+
+    if last_tile:
+        owned = (x >= tile_min_x) & (x <= tile_max_x)
+    else:
+        owned = (x >= tile_min_x) & (x < tile_max_x)
+
+    halo = ~owned & (x >= tile_min_x - Boid.PERCEPTION_RADIUS) & (x <= tile_max_x + Boid.PERCEPTION_RADIUS)
+
+    owned_indices = np.nonzero(owned)[0]
+    if len(owned_indices) == 0:
+        return 0
+
+    indices = np.concatenate((owned_indices, np.nonzero(halo)[0]))
+    new_x, new_y, new_vx, new_vy = compute_step(front[0, indices], front[1, indices], front[2, indices], front[3, indices], len(owned_indices),
+                                                dt, min_x, min_y, max_x, max_y, target_to, target_away, __worker_obstacles)
+
+    back[0, owned_indices] = new_x
+    back[1, owned_indices] = new_y
+    back[2, owned_indices] = new_vx
+    back[3, owned_indices] = new_vy
+
+    return len(owned_indices)
+
+
+class ParallelFlockStepper:
+    """
+    Steps a Flock on a multiprocessing pool.
+    The world is split into vertical tiles, one task per tile. The positions and velocities live in shared memory
+    (front / back buffers), so only the tile bounds and the step parameters are pickled each frame.
+    Each tile reads its halo (the boids next to its borders) from the shared front buffer, the result is the same
+    as the single process double buffered step. The static obstacles are sent to the workers once, when they start.
+    The workers do not sample the server metrics, the tiles of a step are timed in the parent as the 'tiles' phase.
+    """
+
+    def __init__(self, processes: int | None = None, tiles: int | None = None, capacity: int = 1024, obstacles: Obstacles | None = None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.tiles = tiles or self.processes * 2  # a few more tiles than workers, to balance uneven tiles
+        self.capacity = 0
+        self.memory: shared_memory.SharedMemory | None = None
+        self.state: np.ndarray | None = None
+        self.pool = None
+        self.obstacles = obstacles
+
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        self.close()
+
+        self.capacity = capacity
+        self.memory = shared_memory.SharedMemory(create=True, size=2 * 4 * capacity * np.dtype(np.float64).itemsize)
+        self.state = _state_view(self.memory, capacity)
+        self.pool = multiprocessing.Pool(self.processes, initializer=_worker_init, initargs=(self.memory.name, capacity, self.obstacles))
+
+    def step(self, flock: Flock, dt: float, min_x: float, min_y: float, max_x: float, max_y: float,
+             target_to: tuple[float, float] | None, target_away: tuple[float, float] | None):
+        count = flock.count
+        if count == 0:
+            return
+
+        if count > self.capacity:
+            self._allocate(max(count, self.capacity * 2))
+
+        front = self.state[FRONT]
+        front[0, :count] = flock.x
+        front[1, :count] = flock.y
+        front[2, :count] = flock.vx
+        front[3, :count] = flock.vy
+
+        low = float(flock.x.min())
+        high = float(flock.x.max())
+        width = (high - low) / self.tiles
+
+        tasks = []
+        for tile in range(self.tiles):
+            tile_min_x = low + tile * width
+            tile_max_x = high if tile == self.tiles - 1 else low + (tile + 1) * width
+            tasks.append((tile_min_x, tile_max_x, tile == self.tiles - 1, count, dt, min_x, min_y, max_x, max_y, target_to, target_away))
+
+        # the neighbors and forces phases run in the workers, the parent times them together
+        with server_metrics.phase('tiles'):
+            self.pool.map(_step_tile, tasks)
+
+        back = self.state[BACK]
+        flock.x[:] = back[0, :count]
+        flock.y[:] = back[1, :count]
+        flock.vx[:] = back[2, :count]
+        flock.vy[:] = back[3, :count]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+        if self.memory is not None:
+            self.state = None
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
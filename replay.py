@@ -0,0 +1,206 @@
+import mmap
+import struct
+import numpy as np
+from boid import Boid
+from boid_helper import add_state_tick, serialize_commands
+from delta_codec import DeltaEncoder
+from network import Package, PackageKind
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+# A replay file is append-only, all the fields are big endian:
+#   header: magic (8 bytes), version (u16), keyframe interval (u32), tick rate (f32), world bounds (4 x f32)
+#   records: kind (u8), tick (u32), payload length (u32), payload
+#     REPLAY_KEYFRAME: a BOIDS_DELTA keyframe payload, the whole flock
+#     REPLAY_DELTA: a BOIDS_DELTA payload, the changes since the previous tick's record
+#     REPLAY_COMMANDS: a BOIDS_COMMANDS payload, the boids added and removed before the tick was stepped
+#     REPLAY_INDEX: the (tick (u32), offset (u64)) of every keyframe, written when the recording is closed, the offset
+#                   is the first record of the keyframe's tick (its commands come before its state)
+#   footer: the offset of the index record (u64), then REPLAY_INDEX_MAGIC
+# A file without the footer (the server did not close it) is still readable, its keyframes are found by scanning
+# the record headers.
+REPLAY_MAGIC = b'BOIDRPLY'
+REPLAY_INDEX_MAGIC = b'BOIDRIDX'
+REPLAY_VERSION = 1
+
+REPLAY_HEADER_FORMAT = '!8sHIfffff'
+REPLAY_HEADER_SIZE = struct.calcsize(REPLAY_HEADER_FORMAT)
+RECORD_HEADER_FORMAT = '!BII'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+INDEX_ENTRY_DTYPE = np.dtype([('tick', '>u4'), ('offset', '>u8')])
+FOOTER_FORMAT = '!Q8s'
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+
+REPLAY_KEYFRAME = 1
+REPLAY_DELTA = 2
+REPLAY_COMMANDS = 3
+REPLAY_INDEX = 4
+
+REPLAY_KEYFRAME_INTERVAL = 300  # ticks between two keyframes, a seek decodes at most this many deltas
+REPLAY_WRITE_BUFFER_SIZE = 1024 * 1024  # bytes buffered before they are written to the file
+
+
+class ReplayRecorder:
+    """
+    Records a session: the flock of every tick as the BOIDS_DELTA stream (a keyframe every keyframe_interval ticks)
+    and every applied add/remove command. The states are the delta encoder's baseline, the float32 values the clients
+    would receive, changes smaller than its quantization are not recorded.
+    """
+
+    def __init__(self, path: str, bounds: tuple[float, float, float, float], tick_rate: float,
+                 keyframe_interval: int = REPLAY_KEYFRAME_INTERVAL):
+        self.path = path
+        self.file = open(path, 'wb', buffering=REPLAY_WRITE_BUFFER_SIZE)
+        self.file.write(struct.pack(REPLAY_HEADER_FORMAT, REPLAY_MAGIC, REPLAY_VERSION, keyframe_interval, tick_rate, *bounds))
+        self.offset = REPLAY_HEADER_SIZE
+        self.tick_offset = self.offset  # where the records of the next tick start
+
+        self.encoder = DeltaEncoder(keyframe_interval)
+        self.index: list[tuple[int, int]] = []  # (tick, offset) of every keyframe
+
+    def _write_record(self, kind: int, tick: int, payload: bytes):
+        self.file.write(struct.pack(RECORD_HEADER_FORMAT, kind, tick & 0xFFFFFFFF, len(payload)))
+        self.file.write(payload)
+        self.offset += RECORD_HEADER_SIZE + len(payload)
+
+    def record_tick(self, tick: int, ids: np.ndarray, x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray):
+        """Record the state of the flock after tick was stepped."""
+        self.encoder.update(ids, x, y, vx, vy)
+
+        if self.encoder.is_keyframe_due():
+            self.file.flush()  # a recording that is not closed keeps everything up to its last keyframe
+            self.index.append((tick, self.tick_offset))
+            self._write_record(REPLAY_KEYFRAME, tick, self.encoder.keyframe_payload())
+        else:
+            self._write_record(REPLAY_DELTA, tick, self.encoder.delta_payload())
+        self.tick_offset = self.offset
+
+    def record_commands(self, tick: int, added_boids: list[Boid], removed_ids: list[int]):
+        """Record the boids added and removed before tick is stepped, only the ones that were actually applied."""
+        if len(added_boids) > 0 or len(removed_ids) > 0:
+            self._write_record(REPLAY_COMMANDS, tick, serialize_commands(added_boids, removed_ids))
+
+    def close(self):
+        index_offset = self.offset
+        self._write_record(REPLAY_INDEX, 0, np.array(self.index, dtype=INDEX_ENTRY_DTYPE).tobytes())
+        self.file.write(struct.pack(FOOTER_FORMAT, index_offset, REPLAY_INDEX_MAGIC))
+        self.file.close()
+        logger.info(f"Recorded {len(self.index)} keyframes to {self.path}")
+
+
+class ReplayReader:
+    """
+    Reads a replay file through mmap: only the records that are read are paged in, so any tick of a long recording
+    is reached by seeking to the keyframe before it, without loading the file.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+        magic, version, self.keyframe_interval, self.tick_rate, *bounds = struct.unpack_from(REPLAY_HEADER_FORMAT, self.view)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {REPLAY_VERSION} replay file")
+        self.bounds: tuple[float, float, float, float] = tuple(bounds)
+
+        self.end = len(self.view)  # the end of the records
+        self.keyframe_ticks, self.keyframe_offsets = self._read_index()
+        if len(self.keyframe_ticks) == 0:
+            self.close()
+            raise ValueError(f"{path} has no keyframes")
+
+        self.first_tick = int(self.keyframe_ticks[0])
+        self.last_tick = self._find_last_tick()
+
+    def _read_index(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.end >= REPLAY_HEADER_SIZE + FOOTER_SIZE:
+            index_offset, magic = struct.unpack_from(FOOTER_FORMAT, self.view, self.end - FOOTER_SIZE)
+            if magic == REPLAY_INDEX_MAGIC:
+                kind, _, length = struct.unpack_from(RECORD_HEADER_FORMAT, self.view, index_offset)
+                index = np.frombuffer(self.view, dtype=INDEX_ENTRY_DTYPE, count=length // INDEX_ENTRY_DTYPE.itemsize,
+                                      offset=index_offset + RECORD_HEADER_SIZE)
+                self.end = index_offset
+                return index['tick'].astype(np.int64), index['offset'].astype(np.int64)
+
+        logger.warning("The replay has no index (the recording was not closed), scanning it for keyframes")
+        ticks = []
+        offsets = []
+        tick_offset = REPLAY_HEADER_SIZE
+        for kind, tick, _, _, next_offset in self.records(REPLAY_HEADER_SIZE):
+            if kind == REPLAY_KEYFRAME:
+                ticks.append(tick)
+                offsets.append(tick_offset)
+            if kind in (REPLAY_KEYFRAME, REPLAY_DELTA):
+                tick_offset = next_offset
+        return np.array(ticks, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+    def _find_last_tick(self) -> int:
+        last_tick = self.first_tick
+        for kind, tick, _, _, _ in self.records(int(self.keyframe_offsets[-1])):
+            if kind in (REPLAY_KEYFRAME, REPLAY_DELTA):
+                last_tick = tick
+        return last_tick
+
+    def records(self, offset: int):
+        """Iterate the records from offset: (kind, tick, payload (a view into the file), offset, next offset)."""
+        while offset + RECORD_HEADER_SIZE <= self.end:
+            kind, tick, length = struct.unpack_from(RECORD_HEADER_FORMAT, self.view, offset)
+            payload_offset = offset + RECORD_HEADER_SIZE
+            if payload_offset + length > self.end:
+                break  # the last record was cut off
+            yield kind, tick, self.view[payload_offset:payload_offset + length], offset, payload_offset + length
+            offset = payload_offset + length
+
+    def keyframe_offset(self, tick: int) -> int:
+        """The offset of the last keyframe at or before tick (the first one for earlier ticks)."""
+        position = max(int(np.searchsorted(self.keyframe_ticks, tick, 'right')) - 1, 0)
+        return int(self.keyframe_offsets[position])
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+class ReplayCursor:
+    """
+    A playback position in a replay. move_to returns the packages that bring a client's state to a tick: the
+    BOIDS_DELTA stream (as the server sends it, with the tick in front) and the BOIDS_COMMANDS applied on the way.
+    Moving backwards, or further forward than a keyframe interval, starts again from the keyframe before the tick.
+    """
+
+    def __init__(self, reader: ReplayReader):
+        self.reader = reader
+        self.tick: int | None = None  # the tick of the last state returned
+        self.offset = reader.keyframe_offset(reader.first_tick)  # where the records after it start
+
+    def move_to(self, tick: int) -> list[Package]:
+        tick = min(max(tick, self.reader.first_tick), self.reader.last_tick)
+        if self.tick is not None and tick == self.tick:
+            return []
+
+        if self.tick is None or tick < self.tick or tick - self.tick > self.reader.keyframe_interval:
+            self.offset = self.reader.keyframe_offset(tick)
+
+        packages = []
+        for kind, record_tick, payload, offset, next_offset in self.reader.records(self.offset):
+            if record_tick > tick:
+                break  # commands carry the tick of the first state they are in, so they wait for it too
+
+            if kind in (REPLAY_KEYFRAME, REPLAY_DELTA):
+                if kind == REPLAY_KEYFRAME:
+                    # the keyframe replaces the states before it, the commands are kept
+                    packages = [package for package in packages if package.kind == PackageKind.BOIDS_COMMANDS]
+                packages.append(Package(PackageKind.BOIDS_DELTA, add_state_tick(record_tick, payload)))
+                self.tick = record_tick
+            elif kind == REPLAY_COMMANDS:
+                packages.append(Package(PackageKind.BOIDS_COMMANDS, bytes(payload)))
+            self.offset = next_offset
+
+        return packages
+
+    def at_end(self) -> bool:
+        return self.tick is not None and self.tick >= self.reader.last_tick
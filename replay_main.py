@@ -0,0 +1,109 @@
+import argparse
+from raylibpy import *
+from boid_helper import deserialize_commands
+from delta_codec import DeltaDecoder
+from compact_codec import CompactStateDecoder
+from network import PackageKind
+from replay import ReplayReader, ReplayCursor
+import client_main
+from client_main import receive_state, draw_flock, pick_boid, PICK_BOID_SQUARED_RADIUS
+from flock_index import FlockIndex
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+SEEK_SECONDS = 10  # how far the left / right keys jump
+MAX_SPEED = 1024  # the fastest playback, times real time
+TIMELINE_HEIGHT = 16  # the scrub bar at the bottom of the window, in pixels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a replay recorded by the server (server_headless.py --record).")
+    parser.add_argument('path', help="the replay file")
+    parser.add_argument('--speed', type=float, default=1.0, help="times real time")
+    parser.add_argument('--start', type=int, help="the tick to start at, the first one by default")
+    args = parser.parse_args()
+
+    reader = ReplayReader(args.path)
+    cursor = ReplayCursor(reader)
+    logger.info(f"Replay of ticks {reader.first_tick} - {reader.last_tick} at {reader.tick_rate} ticks per second")
+
+    min_x, min_y, max_x, max_y = reader.bounds
+    width, height = int(max_x - min_x), int(max_y - min_y)
+    init_window(width, height + TIMELINE_HEIGHT, "Replay")
+    set_target_fps(60)
+
+    delta_decoder = DeltaDecoder()
+    compact_decoder = CompactStateDecoder()
+
+    position = float(reader.first_tick if args.start is None else args.start)  # the playback tick, fractional between frames
+    speed = args.speed
+    paused = False
+
+    flock_index = FlockIndex([], PICK_BOID_SQUARED_RADIUS)  # the boids drawn, rebuilt when a new state is received
+    added_ids: set[int] = set()  # the boids added during the playback, drawn green like a client's own boids
+
+    while not window_should_close():
+        # Update
+        if is_key_pressed(KEY_SPACE):
+            paused = not paused
+        if is_key_pressed(KEY_UP):
+            speed = min(speed * 2, MAX_SPEED)
+        if is_key_pressed(KEY_DOWN):
+            speed = max(speed / 2, 1 / MAX_SPEED)
+        if is_key_pressed(KEY_RIGHT):
+            position += SEEK_SECONDS * reader.tick_rate
+        if is_key_pressed(KEY_LEFT):
+            position -= SEEK_SECONDS * reader.tick_rate
+        if is_key_pressed(KEY_HOME):
+            position = reader.first_tick
+        if is_key_pressed(KEY_END):
+            position = reader.last_tick
+
+        mouse_position = get_mouse_position()
+        if is_mouse_button_down(MOUSE_BUTTON_LEFT) and mouse_position.y >= height:
+            position = reader.first_tick + (reader.last_tick - reader.first_tick) * min(max(mouse_position.x / width, 0.0), 1.0)
+        elif not paused:
+            position += get_frame_time() * reader.tick_rate * speed
+
+        position = min(max(position, reader.first_tick), reader.last_tick)
+
+        if cursor.tick is not None and position < cursor.tick:
+            added_ids.clear()  # the history before the seek is not replayed
+
+        # the state packets go through the client's own receive path
+        for package in cursor.move_to(int(position)):
+            if package.kind == PackageKind.BOIDS_COMMANDS:
+                added_boids, removed_ids = deserialize_commands(package.payload)
+                added_ids.update(boid.id for boid in added_boids)
+                added_ids.difference_update(removed_ids)
+            else:
+                client_main.incoming_packets.put(package)
+
+        _, new_boids = receive_state(delta_decoder, compact_decoder)
+        if new_boids is not None:
+            flock_index = FlockIndex(new_boids, PICK_BOID_SQUARED_RADIUS)
+
+        picked_id = pick_boid(flock_index, flock_index.arrays, (mouse_position.x, mouse_position.y))
+
+        # Draw
+        begin_drawing()
+        clear_background(RAYWHITE)
+
+        draw_flock(flock_index.arrays, picked_id, added_ids)
+
+        progress = (cursor.tick - reader.first_tick) / max(reader.last_tick - reader.first_tick, 1) if cursor.tick is not None else 0.0
+        draw_rectangle(0, height, width, TIMELINE_HEIGHT, LIGHTGRAY)
+        draw_rectangle(0, height, int(width * progress), TIMELINE_HEIGHT, DARKBLUE)
+
+        draw_fps(10, 10)
+        draw_text(f"Tick: {cursor.tick} / {reader.last_tick}  Speed: x{speed:g}{'  Paused' if paused else ''}", 10, 30, 20, BLACK)
+
+        end_drawing()
+
+    close_window()
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
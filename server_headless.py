@@ -0,0 +1,177 @@
+import argparse
+import queue
+import time
+from boid_helper import generate_boids
+from server_network import ClientCommunicationInfo
+from server_network_async import start_server_network
+from server_simulation import ServerSimulation, MAX_BOIDS
+from state_broadcast import StateBroadcaster
+from metrics import server_metrics, start_metrics_server
+from replay import ReplayRecorder, REPLAY_KEYFRAME_INTERVAL
+from checkpoint import Checkpointer, load_checkpoint, restore_simulation, DEFAULT_CHECKPOINT_INTERVAL
+from obstacles import load_obstacles
+from logger_utils import create_formatted_logger
+
+DEFAULT_TICK_RATE = 60  # simulation steps per second
+DEFAULT_BROADCAST_RATE = 20  # state broadcasts per second
+
+MAX_CATCH_UP_TICKS = 5  # the maximum number of ticks run in a row when behind, older ticks are dropped
+
+logger = create_formatted_logger()
+
+all_incoming_packets = queue.Queue()  # a queue for all incoming packets
+
+all_client_infos: list[ClientCommunicationInfo] = []  # a list to store all client information
+
+
+class RaylibObserver:
+    """An optional window that shows the simulation, it only draws and never drives the clock."""
+
+    def __init__(self, width: int, height: int, fps: int):
+        # imported here so a headless box never needs raylib
+        import raylibpy
+        import boid_render
+
+        self.raylib = raylibpy
+        self.boid_render = boid_render
+        self.obstacles_triangles = None  # computed on the first draw, the obstacles never move
+
+        raylibpy.init_window(width, height, "Server view (headless)")
+        raylibpy.set_target_fps(fps)
+
+    def should_close(self) -> bool:
+        return self.raylib.window_should_close()
+
+    def draw(self, simulation: ServerSimulation):
+        self.raylib.begin_drawing()
+        self.raylib.clear_background(self.raylib.RAYWHITE)
+
+        if simulation.obstacles is not None:
+            if self.obstacles_triangles is None:
+                self.obstacles_triangles = self.boid_render.get_obstacles_triangles(simulation.obstacles)
+            self.boid_render.draw_triangles(self.obstacles_triangles, self.boid_render.OBSTACLE_COLOR)
+
+        _, x, y, vx, vy = simulation.get_state_arrays()
+        self.boid_render.draw_boids_arrays(x, y, vx, vy, self.raylib.BLUE)
+
+        self.raylib.draw_fps(10, 10)
+        self.raylib.draw_text(f"Tick: {simulation.tick}", 10, 30, 20, self.raylib.BLACK)
+
+        self.raylib.end_drawing()
+
+    def close(self):
+        self.raylib.close_window()
+
+
+def run(simulation: ServerSimulation, broadcaster: StateBroadcaster, tick_rate: float, broadcast_rate: float,
+        observer: RaylibObserver | None = None, max_ticks: int | None = None, checkpointer: Checkpointer | None = None):
+    """
+    Run the simulation on a fixed timestep clock: every tick steps the world by exactly 1 / tick_rate seconds,
+    the state is broadcast to the clients at broadcast_rate, independently of the ticks and of the rendering.
+    The tick duration of the metrics covers processing the incoming packets and stepping, broadcasts are timed apart.
+    A checkpointer, when given, checkpoints the world between ticks.
+    """
+    tick_dt = 1 / tick_rate
+    broadcast_interval = 1 / broadcast_rate
+
+    next_tick = time.perf_counter()
+    next_broadcast = next_tick
+
+    while max_ticks is None or simulation.tick < max_ticks:
+        if observer is not None and observer.should_close():
+            break
+
+        now = time.perf_counter()
+
+        ticks_run = 0
+        while now >= next_tick:
+            if ticks_run == MAX_CATCH_UP_TICKS:
+                # drop the whole ticks it is behind, less than a tick late is caught up on the next pass
+                dropped = int((now - next_tick) / tick_dt)
+                if dropped > 0:
+                    logger.warning(f"Simulation is behind, dropping {dropped} ticks")
+                    next_tick += dropped * tick_dt
+                break
+
+            tick_start = time.perf_counter()
+            with server_metrics.phase('process_incoming'):
+                simulation.process_incoming(all_incoming_packets)
+            with server_metrics.phase('step'):
+                simulation.step(tick_dt)
+            server_metrics.observe_tick(time.perf_counter() - tick_start)
+
+            if checkpointer is not None:
+                checkpointer.update(simulation)
+
+            next_tick += tick_dt
+            ticks_run += 1
+
+        if now >= next_broadcast:
+            with server_metrics.phase('broadcast'):
+                broadcaster.broadcast(all_client_infos, simulation)
+            next_broadcast = max(next_broadcast + broadcast_interval, now)
+
+        if observer is not None:
+            with server_metrics.phase('draw'):
+                observer.draw(simulation)
+        else:
+            time.sleep(max(0.0, min(next_tick, next_broadcast) - time.perf_counter()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the boids server without a window.")
+    parser.add_argument('--tick-rate', type=float, default=DEFAULT_TICK_RATE, help="simulation steps per second")
+    parser.add_argument('--broadcast-rate', type=float, default=DEFAULT_BROADCAST_RATE, help="state broadcasts per second")
+    parser.add_argument('--boids', type=int, default=100, help="the number of boids to start with")
+    parser.add_argument('--max-boids', type=int, default=MAX_BOIDS, help="the maximum number of boids")
+    parser.add_argument('--engine', choices=('boids', 'flock', 'parallel'), default='boids')
+    parser.add_argument('--state-stream', choices=('full', 'delta'), default='full', help="full snapshots or deltas between keyframes")
+    parser.add_argument('--network-backend', choices=('threads', 'asyncio'), default='threads', help="thread per socket or one event loop")
+    parser.add_argument('--obstacles', metavar='PATH', help="a JSON map of the world's obstacles (see obstacles.load_obstacles)")
+    parser.add_argument('--render', action='store_true', help="open a raylib window that observes the simulation")
+    parser.add_argument('--render-fps', type=int, default=60)
+    parser.add_argument('--metrics-port', type=int, help="serve the loop's metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--record', metavar='PATH', help="record the session to a replay file (play it with replay_main.py)")
+    parser.add_argument('--record-keyframe-interval', type=int, default=REPLAY_KEYFRAME_INTERVAL, help="ticks between two keyframes of the recording")
+    parser.add_argument('--checkpoint', metavar='PATH', help="checkpoint the world to this file and restore it from there at startup")
+    parser.add_argument('--checkpoint-interval', type=float, default=DEFAULT_CHECKPOINT_INTERVAL, help="seconds between two checkpoints")
+    args = parser.parse_args()
+
+    stop_network = start_server_network(args.network_backend, all_incoming_packets, all_client_infos)
+    stop_metrics = start_metrics_server(all_client_infos, args.metrics_port) if args.metrics_port is not None else None
+
+    obstacles = load_obstacles(args.obstacles) if args.obstacles is not None else None
+
+    checkpoint = load_checkpoint(args.checkpoint) if args.checkpoint is not None else None
+    if checkpoint is not None:
+        simulation = restore_simulation(checkpoint, engine=args.engine, max_boids=args.max_boids, obstacles=obstacles)
+        logger.info(f"Restored tick {checkpoint.tick} with {len(simulation)} boids from {args.checkpoint}")
+    else:
+        simulation = ServerSimulation(generate_boids(args.boids), engine=args.engine, max_boids=args.max_boids, obstacles=obstacles)
+    checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval) if args.checkpoint is not None else None
+
+    if args.record is not None:
+        simulation.recorder = ReplayRecorder(args.record, simulation.bounds, args.tick_rate, args.record_keyframe_interval)
+    observer = RaylibObserver(800, 450, args.render_fps) if args.render else None
+
+    try:
+        run(simulation, StateBroadcaster(args.state_stream), args.tick_rate, args.broadcast_rate, observer, checkpointer=checkpointer)
+    except KeyboardInterrupt:
+        logger.info("Shutting down server...")
+
+    if observer is not None:
+        observer.close()
+
+    if checkpointer is not None:
+        checkpointer.close(simulation)  # the restart continues from the last tick
+
+    simulation.close()
+
+    if stop_metrics is not None:
+        stop_metrics()
+
+    stop_network()
+
+
+if __name__ == '__main__':
+    main()
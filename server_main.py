@@ -1,13 +1,46 @@
 import queue
 import logging
+import time
 from raylibpy import *
-from boid_helper import generate_boids, get_triangle_points, serialize_boids
-from server_network import ClientCommunicationInfo, setup_server_variables, server_establish_connection, set_shutdown
-from network import Package, PackageKind
-from boid import Boid
+from boid_helper import generate_boids
+from boid_render import draw_boids_arrays, draw_triangles, get_obstacles_triangles, OBSTACLE_COLOR
+from server_network import ClientCommunicationInfo
+from server_network_async import start_server_network
+from server_simulation import ServerSimulation, MAX_BOIDS
+from state_broadcast import StateBroadcaster
+from metrics import server_metrics, start_metrics_server
+from replay import ReplayRecorder
+from checkpoint import Checkpointer, load_checkpoint, restore_simulation, DEFAULT_CHECKPOINT_INTERVAL
+from obstacles import load_obstacles
 from logger_utils import create_formatted_logger
 
-MAX_BOIDS = 200  # maximum number of boids
+USE_SPATIAL_GRID = True  # query neighbors through a spatial grid, False scans the whole list (the reference mode)
+
+# 'boids' steps a list of Boid objects, 'flock' steps numpy arrays (see flock.Flock),
+# 'parallel' steps the numpy arrays on a process pool over shared memory (see parallel_flock.ParallelFlockStepper)
+ENGINE = 'boids'
+
+# 'in_place' updates each boid while later boids read it (depends on the list order),
+# 'double_buffered' reads a snapshot of the frame and writes the next one into a second list
+STEP_MODE = 'double_buffered'
+
+# 'full' sends the whole state every frame (BOIDS_STATE), 'delta' sends only the changes between keyframes (BOIDS_DELTA)
+STATE_STREAM = 'full'
+
+# 'threads' serves every client with its own threads, 'asyncio' serves all the clients from one event loop
+NETWORK_BACKEND = 'threads'
+
+METRICS_PORT: int | None = None  # serve the loop's metrics on http://127.0.0.1:METRICS_PORT/metrics, None to not sample them
+
+RECORD_PATH: str | None = None  # record the session to this replay file (play it with replay_main.py), None to not record
+
+# checkpoint the world to this file every CHECKPOINT_INTERVAL seconds and restore it from there at startup, None to always start fresh
+CHECKPOINT_PATH: str | None = None
+CHECKPOINT_INTERVAL = DEFAULT_CHECKPOINT_INTERVAL
+
+OBSTACLES_PATH: str | None = None  # a JSON map of the world's obstacles (see obstacles.load_obstacles), None for an open world
+
+TARGET_FPS = 60
 
 logger = create_formatted_logger()
 
@@ -18,75 +51,81 @@ shutdown = False  # a flag to indicate if the server should shut down
 all_client_infos: list[ClientCommunicationInfo] = []  # a list to store all client information
 
 if __name__ == '__main__':
-    setup_server_variables(all_incoming_packets, all_client_infos)
-    server_establish_socket = server_establish_connection()
+    stop_network = start_server_network(NETWORK_BACKEND, all_incoming_packets, all_client_infos)
+    stop_metrics = start_metrics_server(all_client_infos, METRICS_PORT) if METRICS_PORT is not None else None
 
     init_window(800, 450, "Server view")
 
-    set_target_fps(60)
+    set_target_fps(TARGET_FPS)
+
+    obstacles = load_obstacles(OBSTACLES_PATH) if OBSTACLES_PATH is not None else None
+    obstacles_triangles = get_obstacles_triangles(obstacles) if obstacles is not None else None
 
-    boids = generate_boids(100)
+    checkpoint = load_checkpoint(CHECKPOINT_PATH) if CHECKPOINT_PATH is not None else None
+    if checkpoint is not None:
+        simulation = restore_simulation(checkpoint, ENGINE, STEP_MODE, USE_SPATIAL_GRID, MAX_BOIDS, obstacles)
+        logger.info(f"Restored tick {checkpoint.tick} with {len(simulation)} boids from {CHECKPOINT_PATH}")
+    else:
+        simulation = ServerSimulation(generate_boids(100), ENGINE, STEP_MODE, USE_SPATIAL_GRID, MAX_BOIDS, obstacles=obstacles)
+    checkpointer = Checkpointer(CHECKPOINT_PATH, CHECKPOINT_INTERVAL) if CHECKPOINT_PATH is not None else None
+
+    if RECORD_PATH is not None:
+        simulation.recorder = ReplayRecorder(RECORD_PATH, simulation.bounds, TARGET_FPS)
+
+    broadcaster = StateBroadcaster(STATE_STREAM)
 
     while not window_should_close():
+        frame_start = time.perf_counter()
+
         # Update
+        with server_metrics.phase('process_incoming'):
+            simulation.process_incoming(all_incoming_packets)
+
         # send all the clients their packets
-        while not all_incoming_packets.empty():
-            packet = all_incoming_packets.get()
-            if packet.kind != PackageKind.EXIT:
-                match packet.kind:
-                    case PackageKind.ADD_BOID:
-                        boid = Boid.deserialize(packet.payload)
-
-                        # check boids id is not already in the list and list is not full
-                        if boid.id not in [b.id for b in boids] and len(boids) < MAX_BOIDS:
-                            logger.info(f"Adding boid with ID: {boid.id} at position: ({boid.x}, {boid.y})")
-                            boids.append(boid)
-                    case PackageKind.REMOVE_BOID:
-                        for i in range(len(boids)):
-                            if boids[i].id == int.from_bytes(packet.payload, 'big'):
-                                boids.pop(i)
-                                logger.info(f"Removed boid with ID: {packet.payload.hex()}")
-                                break
-                    case _:
-                        logger.error(f"Unknown package kind: {packet.kind.name}")
-            else:
-                logger.fatal(f"An exit package slipped through to server main!")
+        with server_metrics.phase('broadcast'):
+            broadcaster.broadcast(all_client_infos, simulation)
 
         mouse_pos = get_mouse_position()
 
-        for client_info in all_client_infos:
-            if not client_info.should_terminate:
-                client_info.outgoing_queue.put(Package(PackageKind.BOIDS_STATE, serialize_boids(boids)))
-
-        target_to = None
-        target_away = None
-
         if is_mouse_button_down(MOUSE_BUTTON_LEFT):
-            target_to = (mouse_pos.x, mouse_pos.y)
+            simulation.set_targets((mouse_pos.x, mouse_pos.y), None)
         elif is_mouse_button_down(MOUSE_BUTTON_RIGHT):
-            target_away = (mouse_pos.x, mouse_pos.y)
+            simulation.set_targets(None, (mouse_pos.x, mouse_pos.y))
+        elif is_mouse_button_released(MOUSE_BUTTON_LEFT) or is_mouse_button_released(MOUSE_BUTTON_RIGHT):
+            simulation.set_targets(None, None)
+
+        with server_metrics.phase('step'):
+            simulation.step(get_frame_time())
+
+        if checkpointer is not None:
+            checkpointer.update(simulation)
 
-        for boid in boids:
-            boid.update(get_frame_time(), boids, 0, 0, 800, 450, target_to, target_away)
+        # the frame is measured without end_drawing, it waits for the target fps
+        with server_metrics.phase('draw'):
+            begin_drawing()
+            clear_background(RAYWHITE)
 
-        begin_drawing()
-        clear_background(RAYWHITE)
+            # Draw
+            if obstacles_triangles is not None:
+                draw_triangles(obstacles_triangles, OBSTACLE_COLOR)
 
-        # Draw
-        for boid in boids:
-            points = get_triangle_points(boid.x, boid.y, boid.vx, boid.vy, 10)
-            point1 = Vector2(points[0][0], points[0][1])
-            point2 = Vector2(points[1][0], points[1][1])
-            point3 = Vector2(points[2][0], points[2][1])
+            _, x, y, vx, vy = simulation.get_state_arrays()
+            draw_boids_arrays(x, y, vx, vy, BLUE)
 
-            draw_triangle(point1, point3, point2, BLUE)
+            draw_fps(10, 10)
 
-        draw_fps(10, 10)
+        server_metrics.observe_tick(time.perf_counter() - frame_start)
 
         end_drawing()
 
     close_window()
 
-    set_shutdown(True)  # Set the shutdown flag to True
+    if checkpointer is not None:
+        checkpointer.close(simulation)
+
+    simulation.close()
+
+    if stop_metrics is not None:
+        stop_metrics()
 
-    server_establish_socket.close()
+    stop_network()
@@ -1,10 +1,14 @@
 import queue
 import socket
-import time
 import traceback
 import threading
 from network_vars import *
 from network import Network, Package, ProtocolStatusCodes, PackageKind
+from outgoing_channel import OutgoingChannel
+from compact_codec import COMPACT_HAS_TABLE
+from delta_codec import DELTA_FLAGS_OFFSET, DELTA_KEYFRAME
+from boid_helper import STATE_TICK_FIELD_SIZE, deserialize_viewport
+from metrics import server_metrics, PACKAGE_HEADER_SIZE
 from logger_utils import create_formatted_logger
 
 logger = create_formatted_logger()
@@ -15,16 +19,81 @@ shutdown = False  # a flag to indicate if the server should shut down
 
 __all_client_infos = None  # a list to store all client information
 
+SUPPORTED_SESSION_FLAGS = SessionFlags.COMPACT_STATE | SessionFlags.SINGLE_CONNECTION  # the session options this server can grant
+
 
 class ClientCommunicationInfo:
-    def __init__(self, outgoing_socket, incoming_socket, client_address, client_id: int = -1):
+    def __init__(self, outgoing_socket, incoming_socket, client_address, client_id: int = -1, session_flags: SessionFlags = SessionFlags.NONE):
         self.outgoing_socket = outgoing_socket
         self.incoming_socket = incoming_socket
         self.client_address = client_address
         self.incoming_queue: queue.Queue[Package] = queue.Queue()  # EXAMINE: this may not be needed
-        self.outgoing_queue: queue.Queue[Package] = queue.Queue()
+        self.outgoing_queue = OutgoingChannel(on_coalesce=self.on_state_coalesced)
         self.client_id = client_id
         self.should_terminate = False
+        self.needs_keyframe = True  # the next BOIDS_DELTA sent to this client must be a keyframe
+        self.session_flags = session_flags  # the options granted in the handshake
+        self.index_epoch: int | None = None  # the BOIDS_STATE_COMPACT index table epoch this client has
+        self.viewport: tuple[float, float, float, float] | None = None  # the area this client shows, None for the whole world
+        self.needs_obstacles = True  # the world's obstacles were not sent to this client yet
+        self.bytes_sent = 0  # the bytes sent to this client so far, headers included
+
+    def handle_session_package(self, package: Package) -> bool:
+        """Apply a package that changes what is sent to this client, returns False if it is not one (it is for the simulation)."""
+        match package.kind:
+            case PackageKind.RESYNC_REQUEST:
+                logger.info(f"Client {self.client_id} requested a resync")
+                self.needs_keyframe = True
+                self.index_epoch = None
+            case PackageKind.SET_VIEWPORT:
+                self.viewport = deserialize_viewport(package.payload)
+                self.needs_keyframe = True  # the delta stream is not sent while a viewport is set
+                logger.info(f"Client {self.client_id} set its viewport to {self.viewport}")
+            case _:
+                return False
+
+        return True
+
+    def count_sent(self, packages: list[Package]):
+        """Account for packages that were sent to this client."""
+        for package in packages:
+            self.bytes_sent += len(package.payload) + PACKAGE_HEADER_SIZE
+            server_metrics.count_package('out', package.kind, len(package.payload))
+
+    def wake(self):
+        """
+        Wake this client's threads so they see should_terminate or the shutdown flag: the outgoing thread waits on its
+        channel, and over a single connection the incoming thread blocks in recv (the shared socket has no timeout).
+        """
+        self.outgoing_queue.close()
+        if self.incoming_socket is not None and self.incoming_socket is self.outgoing_socket:
+            try:
+                self.incoming_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # the socket is closed already
+
+    def on_state_coalesced(self, replaced: Package, package: Package) -> Package | None:
+        """
+        The replaced state never reaches the client, send again what it carried that the next states rely on.
+        Returns the state to send instead of the replaced one (OutgoingChannel.on_coalesce).
+        """
+        if self.outgoing_queue.coalesced == 1:
+            logger.info(f"Client {self.client_id} is slower than the broadcast, its states are coalesced from now on")
+
+        if replaced.kind == PackageKind.BOIDS_DELTA:
+            if package.kind == PackageKind.BOIDS_DELTA and package.payload[STATE_TICK_FIELD_SIZE + DELTA_FLAGS_OFFSET] & DELTA_KEYFRAME:
+                return package  # a keyframe does not need the replaced delta
+            self.needs_keyframe = True  # the delta chain is broken
+            if package.kind == PackageKind.BOIDS_DELTA:
+                return None  # the newer delta builds on the replaced one, the keyframe of the next broadcast goes first
+        elif replaced.kind == PackageKind.BOIDS_STATE_COMPACT and replaced.payload[STATE_TICK_FIELD_SIZE] & COMPACT_HAS_TABLE:
+            if package.kind == PackageKind.BOIDS_STATE_COMPACT and package.payload[STATE_TICK_FIELD_SIZE] & COMPACT_HAS_TABLE:
+                return package  # it carries the table too
+            self.index_epoch = None  # the index table was not received
+            if package.kind == PackageKind.BOIDS_STATE_COMPACT:
+                return None  # the newer state needs the replaced table, the next broadcast sends it with the table
+
+        return package
 
 
 def client_incoming_thread_handler(client_info: ClientCommunicationInfo):
@@ -39,15 +108,18 @@ def client_incoming_thread_handler(client_info: ClientCommunicationInfo):
 
                 match status:
                     case ProtocolStatusCodes.ALL_GOOD:
+                        server_metrics.count_package('in', package.kind, len(package.payload))
                         if package.kind != PackageKind.EXIT:
-                            __all_incoming_packets.put(package)
+                            if not client_info.handle_session_package(package):
+                                __all_incoming_packets.put(package)
                         else:
                             logger.info(f"Received exit package from client {client_info.client_id}, shutting down...")
                             client_info.should_terminate = True
                             break
 
                     case ProtocolStatusCodes.SOCKET_DISCONNECTED | ProtocolStatusCodes.SOCKET_CONNECTION_ERROR:
-                        logger.error('Seems client disconnected abnormally')
+                        if not client_info.should_terminate and not shutdown:  # else wake shut the shared socket down
+                            logger.error('Seems client disconnected abnormally')
                         client_info.should_terminate = True
                         break
                     case _:
@@ -63,9 +135,12 @@ def client_incoming_thread_handler(client_info: ClientCommunicationInfo):
         logger.fatal(traceback.format_exc())
         client_info.should_terminate = True
 
+    client_info.outgoing_queue.close()  # wake the outgoing thread so it can end too
+
     logger.info(f"Ended incoming thread handler for {client_info.client_id}!")
 
-    client_info.incoming_socket.close()
+    if client_info.incoming_socket is not client_info.outgoing_socket:
+        client_info.incoming_socket.close()  # a single connection is closed by the outgoing thread, it may still be sending
 
 
 def client_outgoing_thread_handler(client_info: ClientCommunicationInfo):
@@ -73,14 +148,20 @@ def client_outgoing_thread_handler(client_info: ClientCommunicationInfo):
 
     try:
         while not client_info.should_terminate and not shutdown:
-            while not client_info.outgoing_queue.empty():
-                package = client_info.outgoing_queue.get()
-
-                Network.send_data(client_info.outgoing_socket, package, log=False)
+            package = client_info.outgoing_queue.get()  # blocks until a package is waiting or the channel is closed
+            if package is None:
+                break
 
-                client_info.outgoing_queue.task_done()
+            # send everything that is waiting in one go
+            packages = [package] + client_info.outgoing_queue.take_all()
+            status, message = Network.send_batch(client_info.outgoing_socket, packages, client_info.client_id, log=False)
 
-            time.sleep(1 / 100)
+            if status != ProtocolStatusCodes.ALL_GOOD:
+                if not client_info.should_terminate and not shutdown:  # else wake shut the shared socket down
+                    logger.error(f"Failed sending to client {client_info.client_id}: {status.name} {message}")
+                client_info.should_terminate = True
+            else:
+                client_info.count_sent(packages)
 
     except socket.error as err:
         logger.fatal(f'Got socket error: {err}')
@@ -90,25 +171,49 @@ def client_outgoing_thread_handler(client_info: ClientCommunicationInfo):
         logger.fatal(traceback.format_exc())
         client_info.should_terminate = True
 
-    logger.info(f"Ended outgoing thread handler for {client_info.client_id}!")
+    client_info.wake()  # over a single connection the incoming thread ends too
+
+    logger.info(f"Ended outgoing thread handler for {client_info.client_id}! "
+                f"({client_info.outgoing_queue.sent_states} states sent, {client_info.outgoing_queue.coalesced} coalesced)")
 
     client_info.outgoing_socket.close()
 
 
-# this function creates a mini server that his only job is to establish a connection with the client
-def client_communication_establish_server_thread(server_establish_socket: socket.socket):
-    global shutdown
+def receive_session_request(client_establish_socket: socket.socket, client_id: int) -> SessionFlags:
+    """Receive the flags the client asks for, a client that does not send them gets the default session."""
+    client_establish_socket.settimeout(HANDSHAKE_TIMEOUT)
+    temp = Network.receive_data(client_establish_socket, client_id)
+    client_establish_socket.settimeout(None)
 
-    logger.info('Client\'s communication establish server started!')
+    if temp is None:
+        logger.warning(f"Client {client_id}: no session request received, using the default session")
+        return SessionFlags.NONE
 
-    client_id = 0
+    status, package = temp
+    if status != ProtocolStatusCodes.ALL_GOOD or package.kind != PackageKind.ESTABLISH_CONNECTION or len(package.payload) < 1:
+        logger.warning(f"Client {client_id}: invalid session request ({status.name}), using the default session")
+        return SessionFlags.NONE
 
-    while not shutdown:
-        try:
-            client_establish_socket, address = server_establish_socket.accept()
+    return SessionFlags(package.payload[0]) & SUPPORTED_SESSION_FLAGS
 
-            logger.info(f'Client connected from {address}')
 
+def client_session_setup_thread(client_establish_socket: socket.socket, address, client_id: int):
+    """
+    Run the handshake of a connected client and start its threads. It runs on its own thread, so a client that is
+    slow to send its session request (or an old one that never does) does not hold up the accept loop.
+    """
+    try:
+        session_flags = receive_session_request(client_establish_socket, client_id)
+        logger.info(f"Client {client_id}: session flags {session_flags!r}")
+
+        if session_flags & SessionFlags.SINGLE_CONNECTION:
+            # both directions run over the setup connection
+            Network.send_data(client_establish_socket,
+                              Package(PackageKind.ESTABLISH_CONNECTION, (0).to_bytes(2, 'big') + (0).to_bytes(2, 'big') + session_flags.to_bytes(1, 'big')),
+                              tid=client_id)
+
+            outgoing_socket = incoming_socket = client_establish_socket
+        else:
             # create new random sockets for the incoming and outgoing communication
             binding_outgoing_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             binding_outgoing_socket.bind((SERVER_IP, 0))
@@ -124,27 +229,59 @@ def client_communication_establish_server_thread(server_establish_socket: socket
             Network.send_data(client_establish_socket,
                               Package(PackageKind.ESTABLISH_CONNECTION,
                                       binding_outgoing_socket.getsockname()[1].to_bytes(2, 'big') +
-                                      binding_incoming_socket.getsockname()[1].to_bytes(2, 'big')),
+                                      binding_incoming_socket.getsockname()[1].to_bytes(2, 'big') +
+                                      session_flags.to_bytes(1, 'big')),
                               tid=client_id)
 
-            # wait for the client to connect to the incoming and outgoing sockets
-            outgoing_socket, address1 = binding_outgoing_socket.accept()
-            incoming_socket, address2 = binding_incoming_socket.accept()
-
-            # add timeout to the incoming socket
+            # wait for the client to connect to the incoming and outgoing sockets, a client that never does is dropped
+            binding_outgoing_socket.settimeout(HANDSHAKE_TIMEOUT)
+            binding_incoming_socket.settimeout(HANDSHAKE_TIMEOUT)
+            try:
+                outgoing_socket, address1 = binding_outgoing_socket.accept()
+                incoming_socket, address2 = binding_incoming_socket.accept()
+            finally:
+                binding_outgoing_socket.close()
+                binding_incoming_socket.close()
+
+        # the incoming thread checks the shutdown flags on every timeout, a single connection stays blocking instead
+        # (a timeout would also apply to the sends and drop a slow client), it is woken by ClientCommunicationInfo.wake
+        if incoming_socket is not outgoing_socket:
             incoming_socket.settimeout(2.0)
+        outgoing_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # the send loop already batches
+
+        client_info = ClientCommunicationInfo(outgoing_socket, incoming_socket, address, client_id, session_flags)
 
-            client_info = ClientCommunicationInfo(outgoing_socket, incoming_socket, address, client_id)
+        # add the client info to the list
+        __all_client_infos.append(client_info)
+
+        # start the threads
+        threading.Thread(target=client_incoming_thread_handler, args=(client_info,)).start()
+        threading.Thread(target=client_outgoing_thread_handler, args=(client_info,)).start()
+    except socket.error as err:
+        logger.error(f'Client {client_id}: the connection setup failed: {err}')
+        client_establish_socket.close()
 
-            # add the client info to the list
-            __all_client_infos.append(client_info)
 
-            # start the threads
-            threading.Thread(target=client_incoming_thread_handler, args=(client_info,)).start()
-            threading.Thread(target=client_outgoing_thread_handler, args=(client_info,)).start()
+# this function creates a mini server that his only job is to establish a connection with the client
+def client_communication_establish_server_thread(server_establish_socket: socket.socket):
+    global shutdown
+
+    logger.info('Client\'s communication establish server started!')
+
+    client_id = 0
+
+    while not shutdown:
+        try:
+            client_establish_socket, address = server_establish_socket.accept()
+
+            logger.info(f'Client connected from {address}')
+
+            threading.Thread(target=client_session_setup_thread, args=(client_establish_socket, address, client_id)).start()
 
             client_id += 1
         except socket.error as err:
+            if shutdown:
+                break  # stop_server_establish woke the accept
             logger.fatal(f'Error: client_communication_establish_server_thread: {err}')
             logger.fatal(traceback.format_exc())
             shutdown = True
@@ -152,9 +289,11 @@ def client_communication_establish_server_thread(server_establish_socket: socket
     server_establish_socket.close()
 
 
-def server_establish_connection():
+def server_establish_connection(port: int = SERVER_SETUP_PORT):
     server_establish_socket = socket.socket()
-    server_establish_socket.bind((SERVER_IP, SERVER_SETUP_PORT))
+    # a restarted server binds right away, the connections of the previous one may still be in TIME_WAIT
+    server_establish_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_establish_socket.bind((SERVER_IP, port))
     server_establish_socket.listen(20)
 
     # start the server
@@ -163,6 +302,15 @@ def server_establish_connection():
     return server_establish_socket
 
 
+def stop_server_establish(server_establish_socket: socket.socket):
+    """Close the setup socket, waking the thread that waits in accept (closing alone does not wake it on Linux)."""
+    try:
+        server_establish_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # it was not listening anymore
+    server_establish_socket.close()
+
+
 def setup_server_variables(all_incoming_packets: queue.Queue, all_client_infos: list[ClientCommunicationInfo]):
     global __all_incoming_packets, __all_client_infos
     __all_incoming_packets = all_incoming_packets
@@ -191,4 +339,4 @@ if __name__ == '__main__':
 
         print("Shutting down server...")
 
-    server_establish_socket.close()
+    stop_server_establish(server_establish_socket)
@@ -0,0 +1,265 @@
+import asyncio
+import queue
+import threading
+import traceback
+from network_vars import *
+from network import Network, Package, ProtocolStatusCodes, PackageKind
+import server_network
+from server_network import ClientCommunicationInfo, SUPPORTED_SESSION_FLAGS
+from metrics import server_metrics
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+
+class AsyncNetworkServer:
+    """
+    Serves all the clients from one asyncio event loop (epoll on Linux), running on its own thread.
+    The framing, the handshake and the client sockets are the same as the thread per socket backend (server_network.py),
+    incoming packages are handed to the simulation through the same queue and clients are added to the same list.
+    """
+
+    def __init__(self, all_incoming_packets: queue.Queue, all_client_infos: list[ClientCommunicationInfo],
+                 host: str = SERVER_IP, port: int = SERVER_SETUP_PORT):
+        self.all_incoming_packets = all_incoming_packets
+        self.all_client_infos = all_client_infos
+        self.host = host
+        self.port = port
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.started = threading.Event()
+        self.start_error: BaseException | None = None  # why the server could not start, raised by start()
+        self.stopping: asyncio.Event | None = None
+        self.next_client_id = 0
+        self.tasks: set[asyncio.Task] = set()  # the clients' handler tasks
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="async-network-server")
+        self.thread.start()
+        self.started.wait()
+
+        if self.start_error is not None:
+            self.thread.join()
+            raise self.start_error
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        except BaseException as err:
+            if self.started.is_set():
+                raise
+            self.start_error = err  # e.g. the port is taken, start() raises it instead of waiting forever
+        finally:
+            self.started.set()
+            self.loop.close()
+
+    def stop(self):
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        if self.thread is not None:
+            self.thread.join()
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(self.handle_setup_connection, self.host, self.port)
+        logger.info(f'Async communication establish server started on port {self.port}!')
+        self.started.set()
+
+        async with server:
+            await self.stopping.wait()
+
+        for client_info in self.all_client_infos:
+            client_info.should_terminate = True
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def receive_session_request(self, reader: asyncio.StreamReader, client_id: int) -> SessionFlags:
+        try:
+            status, package = await asyncio.wait_for(Network.receive_data_async(reader, client_id), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Client {client_id}: no session request received, using the default session")
+            return SessionFlags.NONE
+
+        if status != ProtocolStatusCodes.ALL_GOOD or package.kind != PackageKind.ESTABLISH_CONNECTION or len(package.payload) < 1:
+            logger.warning(f"Client {client_id}: invalid session request ({status.name}), using the default session")
+            return SessionFlags.NONE
+
+        return SessionFlags(package.payload[0]) & SUPPORTED_SESSION_FLAGS
+
+    async def accept_one(self) -> tuple[asyncio.AbstractServer, asyncio.Future]:
+        """Listen on a random port for a single connection, returns the server and a future of (reader, writer)."""
+        connection = self.loop.create_future()
+
+        def on_connection(reader, writer):
+            if not connection.done():
+                connection.set_result((reader, writer))
+            else:
+                writer.close()
+
+        server = await asyncio.start_server(on_connection, self.host, 0)
+        return server, connection
+
+    async def handle_setup_connection(self, setup_reader: asyncio.StreamReader, setup_writer: asyncio.StreamWriter):
+        client_id = self.next_client_id
+        self.next_client_id += 1
+        address = setup_writer.get_extra_info('peername')
+        logger.info(f'Client connected from {address}')
+
+        servers: list[asyncio.AbstractServer] = []  # the listeners of the extra connections, closed once set up
+        connections: list[asyncio.Future] = []  # their (reader, writer) futures
+
+        try:
+            session_flags = await self.receive_session_request(setup_reader, client_id)
+            logger.info(f"Client {client_id}: session flags {session_flags!r}")
+
+            if session_flags & SessionFlags.SINGLE_CONNECTION:
+                # both directions run over the setup connection
+                package = Package(PackageKind.ESTABLISH_CONNECTION, (0).to_bytes(2, 'big') + (0).to_bytes(2, 'big') + session_flags.to_bytes(1, 'big'))
+                setup_writer.write(Network.build_header(package) + package.payload)
+                await setup_writer.drain()
+
+                incoming_reader, incoming_writer, outgoing_writer = setup_reader, setup_writer, setup_writer
+            else:
+                outgoing_server, outgoing_connection = await self.accept_one()
+                servers.append(outgoing_server)
+                connections.append(outgoing_connection)
+                incoming_server, incoming_connection = await self.accept_one()
+                servers.append(incoming_server)
+                connections.append(incoming_connection)
+                outgoing_port = outgoing_server.sockets[0].getsockname()[1]
+                incoming_port = incoming_server.sockets[0].getsockname()[1]
+
+                # send the port of the new sockets to the client
+                package = Package(PackageKind.ESTABLISH_CONNECTION,
+                                  outgoing_port.to_bytes(2, 'big') + incoming_port.to_bytes(2, 'big') + session_flags.to_bytes(1, 'big'))
+                setup_writer.write(Network.build_header(package) + package.payload)
+                await setup_writer.drain()
+
+                # wait for the client to connect to the incoming and outgoing sockets
+                _, outgoing_writer = await asyncio.wait_for(outgoing_connection, HANDSHAKE_TIMEOUT)
+                incoming_reader, incoming_writer = await asyncio.wait_for(incoming_connection, HANDSHAKE_TIMEOUT)
+                setup_writer.close()  # the setup connection is not needed anymore
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            logger.error(f'Client {client_id}: failed establishing the connection: {err}')
+            setup_writer.close()
+
+            # a half set up client, close the connections it did make
+            for connection in connections:
+                if connection.done() and not connection.cancelled():
+                    connection.result()[1].close()
+            return
+        finally:
+            for server in servers:
+                server.close()
+
+        client_info = ClientCommunicationInfo(None, None, address, client_id, session_flags)
+        ready = asyncio.Event()  # set when the client has packages waiting
+        client_info.outgoing_queue.on_put = lambda: self.loop.call_soon_threadsafe(ready.set)
+
+        self.all_client_infos.append(client_info)
+
+        for coroutine in (self.client_incoming_handler(client_info, incoming_reader, incoming_writer, ready),
+                          self.client_outgoing_handler(client_info, outgoing_writer, ready)):
+            task = asyncio.create_task(coroutine)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def client_incoming_handler(self, client_info: ClientCommunicationInfo, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                      ready: asyncio.Event):
+        logger.info(f"Started incoming handler for {client_info.client_id}!")
+
+        try:
+            while not client_info.should_terminate:
+                status, package = await Network.receive_data_async(reader, client_info.client_id)
+
+                match status:
+                    case ProtocolStatusCodes.ALL_GOOD:
+                        server_metrics.count_package('in', package.kind, len(package.payload))
+                        if package.kind != PackageKind.EXIT:
+                            if not client_info.handle_session_package(package):
+                                self.all_incoming_packets.put(package)
+                        else:
+                            logger.info(f"Received exit package from client {client_info.client_id}, shutting down...")
+                            break
+                    case ProtocolStatusCodes.SOCKET_DISCONNECTED | ProtocolStatusCodes.SOCKET_CONNECTION_ERROR:
+                        logger.error('Seems client disconnected abnormally')
+                        break
+                    case _:
+                        logger.error(f'Something went wrong: {status} : {PackageKind(package.kind).name} : {package.payload}')
+                        break
+        except Exception as err:
+            logger.fatal(f'General error: {err}')
+            logger.fatal(traceback.format_exc())
+
+        client_info.should_terminate = True
+        client_info.outgoing_queue.close()  # wake the writer so it can end too
+        writer.close()
+
+        logger.info(f"Ended incoming handler for {client_info.client_id}!")
+
+    async def client_outgoing_handler(self, client_info: ClientCommunicationInfo, writer: asyncio.StreamWriter, ready: asyncio.Event):
+        logger.info(f"Started outgoing handler for {client_info.client_id}!")
+        outgoing_queue = client_info.outgoing_queue
+
+        try:
+            while not client_info.should_terminate:
+                await ready.wait()
+                ready.clear()
+
+                packages = outgoing_queue.take_all()
+                if len(packages) == 0 and outgoing_queue.closed:
+                    break
+
+                for package in packages:
+                    status, message = Network.check_package(package)
+                    if status != ProtocolStatusCodes.ALL_GOOD:
+                        logger.error(f"Dropped a {package.kind.name} package for client {client_info.client_id}: {message}")
+                        continue
+
+                    writer.write(Network.build_header(package))
+                    writer.write(package.payload)
+                    client_info.count_sent([package])
+
+                # the backpressure, waits while the client reads slowly, meanwhile newer states replace the waiting one
+                await writer.drain()
+        except ConnectionError as err:
+            logger.error(f'Got socket error: {err}')
+        except Exception as err:
+            logger.fatal(f'General error: {err}')
+            logger.fatal(traceback.format_exc())
+
+        client_info.should_terminate = True
+        outgoing_queue.close()
+        writer.close()
+
+        logger.info(f"Ended outgoing handler for {client_info.client_id}! "
+                    f"({outgoing_queue.sent_states} states sent, {outgoing_queue.coalesced} coalesced)")
+
+
+def start_server_network(backend: str, all_incoming_packets: queue.Queue, all_client_infos: list[ClientCommunicationInfo],
+                         port: int = SERVER_SETUP_PORT):
+    """
+    Start the server networking, 'threads' for the thread per socket backend (server_network.py) or 'asyncio' for
+    the single event loop backend, the clients connect to the given setup port. Returns a function that stops it.
+    """
+    if backend == 'asyncio':
+        server = AsyncNetworkServer(all_incoming_packets, all_client_infos, port=port)
+        server.start()
+        return server.stop
+
+    server_network.setup_server_variables(all_incoming_packets, all_client_infos)
+    server_establish_socket = server_network.server_establish_connection(port)
+
+    def stop():
+        server_network.set_shutdown(True)  # Set the shutdown flag to True
+        server_network.stop_server_establish(server_establish_socket)
+
+        # wake the clients' threads, they wait on their channels (and on single connections, in recv)
+        for client_info in all_client_infos:
+            client_info.wake()
+
+    return stop
@@ -0,0 +1,188 @@
+import queue
+import numpy as np
+from boid import Boid
+from boid_helper import DoubleBufferedBoids, deserialize_commands, deserialize_targets, serialize_boids
+from spatial_grid import SpatialGrid
+from flock import Flock
+from parallel_flock import ParallelFlockStepper
+from obstacles import Obstacles
+from network import Package, PackageKind
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+MAX_BOIDS = 200  # maximum number of boids
+
+WORLD_BOUNDS = (0, 0, 800, 450)  # min_x, min_y, max_x, max_y
+
+
+class ServerSimulation:
+    """
+    The server's world, owns the flock and applies the packets coming from the clients.
+    It does not know about rendering or about the clock, the caller decides when to step and with which dt.
+
+    engine: 'boids' steps a list of Boid objects, 'flock' steps numpy arrays (see flock.Flock),
+            'parallel' steps the numpy arrays on a process pool over shared memory (see parallel_flock.ParallelFlockStepper)
+    step_mode (boids engine only): 'in_place' updates each boid while later boids read it (depends on the list order),
+            'double_buffered' reads a snapshot of the frame and writes the next one into a second list
+    use_spatial_grid (boids engine only): query neighbors through a spatial grid, False scans the whole list (the reference mode)
+    obstacles: the static obstacles of the world (see obstacles.Obstacles), None for an open world
+    recorder: a replay.ReplayRecorder that gets the state after every step and the applied add/remove commands, None to not record
+    """
+
+    def __init__(self, boids: list[Boid], engine: str = 'boids', step_mode: str = 'double_buffered', use_spatial_grid: bool = True,
+                 max_boids: int = MAX_BOIDS, bounds: tuple[float, float, float, float] = WORLD_BOUNDS,
+                 obstacles: Obstacles | None = None):
+        self.engine = engine
+        self.max_boids = max_boids
+        self.bounds = bounds
+        self.tick = 0  # the number of steps done so far
+
+        self.target_to: tuple[float, float] | None = None
+        self.target_away: tuple[float, float] | None = None
+        self.obstacles = obstacles
+
+        self.boids = boids
+        self.flock = Flock.from_boids(boids) if engine in ('flock', 'parallel') else None
+        # boid id -> index in self.boids (the boids engine, the flock keeps its own), stepping keeps the list order
+        self.id_to_index = {boid.id: i for i, boid in enumerate(boids)} if self.flock is None else None
+        self.stepper = ParallelFlockStepper(capacity=max_boids, obstacles=obstacles) if engine == 'parallel' else None
+        self.buffers = DoubleBufferedBoids(boids) if self.flock is None and step_mode == 'double_buffered' else None
+        self.grid = SpatialGrid(Boid.PERCEPTION_RADIUS) if self.flock is None and use_spatial_grid else None
+        self.recorder = None
+
+    def __len__(self):
+        return len(self.flock) if self.flock is not None else len(self.boids)
+
+    def get_boids(self) -> list[Boid]:
+        """Get the boids as Boid objects, for the numpy engines they are built on demand."""
+        return self.flock.to_boids() if self.flock is not None else self.boids
+
+    def serialize_state(self, indices: np.ndarray | None = None) -> bytes:
+        """
+        Serialize the current state once (the BOIDS_STATE payload, tick included), the result is shared by all the clients.
+        indices selects the boids to serialize (indices into get_state_arrays), all of them by default.
+        """
+        if self.flock is not None:
+            return self.flock.serialize(indices, self.tick)
+        if indices is None:
+            return serialize_boids(self.boids, self.tick)
+        return serialize_boids([self.boids[i] for i in indices.tolist()], self.tick)
+
+    def get_state_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Get the current state as (ids, x, y, vx, vy) arrays."""
+        if self.flock is not None:
+            return self.flock.ids, self.flock.x, self.flock.y, self.flock.vx, self.flock.vy
+
+        return (np.fromiter((boid.id for boid in self.boids), dtype=np.uint32, count=len(self.boids)),
+                np.fromiter((boid.x for boid in self.boids), dtype=np.float64, count=len(self.boids)),
+                np.fromiter((boid.y for boid in self.boids), dtype=np.float64, count=len(self.boids)),
+                np.fromiter((boid.vx for boid in self.boids), dtype=np.float64, count=len(self.boids)),
+                np.fromiter((boid.vy for boid in self.boids), dtype=np.float64, count=len(self.boids)))
+
+    def add_boid(self, boid: Boid) -> bool:
+        """Add a boid, returns False if the flock is full or the id is already taken."""
+        if len(self) >= self.max_boids:
+            return False
+
+        if self.flock is not None:
+            return self.flock.add_boid(boid)
+
+        # check boids id is not already in the list
+        if boid.id in self.id_to_index:
+            return False
+
+        self.id_to_index[boid.id] = len(self.boids)
+        self.boids.append(boid)
+        return True
+
+    def remove_boid(self, boid_id: int) -> bool:
+        """Remove a boid by id by moving the last boid into its slot, returns False if there is no such boid."""
+        if self.flock is not None:
+            return self.flock.remove_boid(boid_id)
+
+        index = self.id_to_index.pop(boid_id, None)
+        if index is None:
+            return False
+
+        last = self.boids.pop()
+        if index < len(self.boids):
+            self.boids[index] = last
+            self.id_to_index[last.id] = index
+
+        return True
+
+    def apply_commands(self, added_boids: list[Boid], removed_ids: list[int]) -> tuple[int, int]:
+        """
+        Apply a batch of commands in O(batch), the adds first so a boid added and removed in the same batch is gone.
+        Returns (the number of boids added, the number of boids removed).
+        """
+        added_boids = [boid for boid in added_boids if self.add_boid(boid)]
+        removed_ids = [boid_id for boid_id in removed_ids if self.remove_boid(boid_id)]
+
+        if self.recorder is not None:
+            self.recorder.record_commands(self.tick + 1, added_boids, removed_ids)  # they are in the state of the next step
+
+        return len(added_boids), len(removed_ids)
+
+    def set_targets(self, target_to: tuple[float, float] | None, target_away: tuple[float, float] | None):
+        """Set the points the flock moves towards / away from, None to clear."""
+        self.target_to = target_to
+        self.target_away = target_away
+
+    def apply_package(self, packet: Package):
+        match packet.kind:
+            case PackageKind.ADD_BOID:
+                boid = Boid.deserialize(packet.payload)
+                if self.apply_commands([boid], []) == (1, 0):
+                    logger.info(f"Adding boid with ID: {boid.id} at position: ({boid.x}, {boid.y})")
+            case PackageKind.REMOVE_BOID:
+                if self.apply_commands([], [int.from_bytes(packet.payload, 'big')]) == (0, 1):
+                    logger.info(f"Removed boid with ID: {packet.payload.hex()}")
+            case PackageKind.BOIDS_COMMANDS:
+                added, removed = self.apply_commands(*deserialize_commands(packet.payload))
+                logger.info(f"Applied a commands batch: {added} boids added, {removed} boids removed")
+            case PackageKind.SET_TARGET:
+                self.set_targets(*deserialize_targets(packet.payload))
+            case PackageKind.EXIT:
+                logger.fatal(f"An exit package slipped through to server main!")
+            case _:
+                logger.error(f"Unknown package kind: {packet.kind.name}")
+
+    def process_incoming(self, incoming_packets: queue.Queue):
+        """Apply all the packets waiting in the queue."""
+        while not incoming_packets.empty():
+            self.apply_package(incoming_packets.get())
+
+    def step(self, dt: float, ghosts: np.ndarray | None = None):
+        """Step the world by dt, ghosts are read only neighbors from outside it (the flock engine only, see Flock.step)."""
+        min_x, min_y, max_x, max_y = self.bounds
+
+        if ghosts is not None and self.engine != 'flock':
+            raise ValueError(f"ghosts are only supported by the flock engine, not {self.engine}")
+
+        if self.stepper is not None:
+            self.stepper.step(self.flock, dt, min_x, min_y, max_x, max_y, self.target_to, self.target_away)
+        elif self.flock is not None:
+            self.flock.step(dt, min_x, min_y, max_x, max_y, self.target_to, self.target_away, ghosts, self.obstacles)
+        elif self.buffers is not None:
+            self.buffers.front = self.boids
+            self.boids = self.buffers.step(dt, min_x, min_y, max_x, max_y, self.target_to, self.target_away, self.grid, self.obstacles)
+        else:
+            if self.grid is not None:
+                self.grid.rebuild(self.boids)
+
+            for boid in self.boids:
+                boid.update(dt, self.boids, min_x, min_y, max_x, max_y, self.target_to, self.target_away, self.grid, obstacles=self.obstacles)
+
+        self.tick += 1
+
+        if self.recorder is not None:
+            self.recorder.record_tick(self.tick, *self.get_state_arrays())
+
+    def close(self):
+        if self.stepper is not None:
+            self.stepper.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
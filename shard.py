@@ -0,0 +1,340 @@
+import argparse
+import queue
+import socket
+import threading
+import time
+import numpy as np
+from boid import Boid
+from boid_helper import generate_boids, pack_state_tick, split_state_tick, BOIDS_COUNT_FIELD_SIZE
+from flock import BOID_WIRE_DTYPE, deserialize_boids_array
+from network import Network, Package, PackageKind, ProtocolStatusCodes
+from network_vars import SERVER_IP
+from server_simulation import ServerSimulation
+from obstacles import Obstacles, load_obstacles
+from state_broadcast import StateBroadcaster
+from server_network_async import start_server_network
+import server_headless
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+SHARD_SETUP_BASE_PORT = 5100  # shard i serves the gateway (as a normal client) on this port + i
+SHARD_LINK_BASE_PORT = 5200  # shard i accepts the links of its neighbors on this port + i
+SHARD_CONNECT_TIMEOUT = 30.0  # seconds a shard keeps trying to reach its neighbors at startup
+SHARD_LINK_TIMEOUT = 5.0  # seconds a shard waits for the exchange of a neighbor before stepping without it (a missed tick)
+
+DEFAULT_WORLD_BOUNDS = (0, 0, 1600, 900)
+DEFAULT_MAX_BOIDS = 10000  # the maximum number of boids of one shard
+
+
+class ShardLayout:
+    """
+    Splits the world into columns x rows regions of the same size, one per shard (index = row * columns + column).
+    hosts holds the address of every shard (one address for all of them by default).
+    """
+
+    def __init__(self, world_bounds: tuple[float, float, float, float], columns: int, rows: int, hosts: list[str] | None = None):
+        self.world_bounds = world_bounds
+        self.columns = columns
+        self.rows = rows
+        hosts = hosts or [SERVER_IP]
+        self.hosts = hosts * len(self) if len(hosts) == 1 else hosts
+
+        min_x, min_y, max_x, max_y = world_bounds
+        self.cell_width = (max_x - min_x) / columns
+        self.cell_height = (max_y - min_y) / rows
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def region(self, index: int) -> tuple[float, float, float, float]:
+        """The part of the world a shard owns, (min_x, min_y, max_x, max_y)."""
+        column, row = index % self.columns, index // self.columns
+        min_x = self.world_bounds[0] + column * self.cell_width
+        min_y = self.world_bounds[1] + row * self.cell_height
+        return min_x, min_y, min_x + self.cell_width, min_y + self.cell_height
+
+    def neighbors(self, index: int) -> list[int]:
+        """The shards around a shard (up to 8)."""
+        column, row = index % self.columns, index // self.columns
+        return [(row + dy) * self.columns + column + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                if (dx, dy) != (0, 0) and 0 <= column + dx < self.columns and 0 <= row + dy < self.rows]
+
+    def owners(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """The shard that owns every point, points outside the world belong to the closest region."""
+        columns = np.clip(np.floor((x - self.world_bounds[0]) / self.cell_width), 0, self.columns - 1).astype(np.int64)
+        rows = np.clip(np.floor((y - self.world_bounds[1]) / self.cell_height), 0, self.rows - 1).astype(np.int64)
+        return rows * self.columns + columns
+
+    def route(self, index: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """The shard every point is handed to from a shard: its owner, or the neighbor on the way to it."""
+        owners = self.owners(x, y)
+        column, row = index % self.columns, index // self.columns
+        columns = np.clip(owners % self.columns, column - 1, column + 1)
+        rows = np.clip(owners // self.columns, row - 1, row + 1)
+        return rows * self.columns + columns
+
+    def host(self, index: int) -> str:
+        return self.hosts[index]
+
+    @staticmethod
+    def setup_port(index: int) -> int:
+        return SHARD_SETUP_BASE_PORT + index
+
+    @staticmethod
+    def link_port(index: int) -> int:
+        return SHARD_LINK_BASE_PORT + index
+
+
+def pack_records(records: np.ndarray) -> bytes:
+    """A serialize_boids payload (the Boid.serialize format) of BOID_WIRE_DTYPE records."""
+    return len(records).to_bytes(BOIDS_COUNT_FIELD_SIZE, 'big') + records.tobytes()
+
+
+def to_records(ids: np.ndarray, x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray) -> np.ndarray:
+    records = np.empty(len(ids), dtype=BOID_WIRE_DTYPE)
+    records['x'] = x
+    records['y'] = y
+    records['vx'] = vx
+    records['vy'] = vy
+    records['id'] = ids
+    return records
+
+
+class ShardLink:
+    """The connection to a neighbor shard, packages are sent from their own thread so two shards never block each other."""
+
+    def __init__(self, neighbor: int, sock: socket.socket):
+        self.neighbor = neighbor
+        self.sock = sock
+        self.sock.settimeout(None)  # a package is read whole once its first byte is there, see receive
+        self.alive = True
+        self.outgoing_packets: queue.Queue[Package | None] = queue.Queue()
+        self.sender = threading.Thread(target=self.send_loop, name=f"shard-link-{neighbor}")
+        self.sender.start()
+
+    def send_loop(self):
+        while True:
+            package = self.outgoing_packets.get()
+            if package is None:
+                break
+
+            status, message = Network.send_data(self.sock, package, log=False)
+            if status != ProtocolStatusCodes.ALL_GOOD:
+                logger.error(f"Failed sending to shard {self.neighbor}: {status.name} {message}")
+                self.alive = False
+                break
+
+    def send(self, package: Package):
+        self.outgoing_packets.put(package)
+
+    def receive(self) -> Package | None:
+        """
+        Wait for the next SHARD_EXCHANGE of the neighbor, None if it does not come within SHARD_LINK_TIMEOUT (the link
+        stays up, its late exchange is read in the next tick) or the link is lost (alive is then False).
+        """
+        while True:
+            if not Network.wait_for_data(self.sock, SHARD_LINK_TIMEOUT):
+                logger.warning(f"Shard {self.neighbor} missed the exchange deadline")
+                return None
+
+            status, package = Network.receive_data(self.sock, log=False)
+            if status != ProtocolStatusCodes.ALL_GOOD:
+                logger.error(f"Lost the link to shard {self.neighbor}: {status.name}")
+                self.alive = False
+                return None
+
+            if package.kind == PackageKind.SHARD_EXCHANGE:
+                return package
+            logger.error(f"Shard {self.neighbor} sent a {package.kind.name} package on the link, it is ignored")
+
+    def close(self):
+        self.outgoing_packets.put(None)
+        self.sender.join()
+        self.sock.close()
+
+
+def connect_links(layout: ShardLayout, index: int) -> dict[int, ShardLink]:
+    """Connect a shard to all its neighbors, it connects to the ones with a higher index and accepts the others."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((layout.host(index), layout.link_port(index)))
+    listener.listen(8)
+
+    links = {}
+    neighbors = layout.neighbors(index)
+    deadline = time.monotonic() + SHARD_CONNECT_TIMEOUT
+
+    for neighbor in [neighbor for neighbor in neighbors if neighbor > index]:
+        while True:
+            try:
+                sock = socket.create_connection((layout.host(neighbor), layout.link_port(neighbor)))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)  # the neighbor is not listening yet
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        Network.send_data(sock, Package(PackageKind.ESTABLISH_CONNECTION, index.to_bytes(2, 'big')), tid=index, log=False)
+        links[neighbor] = ShardLink(neighbor, sock)
+
+    listener.settimeout(SHARD_CONNECT_TIMEOUT)
+    for _ in [neighbor for neighbor in neighbors if neighbor < index]:
+        sock, _ = listener.accept()
+        sock.settimeout(None)
+        if not Network.wait_for_data(sock, SHARD_CONNECT_TIMEOUT):
+            raise ConnectionError(f"Shard {index}: a neighbor connected without a link request")
+
+        status, package = Network.receive_data(sock, tid=index, log=False)
+        if status != ProtocolStatusCodes.ALL_GOOD or package.kind != PackageKind.ESTABLISH_CONNECTION:
+            raise ConnectionError(f"Shard {index}: invalid link request ({status.name})")
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        neighbor = int.from_bytes(package.payload[:2], 'big')
+        links[neighbor] = ShardLink(neighbor, sock)
+
+    listener.close()
+    logger.info(f"Shard {index}: linked to shards {sorted(links)}")
+    return links
+
+
+class ShardSimulation(ServerSimulation):
+    """
+    The part of a sharded world that one process owns (a region of the layout), stepped with the flock engine.
+    Before every step the shard exchanges one SHARD_EXCHANGE package with each neighbor, in lockstep:
+      handoffs: the boids that left the region, they are removed here and added by the neighbor
+      ghosts: the boids within the perception radius of the neighbor's region, read only neighbors for its step
+    Both lists are in the Boid.serialize format. A boid handed off in a tick is kept as a ghost here for that tick.
+    A handoff is never dropped: the receiver adds it even over max_boids, and the boids handed to a neighbor whose link
+    is lost in that tick stay here. An exchange that misses its tick is read in the next one, only its handoffs are used.
+    """
+
+    def __init__(self, layout: ShardLayout, index: int, boids: list[Boid], links: dict[int, ShardLink], max_boids: int = DEFAULT_MAX_BOIDS,
+                 obstacles: Obstacles | None = None):
+        super().__init__(boids, engine='flock', max_boids=max_boids, bounds=layout.world_bounds, obstacles=obstacles)
+        self.layout = layout
+        self.index = index
+        self.region = layout.region(index)
+        self.links = links
+        self.handed_off = 0  # the number of boids handed off to neighbors so far
+        self.received = 0  # the number of boids received from neighbors so far
+        self.rejected = 0  # the received boids whose id this shard already has, the copy here is kept
+
+    def exchange(self) -> np.ndarray:
+        """Send the handoffs and ghosts of this tick and receive the neighbors' ones, returns the ghosts to step with."""
+        flock = self.flock
+        links = {neighbor: link for neighbor, link in self.links.items() if link.alive}
+        records = to_records(flock.ids, flock.x, flock.y, flock.vx, flock.vy)
+
+        # boids that left the region go to the neighbor on the way to their owner, they stay here if it is gone
+        routes = self.layout.route(self.index, flock.x, flock.y)
+        leaving = (routes != self.index) & np.isin(routes, list(links))
+        handoffs = records[leaving]
+        for boid_id in handoffs['id'].tolist():
+            flock.remove_boid(boid_id)
+        staying = records[~leaving]
+
+        radius = Boid.PERCEPTION_RADIUS
+        for neighbor, link in links.items():
+            min_x, min_y, max_x, max_y = self.layout.region(neighbor)
+            near = ((staying['x'] >= min_x - radius) & (staying['x'] <= max_x + radius) &
+                    (staying['y'] >= min_y - radius) & (staying['y'] <= max_y + radius))
+            payload = b"".join((pack_state_tick(self.tick), pack_records(handoffs[routes[leaving] == neighbor]), pack_records(staying[near])))
+            link.send(Package(PackageKind.SHARD_EXCHANGE, payload))
+
+        ghosts = []
+        returned = np.zeros(len(handoffs), dtype=bool)
+        for neighbor, link in links.items():
+            while True:
+                package = link.receive()
+                if package is None:
+                    break
+
+                tick, payload = split_state_tick(package.payload)
+                received_handoffs = deserialize_boids_array(payload)
+                self.add_handoffs(neighbor, received_handoffs)
+                if tick >= self.tick:
+                    offset = BOIDS_COUNT_FIELD_SIZE + received_handoffs.nbytes
+                    ghosts.append(deserialize_boids_array(payload[offset:]))
+                    break
+                logger.warning(f"Shard {self.index}: the exchange of shard {neighbor} for tick {tick} came late, this shard is at {self.tick}")
+
+            if not link.alive:
+                # the neighbor may never have got the boids handed to it in this tick, they stay here
+                lost = routes[leaving] == neighbor
+                for x, y, vx, vy, boid_id in handoffs[lost].tolist():
+                    self.flock.add_boid(Boid(x, y, vx, vy, boid_id))
+                returned |= lost
+
+        self.handed_off += int(np.count_nonzero(~returned))
+        return np.concatenate([handoffs[~returned]] + ghosts)
+
+    def add_handoffs(self, neighbor: int, handoffs: np.ndarray):
+        """Add the boids a neighbor handed to this shard, over max_boids if needed: they left the neighbor already."""
+        for x, y, vx, vy, boid_id in handoffs.tolist():
+            if self.flock.add_boid(Boid(x, y, vx, vy, boid_id)):
+                self.received += 1
+            else:
+                self.rejected += 1
+                logger.warning(f"Shard {self.index}: shard {neighbor} handed off boid {boid_id}, this shard has it already")
+
+    def step(self, dt: float):
+        """Step the region, the ghosts of the neighbors' regions come from the exchange (callers cannot pass any)."""
+        super().step(dt, self.exchange())
+
+    def close(self):
+        super().close()
+        for link in self.links.values():
+            link.close()
+
+
+def run_shard(layout: ShardLayout, index: int, boids: int, tick_rate: float, broadcast_rate: float,
+              max_boids: int = DEFAULT_MAX_BOIDS, network_backend: str = 'threads', obstacles: Obstacles | None = None):
+    """Run one shard: link to the neighbors, then serve the gateway like server_headless serves clients."""
+    stop_network = start_server_network(network_backend, server_headless.all_incoming_packets, server_headless.all_client_infos,
+                                        port=layout.setup_port(index))
+
+    simulation = ShardSimulation(layout, index, generate_boids(boids, layout.region(index)), connect_links(layout, index), max_boids, obstacles)
+    logger.info(f"Shard {index}: owns {simulation.region} with {len(simulation)} boids")
+
+    try:
+        server_headless.run(simulation, StateBroadcaster('full'), tick_rate, broadcast_rate)
+    except KeyboardInterrupt:
+        logger.info(f"Shutting down shard {index}...")
+
+    logger.info(f"Shard {index}: {len(simulation)} boids, {simulation.handed_off} handed off, {simulation.received} received, "
+                f"{simulation.rejected} rejected")
+    simulation.close()
+    stop_network()
+
+
+def parse_layout(args) -> ShardLayout:
+    return ShardLayout(tuple(args.world), args.columns, args.rows, args.hosts.split(',') if args.hosts else None)
+
+
+def add_layout_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--columns', type=int, default=2, help="the number of shards along x")
+    parser.add_argument('--rows', type=int, default=1, help="the number of shards along y")
+    parser.add_argument('--world', type=float, nargs=4, default=DEFAULT_WORLD_BOUNDS, metavar=('MIN_X', 'MIN_Y', 'MAX_X', 'MAX_Y'))
+    parser.add_argument('--hosts', default=None, help="comma separated address of every shard (one address for all of them)")
+    parser.add_argument('--obstacles', default=None, help="a JSON map of the world's obstacles (see obstacles.load_obstacles)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one shard of a sharded boids world.")
+    parser.add_argument('--index', type=int, required=True, help="the shard to run")
+    add_layout_arguments(parser)
+    parser.add_argument('--boids', type=int, default=100, help="the number of boids the shard starts with")
+    parser.add_argument('--max-boids', type=int, default=DEFAULT_MAX_BOIDS, help="the maximum number of boids of the shard")
+    parser.add_argument('--tick-rate', type=float, default=server_headless.DEFAULT_TICK_RATE, help="simulation steps per second")
+    parser.add_argument('--broadcast-rate', type=float, default=server_headless.DEFAULT_BROADCAST_RATE, help="state sends to the gateway per second")
+    parser.add_argument('--network-backend', choices=('threads', 'asyncio'), default='threads')
+    args = parser.parse_args()
+
+    obstacles = load_obstacles(args.obstacles) if args.obstacles else None
+    run_shard(parse_layout(args), args.index, args.boids, args.tick_rate, args.broadcast_rate, args.max_boids, args.network_backend, obstacles)
+
+
+if __name__ == '__main__':
+    main()
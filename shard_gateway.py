@@ -0,0 +1,216 @@
+import argparse
+import multiprocessing
+import queue
+import threading
+import time
+import numpy as np
+from boid import Boid
+from boid_helper import BOIDS_COUNT_FIELD_SIZE, pack_state_tick, split_state_tick, deserialize_commands, serialize_commands
+from flock import BOID_WIRE_DTYPE, deserialize_boids_array
+from network import Network, Package, PackageKind, ProtocolStatusCodes
+from network_vars import SessionFlags
+from client_network import communicating_setup
+from server_network import ClientCommunicationInfo
+from server_network_async import start_server_network
+from state_broadcast import StateBroadcaster
+import shard
+from shard import ShardLayout
+from obstacles import Obstacles, load_obstacles
+from logger_utils import create_formatted_logger
+
+logger = create_formatted_logger()
+
+DEFAULT_BROADCAST_RATE = 20  # merged state broadcasts per second
+FEED_POLL_TIMEOUT = 2.0  # seconds a shard feed waits for data before checking whether it was closed
+
+all_incoming_packets = queue.Queue()  # a queue for all incoming packets
+
+all_client_infos: list[ClientCommunicationInfo] = []  # a list to store all client information
+
+
+class ShardFeed:
+    """The gateway's connection to one shard, a single connection session that keeps the newest state of the shard."""
+
+    def __init__(self, layout: ShardLayout, index: int):
+        self.index = index
+
+        deadline = time.monotonic() + shard.SHARD_CONNECT_TIMEOUT
+        while True:
+            try:
+                self.socket, _, _ = communicating_setup(SessionFlags.SINGLE_CONNECTION, layout.host(index), layout.setup_port(index))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)  # the shard is not listening yet
+
+        self.socket.settimeout(None)  # a package is read whole once its first byte is there, see receive_loop
+        self.send_lock = threading.Lock()
+        self.tick = -1
+        self.records = np.empty(0, dtype=BOID_WIRE_DTYPE)  # the newest state of the shard
+        self.alive = True
+        self.receiver = threading.Thread(target=self.receive_loop, name=f"shard-feed-{index}")
+        self.receiver.start()
+
+    def receive_loop(self):
+        while self.alive:
+            if not Network.wait_for_data(self.socket, FEED_POLL_TIMEOUT):
+                continue  # check alive again
+
+            status, package = Network.receive_data(self.socket, self.index, log=False)
+            if status != ProtocolStatusCodes.ALL_GOOD:
+                logger.error(f"Lost the connection to shard {self.index}: {status.name}")
+                self.alive = False
+                break
+
+            if package.kind == PackageKind.BOIDS_STATE:
+                self.tick, payload = split_state_tick(package.payload)
+                self.records = deserialize_boids_array(payload)
+
+    def send(self, package: Package):
+        with self.send_lock:
+            Network.send_data(self.socket, package, self.index, log=False)
+
+    def close(self):
+        if self.alive:
+            self.send(Package(PackageKind.EXIT, b""))
+        self.alive = False
+        self.receiver.join()
+        self.socket.close()
+
+
+class MergedWorld:
+    """
+    The states of all the shards merged into one world, it has the methods of ServerSimulation that the
+    StateBroadcaster uses, so clients of the gateway get every state encoding, delta stream and viewport culling.
+    """
+
+    def __init__(self, obstacles: Obstacles | None = None):
+        self.tick = 0
+        self.obstacles = obstacles  # the same obstacles as the shards, sent to the clients
+        self.records = np.empty(0, dtype=BOID_WIRE_DTYPE)
+        self.arrays = (np.empty(0, dtype=np.uint32),) + (np.empty(0, dtype=np.float64),) * 4
+
+    def __len__(self):
+        return len(self.records)
+
+    def update(self, feeds: list[ShardFeed]):
+        """
+        Merge the newest state of every shard, the tick is the one of the slowest shard.
+        The shards' states may be from different ticks, a boid handed off between them can be in two states: only its
+        copy from the newest state is kept, the ids of the world stay unique (the delta stream relies on it).
+        """
+        feeds = sorted(feeds, key=lambda feed: feed.tick, reverse=True)
+        # concatenate promotes to the native byte order, the records must stay in the wire format
+        records = np.concatenate([feed.records for feed in feeds], dtype=BOID_WIRE_DTYPE) if len(feeds) > 0 else self.records[:0]
+        _, first = np.unique(records['id'], return_index=True)
+        if len(first) < len(records):
+            records = records[np.sort(first)]
+        self.records = records
+        self.tick = min((feed.tick for feed in feeds), default=0)
+        self.arrays = (self.records['id'].astype(np.uint32), self.records['x'].astype(np.float64), self.records['y'].astype(np.float64),
+                       self.records['vx'].astype(np.float64), self.records['vy'].astype(np.float64))
+
+    def get_state_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        return self.arrays
+
+    def serialize_state(self, indices: np.ndarray | None = None) -> bytes:
+        records = self.records if indices is None else self.records[indices]
+        return b"".join((pack_state_tick(self.tick), len(records).to_bytes(BOIDS_COUNT_FIELD_SIZE, 'big'), records.tobytes()))
+
+
+class ShardGateway:
+    """Serves the clients of a sharded world: merges the shards' states and routes the clients' packages to the shards."""
+
+    def __init__(self, layout: ShardLayout, obstacles: Obstacles | None = None):
+        self.layout = layout
+        self.feeds = [ShardFeed(layout, index) for index in range(len(layout))]
+        self.world = MergedWorld(obstacles)
+
+    def send_to_all(self, package: Package):
+        for feed in self.feeds:
+            if feed.alive:
+                feed.send(package)
+
+    def send_to_owner(self, boid: Boid, package: Package):
+        feed = self.feeds[int(self.layout.owners(np.array([boid.x]), np.array([boid.y]))[0])]
+        if feed.alive:
+            feed.send(package)
+
+    def apply_package(self, packet: Package):
+        match packet.kind:
+            case PackageKind.ADD_BOID:
+                self.send_to_owner(Boid.deserialize(packet.payload), packet)
+            case PackageKind.REMOVE_BOID | PackageKind.SET_TARGET:
+                self.send_to_all(packet)  # the shards that do not have the boid ignore it
+            case PackageKind.BOIDS_COMMANDS:
+                added_boids, removed_ids = deserialize_commands(packet.payload)
+                owners = self.layout.owners(np.array([boid.x for boid in added_boids]), np.array([boid.y for boid in added_boids]))
+                for index, feed in enumerate(self.feeds):
+                    shard_boids = [boid for boid, owner in zip(added_boids, owners.tolist()) if owner == index]
+                    if feed.alive and (len(shard_boids) > 0 or len(removed_ids) > 0):
+                        feed.send(Package(PackageKind.BOIDS_COMMANDS, serialize_commands(shard_boids, removed_ids)))
+            case _:
+                logger.error(f"Unknown package kind: {packet.kind.name}")
+
+    def run(self, broadcaster: StateBroadcaster, broadcast_rate: float):
+        broadcast_interval = 1 / broadcast_rate
+        next_broadcast = time.perf_counter()
+
+        while any(feed.alive for feed in self.feeds):
+            while not all_incoming_packets.empty():
+                self.apply_package(all_incoming_packets.get())
+
+            self.world.update([feed for feed in self.feeds if feed.alive])
+            broadcaster.broadcast(all_client_infos, self.world)
+
+            next_broadcast = max(next_broadcast + broadcast_interval, time.perf_counter())
+            time.sleep(max(0.0, next_broadcast - time.perf_counter()))
+
+    def close(self):
+        for feed in self.feeds:
+            feed.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the clients of a sharded boids world, optionally starting the shards.")
+    shard.add_layout_arguments(parser)
+    parser.add_argument('--spawn', action='store_true', help="start every shard as a local process")
+    parser.add_argument('--boids-per-shard', type=int, default=100, help="the number of boids every spawned shard starts with")
+    parser.add_argument('--max-boids', type=int, default=shard.DEFAULT_MAX_BOIDS, help="the maximum number of boids of a spawned shard")
+    parser.add_argument('--tick-rate', type=float, default=60, help="simulation steps per second of the spawned shards")
+    parser.add_argument('--broadcast-rate', type=float, default=DEFAULT_BROADCAST_RATE, help="merged state broadcasts per second")
+    parser.add_argument('--state-stream', choices=('full', 'delta'), default='full', help="full snapshots or deltas between keyframes")
+    parser.add_argument('--network-backend', choices=('threads', 'asyncio'), default='threads', help="thread per socket or one event loop")
+    args = parser.parse_args()
+
+    layout = shard.parse_layout(args)
+    obstacles = load_obstacles(args.obstacles) if args.obstacles else None
+
+    processes = []
+    if args.spawn:
+        for index in range(len(layout)):
+            process = multiprocessing.Process(target=shard.run_shard, name=f"shard-{index}",
+                                              args=(layout, index, args.boids_per_shard, args.tick_rate, args.broadcast_rate,
+                                                    args.max_boids, args.network_backend, obstacles))
+            process.start()
+            processes.append(process)
+
+    gateway = ShardGateway(layout, obstacles)
+    stop_network = start_server_network(args.network_backend, all_incoming_packets, all_client_infos)
+    logger.info(f"Gateway serving a {layout.columns}x{layout.rows} sharded world of {layout.world_bounds}")
+
+    try:
+        gateway.run(StateBroadcaster(args.state_stream), args.broadcast_rate)
+    except KeyboardInterrupt:
+        logger.info("Shutting down gateway...")
+
+    gateway.close()
+    stop_network()
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
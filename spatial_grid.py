@@ -0,0 +1,124 @@
+import math
+import numpy as np
+
+
+class SpatialGrid:
+    """
+    A uniform grid (cell list) over the boids, used to find the boids inside a perception radius
+    without scanning the whole flock.
+    The cell size should be at least the query radius, so that a query only has to look at the 3x3 block of
+    cells around the query point.
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list] = {}  # (cell x, cell y) -> boids in the cell
+
+    def get_cell(self, x: float, y: float) -> tuple[int, int]:
+        """Get the cell coordinates of a point."""
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def clear(self):
+        self.cells.clear()
+
+    def insert(self, boid):
+        self.cells.setdefault(self.get_cell(boid.x, boid.y), []).append(boid)
+
+    def remove(self, boid, x: float | None = None, y: float | None = None):
+        """Remove a boid from the grid, (x, y) is the position the boid was inserted at (defaults to its current one)."""
+        cell = self.get_cell(boid.x if x is None else x, boid.y if y is None else y)
+        cell_boids = self.cells.get(cell)
+        if cell_boids is None:
+            return
+
+        for i in range(len(cell_boids)):
+            if cell_boids[i] is boid:
+                cell_boids.pop(i)
+                break
+
+        if len(cell_boids) == 0:
+            del self.cells[cell]
+
+    def move(self, boid, old_x: float, old_y: float):
+        """Update the cell of a boid that moved from (old_x, old_y) to its current position."""
+        old_cell = self.get_cell(old_x, old_y)
+        new_cell = self.get_cell(boid.x, boid.y)
+
+        if old_cell != new_cell:
+            self.remove(boid, old_x, old_y)
+            self.cells.setdefault(new_cell, []).append(boid)
+
+    def rebuild(self, boids: list):
+        """Rebuild the grid from scratch, should be called once per tick."""
+        self.cells.clear()
+        for boid in boids:
+            self.insert(boid)
+
+    def query(self, x: float, y: float) -> list:
+        """Get all the boids in the 3x3 cells block around a point, a superset of the boids inside one cell size."""
+        cx, cy = self.get_cell(x, y)
+        result = []
+
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                cell_boids = self.cells.get((cx + dx, cy + dy))
+                if cell_boids is not None:
+                    result.extend(cell_boids)
+
+        return result
+
+
+class CellIndex:
+    """
+    A sorted cell list over position arrays, built once per frame and queried by rectangles.
+    Used to select the boids inside an area (a client's viewport) without testing the whole flock.
+    """
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, cell_size: float):
+        self.x = x
+        self.y = y
+        self.cell_size = cell_size
+
+        if len(x) == 0:
+            self.order = np.empty(0, dtype=np.intp)
+            self.sorted_keys = np.empty(0, dtype=np.int64)
+            return
+
+        cx = np.floor(x / cell_size).astype(np.int64)
+        cy = np.floor(y / cell_size).astype(np.int64)
+        self.min_cx, self.max_cx = int(cx.min()), int(cx.max())
+        self.min_cy, self.max_cy = int(cy.min()), int(cy.max())
+        self.height = self.max_cy - self.min_cy + 1
+
+        # the cells of a column are next to each other in key order, a rectangle is one key range per column
+        keys = (cx - self.min_cx) * self.height + (cy - self.min_cy)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def query_rect(self, min_x: float, min_y: float, max_x: float, max_y: float) -> np.ndarray:
+        """Get the (sorted) indices of the points inside the rectangle."""
+        if len(self.order) == 0:
+            return np.empty(0, dtype=np.intp)
+
+        first_cx = max(math.floor(min_x / self.cell_size), self.min_cx)
+        last_cx = min(math.floor(max_x / self.cell_size), self.max_cx)
+        first_cy = max(math.floor(min_y / self.cell_size), self.min_cy)
+        last_cy = min(math.floor(max_y / self.cell_size), self.max_cy)
+        if first_cx > last_cx or first_cy > last_cy:
+            return np.empty(0, dtype=np.intp)
+
+        columns = np.arange(first_cx - self.min_cx, last_cx - self.min_cx + 1, dtype=np.int64) * self.height
+        start = np.searchsorted(self.sorted_keys, columns + (first_cy - self.min_cy), 'left')
+        end = np.searchsorted(self.sorted_keys, columns + (last_cy - self.min_cy), 'right')
+        lengths = end - start
+
+        # expand every [start, end) range into the positions it covers
+        total = int(lengths.sum())
+        offsets = np.repeat(start - (np.cumsum(lengths) - lengths), lengths)
+        candidates = self.order[np.arange(total) + offsets]
+
+        # the border cells are only partly inside the rectangle
+        x = self.x[candidates]
+        y = self.y[candidates]
+        inside = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        return np.sort(candidates[inside])
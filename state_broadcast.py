@@ -0,0 +1,157 @@
+import numpy as np
+from network import Package, PackageKind
+from network_vars import SessionFlags
+from server_network import ClientCommunicationInfo
+from delta_codec import DeltaEncoder
+from compact_codec import CompactStateEncoder
+from spatial_grid import CellIndex
+from obstacles import serialize_obstacles
+from metrics import server_metrics
+
+VIEWPORT_MARGIN = 64  # boids this far outside a client's viewport are sent too, so they do not pop in at its edges
+VIEWPORT_CELL_SIZE = 128  # the cell size of the index the viewports are selected with
+
+
+class StateBroadcaster:
+    """
+    Sends the world state to every client, each encoding is built at most once per broadcast and the same
+    immutable package is shared by all the clients that use it.
+
+    state_stream: 'full' sends the whole state every frame (BOIDS_STATE), 'delta' sends only the changes between
+                  keyframes (BOIDS_DELTA). Clients that negotiated SessionFlags.COMPACT_STATE get BOIDS_STATE_COMPACT.
+    Every state payload starts with the simulation tick (see boid_helper.pack_state_tick), clients interpolate by it.
+    The encoders write it in the buffer they build the payload in, so a payload is never copied to add it.
+
+    Clients that set a viewport (SET_VIEWPORT) get only the boids inside it plus VIEWPORT_MARGIN, selected through a
+    cell index built once per broadcast. The delta stream has one baseline for everybody, so such clients get the full
+    (BOIDS_STATE) state of their area instead, and a keyframe once they clear the viewport.
+
+    The world's static obstacles (simulation.obstacles) are sent once to every client, before its first state.
+
+    Building the encodings is timed as the 'serialize' phase of the server metrics, the rest of a broadcast is the fan out.
+    """
+
+    def __init__(self, state_stream: str = 'full'):
+        self.delta_encoder = DeltaEncoder() if state_stream == 'delta' else None
+        self.compact_encoder = CompactStateEncoder()
+
+        # the state of the current broadcast, built on demand
+        self._state_arrays: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None
+        self._cell_index: CellIndex | None = None
+        self._selections: dict[tuple[float, float, float, float], np.ndarray] = {}
+        self._obstacles_package: Package | None = None  # the OBSTACLES package, the obstacles never change
+
+    def broadcast(self, all_client_infos: list[ClientCommunicationInfo], simulation):
+        clients = [client_info for client_info in all_client_infos if not client_info.should_terminate]
+        if len(clients) == 0 and self.delta_encoder is None:
+            return
+
+        if simulation.obstacles is not None:
+            self.send_obstacles([client_info for client_info in clients if client_info.needs_obstacles], simulation.obstacles)
+
+        self._state_arrays = simulation.get_state_arrays()
+        self._cell_index = None
+        self._selections.clear()
+        tick = simulation.tick
+
+        compact_clients = [client_info for client_info in clients if client_info.session_flags & SessionFlags.COMPACT_STATE]
+        other_clients = [client_info for client_info in clients if not client_info.session_flags & SessionFlags.COMPACT_STATE]
+
+        if len(compact_clients) > 0:
+            with server_metrics.phase('serialize'):
+                compact_fits = self.compact_encoder.update(*self._state_arrays, tick)
+            if compact_fits:
+                self.broadcast_compact(compact_clients)
+            else:
+                other_clients += compact_clients  # too many boids for the compact format
+
+        culled_clients = [client_info for client_info in other_clients if client_info.viewport is not None]
+        other_clients = [client_info for client_info in other_clients if client_info.viewport is None]
+
+        if self.delta_encoder is not None:
+            with server_metrics.phase('serialize'):
+                self.delta_encoder.update(*self._state_arrays, tick)  # the stream advances even without clients
+            self.broadcast_delta(other_clients)
+        elif len(other_clients) > 0:
+            with server_metrics.phase('serialize'):
+                state_payload = simulation.serialize_state()
+            self.broadcast_full(other_clients, state_payload)
+
+        if len(culled_clients) > 0:
+            self.broadcast_culled(culled_clients, simulation)
+
+        self._state_arrays = None
+
+    def select_viewport(self, viewport: tuple[float, float, float, float]) -> np.ndarray:
+        """The indices of the boids a viewport gets, computed once per broadcast for every distinct viewport."""
+        if viewport not in self._selections:
+            if self._cell_index is None:
+                _, x, y, _, _ = self._state_arrays
+                self._cell_index = CellIndex(x, y, VIEWPORT_CELL_SIZE)
+
+            min_x, min_y, max_x, max_y = viewport
+            self._selections[viewport] = self._cell_index.query_rect(min_x - VIEWPORT_MARGIN, min_y - VIEWPORT_MARGIN,
+                                                                     max_x + VIEWPORT_MARGIN, max_y + VIEWPORT_MARGIN)
+        return self._selections[viewport]
+
+    def send_obstacles(self, clients: list[ClientCommunicationInfo], obstacles):
+        if len(clients) == 0:
+            return
+
+        if self._obstacles_package is None:
+            self._obstacles_package = Package(PackageKind.OBSTACLES, serialize_obstacles(obstacles))
+
+        for client_info in clients:
+            client_info.needs_obstacles = False
+            client_info.outgoing_queue.put(self._obstacles_package)
+
+    @staticmethod
+    def broadcast_full(clients: list[ClientCommunicationInfo], state_payload: bytes):
+        package = Package(PackageKind.BOIDS_STATE, state_payload)
+
+        for client_info in clients:
+            client_info.outgoing_queue.put(package)
+
+    def broadcast_culled(self, clients: list[ClientCommunicationInfo], simulation):
+        """Send the full state of every client's viewport, clients with the same viewport share the package."""
+        packages = {}
+
+        for client_info in clients:
+            if client_info.viewport not in packages:
+                with server_metrics.phase('serialize'):
+                    state_payload = simulation.serialize_state(self.select_viewport(client_info.viewport))
+                packages[client_info.viewport] = Package(PackageKind.BOIDS_STATE, state_payload)
+
+            client_info.outgoing_queue.put(packages[client_info.viewport])
+
+    def broadcast_delta(self, clients: list[ClientCommunicationInfo]):
+        """Send the current frame of the delta stream, a keyframe to the clients that need one."""
+        keyframe_due = self.delta_encoder.is_keyframe_due()
+        with server_metrics.phase('serialize'):
+            delta_package = Package(PackageKind.BOIDS_DELTA, self.delta_encoder.delta_payload())
+        keyframe_package = None
+
+        for client_info in clients:
+            if keyframe_due or client_info.needs_keyframe:
+                if keyframe_package is None:
+                    with server_metrics.phase('serialize'):
+                        keyframe_package = Package(PackageKind.BOIDS_DELTA, self.delta_encoder.keyframe_payload())
+                client_info.needs_keyframe = False
+                client_info.outgoing_queue.put(keyframe_package)
+            else:
+                client_info.outgoing_queue.put(delta_package)
+
+    def broadcast_compact(self, clients: list[ClientCommunicationInfo]):
+        """Send the compact state, with the index table to the clients that do not have its current epoch."""
+        packages = {}
+
+        for client_info in clients:
+            with_table = client_info.index_epoch != self.compact_encoder.epoch
+            key = (with_table, client_info.viewport)
+            if key not in packages:
+                indices = None if client_info.viewport is None else self.select_viewport(client_info.viewport)
+                with server_metrics.phase('serialize'):
+                    packages[key] = Package(PackageKind.BOIDS_STATE_COMPACT, self.compact_encoder.payload(with_table, indices))
+
+            client_info.index_epoch = self.compact_encoder.epoch
+            client_info.outgoing_queue.put(packages[key])
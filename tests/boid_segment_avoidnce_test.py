@@ -1,5 +1,6 @@
 from raylibpy import *
 from boid import Boid
+from obstacles import Obstacles
 import random
 import math
 
@@ -54,6 +55,7 @@ def main():
     boids = [Boid(400, 100, 0, 40)]
 
     segments = [((10, 400), (790, 350))]
+    obstacles = Obstacles([(x1, y1, x2, y2) for (x1, y1), (x2, y2) in segments])
 
     while not window_should_close():
         # Update
@@ -62,7 +64,7 @@ def main():
 
         # Draw
         for boid in boids:
-            boid.update(get_frame_time(), boids, 10, 10, 800 - 10, 450 - 10, segments)
+            boid.update(get_frame_time(), boids, 10, 10, 800 - 10, 450 - 10, None, None, obstacles=obstacles)
 
         for segment in segments:
             p1 = Vector2(segment[0][0], segment[0][1])